@@ -0,0 +1,78 @@
+# 模拟做种时多个对等方请求少量热门片段，比较不使用读取缓存（每个请求从磁盘读取整个片段）与使用读取缓存的吞吐量和命中率
+# 每个对等方按顺序请求一个片段中的所有块，热门片段被多个对等方交替请求
+# 用法: python benchmarks/bench_read_cache.py [种子大小MiB] [热门片段数量] [对等方数量]
+import os
+import sys
+import time
+import random
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcoding import bencode
+import torrent
+import read_cache
+import pieces_manager
+from block import BLOCK_SIZE
+
+PIECE_LENGTH = 1024 * 1024
+
+
+# 生成单文件种子和对应的数据文件，返回种子文件路径
+def make_torrent(directory, size):
+    data = os.urandom(size)
+    with open(os.path.join(directory, 'data.bin'), 'wb') as f:
+        f.write(data)
+    pieces = b''.join(hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, size, PIECE_LENGTH))
+    info = {'name': 'data.bin', 'piece length': PIECE_LENGTH, 'length': size, 'pieces': pieces}
+    path = os.path.join(directory, 'data.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencode({'announce': 'http://127.0.0.1/announce', 'info': info}))
+    return path
+
+
+# 生成请求序列：每个对等方选择一个热门片段，多个对等方的块请求交替到达
+def make_requests(number_of_pieces, hot_pieces, peers):
+    rng = random.Random(1)
+    hot = rng.sample(range(number_of_pieces), hot_pieces)
+    streams = [[(piece_index, offset) for offset in range(0, PIECE_LENGTH, BLOCK_SIZE)]
+               for piece_index in (rng.choice(hot) for _ in range(peers))]
+    requests = []
+    while any(streams):
+        for stream in streams:
+            if stream:
+                requests.append(stream.pop(0))
+    return requests
+
+
+def bench(name, torrent_path, requests, cache_size):
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path),
+                                           cache=read_cache.ReadCache(cache_size))
+    for index in range(manager.number_of_pieces):
+        manager.set_piece_completed(index)
+
+    start = time.perf_counter()
+    for piece_index, offset in requests:
+        manager.get_block(piece_index, offset, BLOCK_SIZE)
+    elapsed = time.perf_counter() - start
+    manager.disk_io.close()
+    stats = manager.read_cache.stats()
+    print("{:<10} {:>8.1f} MiB/s  hit ratio {:>5.1f}%".format(name, len(requests) * BLOCK_SIZE / elapsed / 1024 / 1024,
+                                                            stats['hit_ratio'] * 100))
+    return elapsed
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 * 1024 * 1024
+    hot_pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    peers = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        torrent_path = make_torrent(directory, size)
+        requests = make_requests(size // PIECE_LENGTH, hot_pieces, peers)
+        print("{} block requests from {} peers for {} hot pieces".format(len(requests), peers, hot_pieces))
+        old = bench('no cache', torrent_path, requests, 0)
+        new = bench('cache', torrent_path, requests, read_cache.READ_CACHE_SIZE)
+        print("speedup: {:.1f}x".format(old / new))
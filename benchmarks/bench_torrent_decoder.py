@@ -0,0 +1,59 @@
+# 比较bcoding与torrent_decoder.TorrentDecoder加载大型种子文件并计算种子哈希值的耗时
+# 用法: python benchmarks/bench_torrent_decoder.py [文件数量] [片段数量]
+import os
+import sys
+import time
+import hashlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcoding import bencode, bdecode
+from torrent_decoder import TorrentDecoder
+
+
+# 生成包含大量文件和片段的种子文件数据
+def make_torrent(number_of_files, number_of_pieces):
+    files = [{'length': 1000 + i, 'path': ['dir%d' % (i % 100), 'file%d.bin' % i]} for i in range(number_of_files)]
+    info = {
+        'name': 'bench',
+        'piece length': 2 ** 18,
+        'pieces': os.urandom(20 * number_of_pieces),
+        'files': files
+    }
+    return bencode({'announce': 'http://127.0.0.1/announce', 'info': info})
+
+
+def bench(name, task, data, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        info_hash = task(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{:<16} {:>8.3f} s  {}".format(name, best, info_hash.hex()))
+    return best
+
+
+# 原来的做法：解码后重新编码info字典
+def load_with_bcoding(data):
+    contents = bdecode(data)
+    return hashlib.sha1(bencode(contents['info'])).digest()
+
+
+# 直接对info字典的原始字节计算哈希值
+def load_with_decoder(data):
+    decoder = TorrentDecoder(data)
+    decoder.decode()
+    return hashlib.sha1(decoder.raw_info()).digest()
+
+
+if __name__ == '__main__':
+    number_of_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    number_of_pieces = int(sys.argv[2]) if len(sys.argv) > 2 else 250000
+
+    data = make_torrent(number_of_files, number_of_pieces)
+    print("torrent: {:.1f} MiB, {} files, {} pieces".format(len(data) / 1024 / 1024, number_of_files,
+                                                           number_of_pieces))
+    old = bench('bcoding', load_with_bcoding, data)
+    new = bench('TorrentDecoder', load_with_decoder, data)
+    print("speedup: {:.1f}x".format(old / new))
@@ -0,0 +1,141 @@
+# 比较逐个处理请求（每个块读取整个片段并复制为PIECE消息）与上传管道（合并相邻请求并通过sendfile发送）的上传吞吐量
+# 上传管道分别在不使用读取缓存和使用默认大小的读取缓存时测试，每个片段只被请求一次
+# 对等方用本地套接字对模拟，另一端由线程读取并丢弃数据
+# 用法: python benchmarks/bench_upload.py [数据量MiB] [片段大小KiB]
+import os
+import sys
+import time
+import select
+import socket
+import hashlib
+import tempfile
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcoding import bencode
+import message
+import peer
+import torrent
+import pieces_manager
+import upload_queue
+import read_cache
+from block import BLOCK_SIZE
+
+
+# 生成单文件种子和对应的数据文件，返回种子文件路径
+def make_torrent(directory, size, piece_length):
+    data = os.urandom(size)
+    with open(os.path.join(directory, 'data.bin'), 'wb') as f:
+        f.write(data)
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, size, piece_length))
+    info = {'name': 'data.bin', 'piece length': piece_length, 'length': size, 'pieces': pieces}
+    path = os.path.join(directory, 'data.torrent')
+    with open(path, 'wb') as f:
+        f.write(bencode({'announce': 'http://127.0.0.1/announce', 'info': info}))
+    return path
+
+
+# 所有片段都已写入磁盘的片段管理器
+def make_storage(torrent_path, cache_size):
+    storage = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path),
+                                           cache=read_cache.ReadCache(cache_size))
+    for index in range(storage.number_of_pieces):
+        storage.set_piece_completed(index)
+    return storage
+
+
+def make_peer(number_of_pieces):
+    local, remote = socket.socketpair()
+    local.setblocking(False)
+    new_peer = peer.Peer(number_of_pieces, '127.0.0.1')
+    new_peer.socket = local
+    new_peer.healthy = True
+    received = [0]
+
+    def drain():
+        while True:
+            data = remote.recv(1024 * 1024)
+            if not data:
+                return
+            received[0] += len(data)
+
+    Thread(target=drain, daemon=True).start()
+    return new_peer, received
+
+
+def requests(storage):
+    for piece_index in range(storage.number_of_pieces):
+        size = storage.pieces[piece_index].piece_size
+        for offset in range(0, size, BLOCK_SIZE):
+            yield message.Request(piece_index, offset, min(BLOCK_SIZE, size - offset))
+
+
+# 等待发送缓冲区清空
+def wait_flushed(new_peer):
+    while new_peer.write_buffer:
+        select.select([], [new_peer.socket], [], 1)
+        new_peer.flush()
+
+
+# 原来的做法：每个请求从磁盘读取整个片段，复制为完整的PIECE消息后发送
+def serve_each(storage, new_peer):
+    for request in requests(storage):
+        block = storage.pieces[request.piece_index].get_block(request.block_offset, request.block_length)
+        new_peer.send_to_peer(message.Piece(request.block_length, request.piece_index, request.block_offset,
+                                            block).to_bytes())
+        if len(new_peer.write_buffer) >= upload_queue.UPLOAD_BUFFER_SIZE:
+            wait_flushed(new_peer)
+    wait_flushed(new_peer)
+
+
+# 上传管道：请求排队后合并处理
+def serve_pipeline(storage, new_peer):
+    uploader = upload_queue.Uploader()
+    pending = requests(storage)
+    while True:
+        # 对等方的请求队列有上限，只补充到上限
+        while len(new_peer.upload_queue) < upload_queue.MAX_QUEUED_REQUESTS:
+            request = next(pending, None)
+            if not request:
+                break
+            new_peer.upload_queue.add(request)
+        if not new_peer.upload_queue:
+            break
+        uploader.serve(new_peer, storage)
+        if new_peer.write_buffer:
+            select.select([], [new_peer.socket], [], 1)
+            new_peer.flush()
+    wait_flushed(new_peer)
+    uploader.close()
+
+
+def bench(name, serve, torrent_path, cache_size):
+    storage = make_storage(torrent_path, cache_size)
+    new_peer, received = make_peer(storage.number_of_pieces)
+    start = time.perf_counter()
+    serve(storage, new_peer)
+    # 每个块的PIECE消息有13字节的头部
+    size = storage.file_table.total_length
+    expected = size + 13 * sum(1 for _ in requests(storage))
+    while received[0] < expected:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    storage.disk_io.close()
+    print("{:<16} {:>8.1f} MiB/s  cache hit ratio {:>5.1f}%".format(name, size / elapsed / 1024 / 1024,
+                                                                   storage.read_cache.hit_ratio() * 100))
+    return elapsed
+
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 256 * 1024 * 1024
+    piece_length = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        torrent_path = make_torrent(directory, size, piece_length)
+        print("upload {:.0f} MiB in {} KiB pieces".format(size / 1024 / 1024, piece_length // 1024))
+        old = bench('each', serve_each, torrent_path, 0)
+        new = bench('pipeline', serve_pipeline, torrent_path, 0)
+        cached = bench('pipeline+cache', serve_pipeline, torrent_path, read_cache.READ_CACHE_SIZE)
+        print("speedup: {:.1f}x, {:.1f}x with the default read cache".format(old / new, old / cached))
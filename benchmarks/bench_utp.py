@@ -0,0 +1,148 @@
+# 在模拟的瓶颈链路上测量uTP的吞吐量和排队延迟，比较LEDBAT与不控制延迟（只在丢包时减小窗口）的情况
+# 链路有固定的单向延迟、带宽上限和一个较大的路由器缓冲区，缓冲区满时丢弃数据包
+# 用法: python benchmarks/bench_utp.py [传输量MiB] [带宽KiB/s] [单向延迟ms]
+import os
+import sys
+import time
+import heapq
+import select
+import socket
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import utp
+
+# 路由器缓冲区能容纳的排队时间（秒）
+BUFFER_DELAY = 1.0
+
+
+# 代替对等方管理器，只记录接受的连接
+class Acceptor(object):
+    def __init__(self):
+        self.streams = []
+
+    def accept_stream(self, sock, ip, port, is_utp=False):
+        sock.setblocking(False)
+        self.streams.append(sock)
+        return True
+
+
+# 在两个uTP端点之间转发数据包，模拟延迟和瓶颈带宽，记录每个数据包在缓冲区中的排队时间
+class Link(object):
+    def __init__(self, rate, delay):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.rate = rate
+        self.delay = delay
+        self.client = None
+        self.server = None
+        # 瓶颈链路空闲的时间
+        self.free_at = 0.0
+        # 等待送达的数据包，每项为(送达时间, 序号, 数据, 目标地址)
+        self.pending = []
+        self.count = 0
+        self.queuing_delays = []
+        self.dropped = 0
+
+    def handle_readable(self):
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except BlockingIOError:
+                return
+            now = time.time()
+            if address == self.server:
+                # 反方向只有确认，不经过瓶颈
+                arrival, target = now + self.delay, self.client
+            else:
+                self.client = address
+                start = max(now, self.free_at)
+                if start - now > BUFFER_DELAY:
+                    self.dropped += 1
+                    continue
+                self.queuing_delays.append(start - now)
+                self.free_at = start + len(data) / self.rate
+                arrival, target = self.free_at + self.delay, self.server
+            self.count += 1
+            heapq.heappush(self.pending, (arrival, self.count, data, target))
+
+    def deliver(self):
+        now = time.time()
+        while self.pending and self.pending[0][0] <= now:
+            _, _, data, target = heapq.heappop(self.pending)
+            self.socket.sendto(data, target)
+
+    def next_delivery(self):
+        return self.pending[0][0] - time.time() if self.pending else 0.01
+
+
+def run(size, rate, delay):
+    acceptor = Acceptor()
+    server = utp.UTP(acceptor, 0)
+    client = utp.UTP(acceptor, 0)
+    link = Link(rate, delay)
+    link.server = ('127.0.0.1', server.socket.getsockname()[1])
+    managers = [server, client]
+
+    result = {}
+    connector = Thread(target=lambda: result.update(sock=client.connect(*link.address)), daemon=True)
+    connector.start()
+
+    data = os.urandom(size)
+    sent = received = 0
+    start = time.time()
+    while received < size and time.time() - start < 120:
+        sockets = [link.socket]
+        for manager in managers:
+            sockets.extend(manager.sockets())
+        timeout = max(min([link.next_delivery()] + [manager.timeout() for manager in managers]), 0)
+        readable, _, _ = select.select(sockets, [], [], timeout)
+        if link.socket in readable:
+            link.handle_readable()
+        for manager in managers:
+            for sock in manager.sockets():
+                if sock in readable:
+                    manager.handle_readable(sock)
+            manager.update()
+        link.deliver()
+
+        sender = result.get('sock')
+        if sender and sent < size:
+            sender.setblocking(False)
+            try:
+                sent += sender.send(data[sent:sent + 65536])
+            except BlockingIOError:
+                pass
+        for stream in acceptor.streams:
+            try:
+                received += len(stream.recv(65536))
+            except BlockingIOError:
+                pass
+
+    elapsed = time.time() - start
+    delays = sorted(link.queuing_delays)
+    print("{:<12} {:>8.1f} KiB/s  queuing delay avg {:>6.1f} ms  p95 {:>6.1f} ms  max {:>6.1f} ms  dropped {}".format(
+        'LEDBAT' if utp.TARGET_DELAY < BUFFER_DELAY else 'no LEDBAT',
+        received / elapsed / 1024,
+        sum(delays) / len(delays) * 1000,
+        delays[int(len(delays) * 0.95)] * 1000,
+        delays[-1] * 1000,
+        link.dropped))
+
+
+if __name__ == '__main__':
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 4 * 1024 * 1024
+    rate = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 512 * 1024
+    delay = int(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.025
+
+    print("transfer {:.1f} MiB over {} KiB/s with {:.0f} ms one-way delay".format(size / 1024 / 1024, rate // 1024,
+                                                                                delay * 1000))
+    run(size, rate, delay)
+    # 目标延迟大于缓冲区容量时，窗口只在丢包时减小，相当于普通的基于丢包的拥塞控制
+    # 从较大的窗口开始，相当于TCP慢启动之后的状态
+    utp.TARGET_DELAY = 1e9
+    utp.INITIAL_WINDOW = utp.MAX_WINDOW // 4
+    run(size, rate, delay)
@@ -24,6 +24,10 @@ class Block():
         self.data: bytes = data
         # 记录最后一次见到该数据块的时间戳，用于确定一个正在下载但长时间未更新的数据块是否应该重新标记为FREE
         self.last_seen: float = last_seen
+        # 提供该块数据的对等方（IP地址:端口号），片段校验失败时用于追查坏数据的来源
+        self.source: str = None
+        # v2种子中块的叶子哈希值（SHA-256），在块到达时计算
+        self.hash: bytes = b''
 
     def __str__(self):
         return "%s - %d - %d - %d" % (self.state, self.block_size, len(self.data), self.last_seen)
\ No newline at end of file
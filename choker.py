@@ -0,0 +1,73 @@
+__author__ = 'alexisgallepe'
+
+import time
+import random
+import logging
+
+# 同时开放的上传名额，其中一个名额留给乐观解除阻塞
+UPLOAD_SLOTS = 4
+# 重新计算阻塞状态的间隔时间（秒）
+CHOKE_INTERVAL = 10
+# 轮换乐观解除阻塞对象的间隔时间（秒）
+OPTIMISTIC_UNCHOKE_INTERVAL = 30
+
+
+# 负责阻塞算法（一报还一报），决定向哪些对等方上传数据
+# 下载时优先为向本客户端上传最快的对等方解除阻塞，做种时优先为接收最快的对等方解除阻塞
+# 另外定期随机选择一个对等方乐观解除阻塞，让新的对等方也有机会证明自己
+class Choker(object):
+    def __init__(self, peers_manager, upload_slots=UPLOAD_SLOTS):
+        self.peers_manager = peers_manager
+        # 上传名额
+        self.upload_slots = upload_slots
+        # 当前被乐观解除阻塞的对等方
+        self.optimistic_peer = None
+        # 上次计算阻塞状态的时间
+        self.last_choke = 0.0
+        # 上次轮换乐观解除阻塞对象的时间
+        self.last_optimistic_unchoke = 0.0
+
+    # 由对等方管理器的循环定期调用，到时间后重新计算阻塞状态
+    def update(self):
+        now = time.time()
+        if now - self.last_choke < CHOKE_INTERVAL:
+            return
+        self.last_choke = now
+        self.rechoke(now)
+
+    # 重新计算所有对等方的阻塞状态，并发送Choke/UnChoke消息
+    def rechoke(self, now):
+        peers = [peer for peer in self.peers_manager.peers if peer.healthy and peer.has_handshaked]
+        # 更新每个对等方在上个周期内的传输速率
+        for peer in peers:
+            peer.update_rates()
+        # 只为对本客户端感兴趣的对等方分配上传名额
+        interested_peers = [peer for peer in peers if peer.is_interested()]
+        # 所有种子共享上传名额，正在做种的种子没有数据可下载，其对等方只能按上传速率排序
+        interested_peers.sort(key=self._get_rate, reverse=True)
+        # 留出一个名额给乐观解除阻塞
+        unchoked_peers = interested_peers[:max(self.upload_slots - 1, 0)]
+        # 乐观解除阻塞的对象已断开、已获得常规名额或到了轮换时间，就重新随机选择
+        if self.optimistic_peer not in peers or self.optimistic_peer in unchoked_peers \
+                or now - self.last_optimistic_unchoke >= OPTIMISTIC_UNCHOKE_INTERVAL:
+            candidates = [peer for peer in interested_peers if peer not in unchoked_peers]
+            self.optimistic_peer = random.choice(candidates) if candidates else None
+            self.last_optimistic_unchoke = now
+            if self.optimistic_peer:
+                logging.debug("Optimistic unchoke - %s" % self.optimistic_peer.ip)
+
+        if self.optimistic_peer and self.upload_slots > 0:
+            unchoked_peers.append(self.optimistic_peer)
+
+        for peer in peers:
+            if peer in unchoked_peers:
+                peer.unchoke()
+            else:
+                peer.choke()
+
+    # 获取用于排序的速率
+    def _get_rate(self, peer):
+        pieces_manager = self.peers_manager.torrents.get(peer.info_hash)
+        if pieces_manager and pieces_manager.all_pieces_completed():
+            return peer.upload_rate
+        return peer.download_rate
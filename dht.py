@@ -0,0 +1,475 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import socket
+import struct
+import hashlib
+import logging
+from threading import Thread
+from bcoding import bencode
+from pubsub import pub
+from torrent_decoder import TorrentDecoder
+
+# 每个桶最多容纳的节点数量，也是每次查找返回的最近节点数量
+K = 8
+# 查找时同时进行的请求数量
+ALPHA = 3
+# 请求超过该时间（秒）没有回应就视为失败
+QUERY_TIMEOUT = 5
+# 节点连续失败该次数后从路由表中移除
+MAX_NODE_FAILURES = 2
+# 每个种子重新查找对等方并宣告的间隔（秒）
+LOOKUP_INTERVAL = 15 * 60
+# 令牌密钥的更换间隔（秒），上一个密钥生成的令牌仍然有效
+TOKEN_INTERVAL = 5 * 60
+# 定期保存路由表的间隔（秒）
+SAVE_INTERVAL = 5 * 60
+# 路由表中的节点少于该数量时重新引导
+MIN_NODES = K
+# 事务ID的长度（字节）
+TRANSACTION_ID_LENGTH = 4
+# 重新引导的最小间隔（秒）
+BOOTSTRAP_INTERVAL = 60
+# 每个种子最多保存的由其他节点宣告的对等方数量
+MAX_STORED_PEERS = 100
+# 每次可读时最多处理的数据包数量，避免阻塞对等方的事件循环
+MAX_PACKETS_PER_READ = 64
+# 路由表的保存路径
+STATE_PATH = 'dht.state'
+# 引导节点，路由表为空时从这些节点开始查找
+BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881)]
+# KRPC消息中的二进制字段，解码时不尝试解码为字符串
+BINARY_KEYS = {'id', 'target', 'info_hash', 'token', 'nodes', 't'}
+
+
+# 将节点信息编码为紧凑格式，每个节点为20字节ID加4字节IP加2字节端口号
+def encode_nodes(nodes):
+    return b''.join(node.id + socket.inet_aton(node.ip) + struct.pack(">H", node.port) for node in nodes)
+
+
+# 从紧凑格式中解码节点信息，返回(ID, IP地址, 端口号)列表
+def decode_nodes(data):
+    nodes = []
+    for offset in range(0, len(data) - 25, 26):
+        node_id = bytes(data[offset:offset + 20])
+        ip = socket.inet_ntoa(data[offset + 20:offset + 24])
+        port, = struct.unpack(">H", data[offset + 24:offset + 26])
+        if port:
+            nodes.append((node_id, ip, port))
+    return nodes
+
+
+# 计算两个ID之间的异或距离
+def distance(a, b):
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+# 能以utf-8解码的字节串会被解码为字符串，需要时转换回字节串
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+# DHT网络中的节点
+class Node(object):
+    def __init__(self, node_id, ip, port):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        # 上次收到该节点消息的时间
+        self.last_seen = time.time()
+        # 连续失败的次数
+        self.failures = 0
+
+
+# Kademlia路由表，按照与本节点ID的共同前缀长度分为160个桶，每个桶最多K个节点
+class RoutingTable(object):
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.buckets = [[] for _ in range(160)]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    # 计算节点所在的桶，即与本节点ID的共同前缀长度
+    def _bucket(self, node_id):
+        return self.buckets[min(160 - distance(self.node_id, node_id).bit_length(), 159)]
+
+    # 增加或更新节点，桶已满时替换失败过的节点，否则忽略新节点，优先保留长期在线的节点
+    def add(self, node_id, ip, port):
+        if len(node_id) != 20 or node_id == self.node_id:
+            return
+        bucket = self._bucket(node_id)
+        for node in bucket:
+            if node.id == node_id:
+                node.ip, node.port = ip, port
+                node.last_seen = time.time()
+                node.failures = 0
+                return
+
+        if len(bucket) >= K:
+            bad_nodes = [node for node in bucket if node.failures > 0]
+            if not bad_nodes:
+                return
+            bucket.remove(bad_nodes[0])
+        bucket.append(Node(node_id, ip, port))
+
+    # 记录节点请求失败，连续失败多次后移除
+    def mark_failed(self, node_id):
+        bucket = self._bucket(node_id)
+        for node in bucket:
+            if node.id == node_id:
+                node.failures += 1
+                if node.failures >= MAX_NODE_FAILURES:
+                    bucket.remove(node)
+                return
+
+    # 获取所有节点
+    def nodes(self):
+        return [node for bucket in self.buckets for node in bucket]
+
+    # 获取与目标ID最近的节点
+    def closest(self, target, count=K):
+        return sorted(self.nodes(), key=lambda node: distance(node.id, target))[:count]
+
+
+# 一次迭代查找，每轮向最近的还没有请求过的节点发送请求，直到最近的K个节点都已回应或失败
+# get_peers查找结束后向回应了令牌的最近节点宣告本客户端
+class Lookup(object):
+    def __init__(self, target, query, nodes):
+        self.target = target
+        # 查找使用的请求，get_peers或find_node
+        self.query = query
+        # 已知的节点，以ID为关键字，值为(IP地址, 端口号)
+        self.candidates = {}
+        # 已请求过的节点ID
+        self.queried = set()
+        # 已回应的节点，以ID为关键字，值为(IP地址, 端口号, 令牌)
+        self.responded = {}
+        # 正在等待回应的请求数量
+        self.in_flight = 0
+        for node_id, ip, port in nodes:
+            self.add_candidate(node_id, ip, port)
+
+    def add_candidate(self, node_id, ip, port):
+        if len(node_id) == 20 and node_id not in self.candidates:
+            self.candidates[node_id] = (ip, port)
+
+    # 最近的K个节点中还没有请求过的节点
+    def next_nodes(self):
+        closest = sorted(self.candidates, key=lambda node_id: distance(node_id, self.target))[:K]
+        return [node_id for node_id in closest if node_id not in self.queried]
+
+    # 是否已经结束
+    def is_done(self):
+        return self.in_flight == 0 and not self.next_nodes()
+
+    # 回应了令牌的最近节点
+    def closest_with_token(self):
+        nodes = [node_id for node_id in self.responded if self.responded[node_id][2]]
+        return sorted(nodes, key=lambda node_id: distance(node_id, self.target))[:K]
+
+
+# Kademlia DHT节点（BEP 5），与对等方管理器共享同一个事件循环
+# 定期为每个种子查找对等方，找到的对等方与tracker返回的对等方一样加入候选列表
+class DHT(object):
+    def __init__(self, peers_manager, port, state_path=STATE_PATH, bootstrap_nodes=None):
+        self.peers_manager = peers_manager
+        # DHT使用的UDP端口号，通常与监听端口相同
+        self.port = port
+        self.state_path = state_path
+        self.bootstrap_nodes = BOOTSTRAP_NODES if bootstrap_nodes is None else bootstrap_nodes
+        # 从保存的路由表恢复本节点ID和已知节点，可以快速引导
+        self.node_id, saved_nodes = self._load_state()
+        self.routing_table = RoutingTable(self.node_id)
+        # 等待回应的请求，以随机的事务ID为关键字，值为(发送时间, 请求名称, 节点ID, 查找, 节点地址)
+        self.transactions = {}
+        # 正在进行的查找，以目标ID为关键字
+        self.lookups = {}
+        # 每个种子上次查找的时间
+        self.last_lookup = {}
+        # 其他节点宣告的对等方，以种子哈希值为关键字
+        self.peer_store = {}
+        # 生成令牌的密钥
+        self.token_secret = os.urandom(16)
+        self.previous_token_secret = self.token_secret
+        self.last_token_rotation = time.time()
+        self.last_save = time.time()
+        self.last_bootstrap = 0.0
+        # 解析完成的引导节点地址，解析在后台线程中进行
+        self.resolved_bootstrap_nodes = []
+        # 与uTP共享UDP端口时，不是KRPC消息的数据包交给该函数处理
+        self.other_packet_handler = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', port))
+        self.socket.setblocking(False)
+
+        Thread(target=self._resolve_bootstrap_nodes, daemon=True).start()
+        # 向保存的节点发送请求，回应的节点会加入路由表
+        if saved_nodes:
+            self._start_lookup(self.node_id, 'find_node', saved_nodes)
+
+        # events
+        # 订阅事件，对等方通过PORT消息告知的DHT节点
+        pub.subscribe(self.add_node_address, 'DHT.AddNode')
+
+    # 向对等方告知的DHT节点发送ping请求，回应后加入路由表
+    def add_node_address(self, ip, port):
+        self._send_query((ip, port), 'ping', {})
+
+    # 需要事件循环监听的套接字
+    def sockets(self):
+        return [self.socket]
+
+    # 事件循环等待的最长时间（秒）
+    def timeout(self):
+        return 1
+
+    # 套接字可读时由对等方管理器调用
+    def handle_readable(self, sock):
+        for _ in range(MAX_PACKETS_PER_READ):
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug("DHT recv failed : %s" % e.__str__())
+                return
+            # KRPC消息是bencode编码的字典，以字符d开头
+            if data[:1] != b'd':
+                if self.other_packet_handler:
+                    self.other_packet_handler(data, address)
+                continue
+            try:
+                self._handle_packet(data, address)
+            except Exception as e:
+                logging.debug("Invalid DHT packet from %s : %s" % (address[0], e.__str__()))
+
+    # 由对等方管理器在每次事件循环中调用
+    def update(self):
+        now = time.time()
+        self._expire_transactions(now)
+
+        if now - self.last_token_rotation >= TOKEN_INTERVAL:
+            self.previous_token_secret = self.token_secret
+            self.token_secret = os.urandom(16)
+            self.last_token_rotation = now
+
+        if len(self.routing_table) < MIN_NODES and now - self.last_bootstrap >= BOOTSTRAP_INTERVAL \
+                and self.resolved_bootstrap_nodes:
+            self.last_bootstrap = now
+            self._start_lookup(self.node_id, 'find_node',
+                               [(os.urandom(20), ip, port) for ip, port in self.resolved_bootstrap_nodes])
+
+        # 定期为每个种子查找对等方，路由表为空时等待引导完成
+        if len(self.routing_table) > 0:
+            for info_hash in list(self.peers_manager.torrents):
+                if now - self.last_lookup.get(info_hash, 0) >= LOOKUP_INTERVAL and info_hash not in self.lookups:
+                    self.last_lookup[info_hash] = now
+                    self.get_peers(info_hash)
+
+        for lookup in list(self.lookups.values()):
+            self._advance_lookup(lookup)
+
+        if now - self.last_save >= SAVE_INTERVAL:
+            self.last_save = now
+            self.save_state()
+
+    # 查找种子的对等方，结束后宣告本客户端
+    def get_peers(self, info_hash):
+        nodes = [(node.id, node.ip, node.port) for node in self.routing_table.closest(info_hash)]
+        self._start_lookup(info_hash, 'get_peers', nodes)
+
+    # 退出前保存路由表，套接字仍由事件循环使用，不在此关闭
+    def close(self):
+        self.save_state()
+
+    # 保存本节点ID和路由表中的节点
+    def save_state(self):
+        temp_path = self.state_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(bencode({'id': self.node_id, 'nodes': encode_nodes(self.routing_table.nodes())}))
+            os.replace(temp_path, self.state_path)
+        except Exception:
+            logging.exception("Can't save DHT state")
+
+    # 加载保存的本节点ID和节点，不存在时生成新的ID
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'rb') as f:
+                contents = TorrentDecoder(f.read(), BINARY_KEYS).decode()
+            node_id = bytes(contents['id'])
+            if len(node_id) == 20:
+                return node_id, decode_nodes(bytes(contents.get('nodes', b'')))
+        except FileNotFoundError:
+            pass
+        except Exception:
+            logging.exception("Can't load DHT state")
+        return os.urandom(20), []
+
+    # 在后台线程中解析引导节点的域名，避免阻塞事件循环
+    def _resolve_bootstrap_nodes(self):
+        for host, port in self.bootstrap_nodes:
+            try:
+                self.resolved_bootstrap_nodes.append((socket.gethostbyname(host), port))
+            except OSError as e:
+                logging.debug("Can't resolve DHT bootstrap node %s : %s" % (host, e.__str__()))
+
+    def _start_lookup(self, target, query, nodes):
+        if target in self.lookups:
+            return
+        self.lookups[target] = Lookup(target, query, nodes)
+
+    # 向最近的还没有请求过的节点发送请求，查找结束后宣告
+    def _advance_lookup(self, lookup):
+        for node_id in lookup.next_nodes():
+            if lookup.in_flight >= ALPHA:
+                break
+            lookup.queried.add(node_id)
+            args = {'info_hash': lookup.target} if lookup.query == 'get_peers' else {'target': lookup.target}
+            if self._send_query(lookup.candidates[node_id], lookup.query, args, node_id, lookup):
+                lookup.in_flight += 1
+
+        if not lookup.is_done():
+            return
+        del self.lookups[lookup.target]
+        if lookup.query == 'get_peers':
+            self._announce(lookup)
+
+    # 向回应了令牌的最近节点宣告本客户端正在分享该种子
+    def _announce(self, lookup):
+        for node_id in lookup.closest_with_token():
+            ip, port, token = lookup.responded[node_id]
+            args = {'info_hash': lookup.target, 'port': self.peers_manager.listen_port, 'token': token,
+                    'implied_port': 0}
+            self._send_query((ip, port), 'announce_peer', args, node_id)
+
+    # 移除超时的请求，并记录节点失败
+    def _expire_transactions(self, now):
+        for transaction_id, (sent_at, _, node_id, lookup, _) in list(self.transactions.items()):
+            if now - sent_at < QUERY_TIMEOUT:
+                continue
+            del self.transactions[transaction_id]
+            if node_id:
+                self.routing_table.mark_failed(node_id)
+            if lookup:
+                lookup.in_flight -= 1
+
+    def _send(self, contents, address):
+        try:
+            self.socket.sendto(bencode(contents), address)
+            return True
+        except OSError as e:
+            logging.debug("DHT send to %s failed : %s" % (address[0], e.__str__()))
+            return False
+
+    # 事务ID是随机的，其他人无法猜测正在等待回应的请求并伪造回应
+    def _send_query(self, address, query, args, node_id=None, lookup=None):
+        transaction_id = os.urandom(TRANSACTION_ID_LENGTH)
+        while transaction_id in self.transactions:
+            transaction_id = os.urandom(TRANSACTION_ID_LENGTH)
+        args = dict(args, id=self.node_id)
+        if not self._send({'t': transaction_id, 'y': 'q', 'q': query, 'a': args}, address):
+            return False
+        self.transactions[transaction_id] = (time.time(), query, node_id, lookup, tuple(address))
+        return True
+
+    # 令牌由密钥和请求方的IP地址计算得到，宣告时用于确认请求方确实查询过本节点
+    def _make_token(self, ip, secret=None):
+        return hashlib.sha1((secret or self.token_secret) + socket.inet_aton(ip)).digest()[:8]
+
+    def _is_valid_token(self, token, ip):
+        return token in (self._make_token(ip), self._make_token(ip, self.previous_token_secret))
+
+    def _handle_packet(self, data, address):
+        contents = TorrentDecoder(data, BINARY_KEYS).decode()
+        message_type = contents.get('y')
+        if message_type == 'q':
+            self._handle_query(contents, address)
+        elif message_type in ('r', 'e'):
+            self._handle_response(contents, address, message_type == 'r')
+
+    # 处理其他节点的请求
+    def _handle_query(self, contents, address):
+        ip, port = address
+        query, args = contents['q'], contents['a']
+        node_id = to_bytes(args['id'])
+        response = {'id': self.node_id}
+
+        if query == 'ping':
+            pass
+        elif query == 'find_node':
+            response['nodes'] = encode_nodes(self.routing_table.closest(to_bytes(args['target'])))
+        elif query == 'get_peers':
+            info_hash = to_bytes(args['info_hash'])
+            response['token'] = self._make_token(ip)
+            peers = self.peer_store.get(info_hash)
+            if peers:
+                response['values'] = [socket.inet_aton(peer_ip) + struct.pack(">H", peer_port)
+                                      for peer_ip, peer_port in peers]
+            else:
+                response['nodes'] = encode_nodes(self.routing_table.closest(info_hash))
+        elif query == 'announce_peer':
+            if not self._is_valid_token(to_bytes(args['token']), ip):
+                self._send({'t': contents['t'], 'y': 'e', 'e': [203, 'Bad token']}, address)
+                return
+            announced_port = port if args.get('implied_port') else args['port']
+            peers = self.peer_store.setdefault(to_bytes(args['info_hash']), [])
+            if (ip, announced_port) not in peers:
+                peers.append((ip, announced_port))
+                del peers[:-MAX_STORED_PEERS]
+        else:
+            self._send({'t': contents['t'], 'y': 'e', 'e': [204, 'Method Unknown']}, address)
+            return
+
+        self.routing_table.add(node_id, ip, port)
+        self._send({'t': contents['t'], 'y': 'r', 'r': response}, address)
+
+    # 处理其他节点对本节点请求的回应，只接受来自请求发往的地址的回应
+    def _handle_response(self, contents, address, success):
+        transaction_id = to_bytes(contents.get('t', b''))
+        transaction = self.transactions.get(transaction_id)
+        if not transaction or transaction[4] != tuple(address):
+            return
+        del self.transactions[transaction_id]
+        _, query, expected_id, lookup, _ = transaction
+        if lookup:
+            lookup.in_flight -= 1
+        if not success:
+            if expected_id:
+                self.routing_table.mark_failed(expected_id)
+            return
+
+        response = contents['r']
+        node_id = to_bytes(response['id'])
+        self.routing_table.add(node_id, address[0], address[1])
+        nodes = decode_nodes(bytes(response.get('nodes', b'')))
+        if not lookup:
+            return
+
+        for new_id, ip, port in nodes:
+            lookup.add_candidate(new_id, ip, port)
+        # 引导时使用的是临时ID，用节点真正的ID替换
+        if expected_id and expected_id != node_id:
+            lookup.candidates.pop(expected_id, None)
+            lookup.candidates[node_id] = address
+            lookup.queried.add(node_id)
+        lookup.responded[node_id] = (address[0], address[1], to_bytes(response.get('token', b'')))
+
+        if query == 'get_peers' and response.get('values'):
+            peers = []
+            for value in response['values']:
+                value = to_bytes(value)
+                if len(value) == 6:
+                    port, = struct.unpack(">H", value[4:])
+                    ip = socket.inet_ntoa(value[:4])
+                    # 忽略已封禁的地址和本客户端自己宣告的地址
+                    if not self.peers_manager.is_banned(ip) and not self.peers_manager.is_own_address(ip, port):
+                        peers.append((ip, port))
+            logging.debug("Got %d peer(s) from DHT node %s" % (len(peers), address[0]))
+            self.peers_manager.add_candidates(lookup.target, peers)
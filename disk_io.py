@@ -0,0 +1,28 @@
+__author__ = 'alexisgallepe'
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# 磁盘读写线程数量
+DISK_IO_WORKERS = 4
+
+
+# 磁盘读写线程池，所有种子共享，避免磁盘写入阻塞网络线程
+class DiskIO(object):
+    def __init__(self, workers=DISK_IO_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='DiskIO')
+
+    # 提交磁盘任务，任务中的异常会被记录下来，而不是静默丢弃
+    def submit(self, task, *args):
+        return self.executor.submit(self._run, task, *args)
+
+    @staticmethod
+    def _run(task, *args):
+        try:
+            return task(*args)
+        except Exception:
+            logging.exception("Disk task failed")
+
+    # 等待所有任务完成后关闭线程池
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,218 @@
+__author__ = 'alexisgallepe'
+
+import time
+import logging
+from threading import Thread, Event
+from block import State
+import pieces_manager
+import piece_picker
+import file_table
+import tracker
+import resume
+import recheck
+import request_timer
+import web_seed
+import stream
+import message
+import peer as peer_module
+
+
+# 负责单个种子的下载：向trackers获取对等方，向对等方请求缺少的块，并定期保存恢复数据
+# 对等方连接、监听端口和磁盘读写线程池由会话中的所有种子共享，见session.Session
+class Download(object):
+    def __init__(self, new_torrent, peers_manager, disk, allocation=file_table.Allocation.SPARSE, budget=None,
+                 file_priorities=None, cache=None, super_seed=False):
+        self.percentage_completed = -1
+        self.last_log_line = ""
+        # 初始化
+        # 已经解析的种子，见torrent.Torrent
+        self.torrent = new_torrent
+        self.peers_manager = peers_manager
+        self.tracker = tracker.Tracker(self.torrent, peers_manager.listen_port)
+        # 文件的优先级需要在加载恢复数据、重新校验和预分配之前设置，不下载的文件不会被创建
+        self.pieces_manager = pieces_manager.PiecesManager(self.torrent, disk, budget, file_priorities, cache)
+
+        # 加载快速恢复数据，跳过已下载的片段
+        self.resume_data = resume.ResumeData(self.torrent, self.pieces_manager)
+        # 恢复数据不存在或已过期时需要重新校验本地已有的数据
+        # 没有指定文件优先级时沿用上次保存的优先级
+        needs_recheck = not self.resume_data.load(restore_priorities=file_priorities is None)
+        # 提前检查剩余空间，空间不足时不开始下载
+        self.pieces_manager.file_table.check_free_space()
+        # 上次保存恢复数据的时间
+        self.last_resume_save = time.time()
+        # 片段选择器，决定请求片段的顺序
+        self.piece_picker = piece_picker.PiecePicker(self.pieces_manager)
+        # 挂起请求的截止时间堆
+        self.request_timer = request_timer.RequestTimer()
+        # 种子中列出的网络种子，与对等方同时下载
+        self.web_seeds = [web_seed.WebSeed(url, self.torrent, self.pieces_manager) for url in self.torrent.url_list]
+        # 是否已经提示过下载完成
+        self.is_completed = False
+        # 重新校验是否已经完成，完成前不请求数据块、不保存恢复数据，也不接受该种子的对等方
+        self.checked = Event()
+
+        # 在后台线程中重新校验和预分配文件，避免阻塞会话循环中的其他种子
+        Thread(target=self._prepare, args=(needs_recheck, allocation, super_seed), daemon=True).start()
+        logging.info("PiecesManager Started")
+
+    # 重新校验本地已有的数据（需要时），之后开始接受该种子的对等方，并预分配文件
+    def _prepare(self, needs_recheck, allocation, super_seed):
+        if needs_recheck:
+            recheck.Recheck(self.torrent, self.pieces_manager).run()
+        self.is_completed = self.pieces_manager.all_pieces_completed()
+        self.peers_manager.add_torrent(self.torrent, self.pieces_manager)
+        # 作为初始做种者时超级做种，见super_seed.SuperSeeder
+        self.peers_manager.set_super_seeding(self.torrent.info_hash, super_seed)
+        self.checked.set()
+        self.pieces_manager.file_table.allocate(allocation)
+
+    # 在后台线程中从trackers服务器获取对等方，避免阻塞其他种子
+    def start(self):
+        Thread(target=self._get_peers, daemon=True).start()
+
+    def _get_peers(self):
+        # 重新校验完成后才能告知对等方拥有的片段
+        self.checked.wait()
+        # 从trackers服务器获取对等方
+        peers_dict = self.tracker.get_peers_from_trackers()
+        # BUG: 此处应该删去，见tracker.Tracker.try_peer_connect
+        self.peers_manager.add_peers(peers_dict.values())
+        # 其余未连接的对等方作为候选，在连接数不足或淘汰慢速对等方后再连接
+        self.peers_manager.add_candidates(self.torrent.info_hash,
+                                          [(s.ip, s.port) for s in self.tracker.dict_sock_addr.values()])
+
+    # 由会话循环调用，遍历一次所有片段并向对等方请求所缺块
+    def update(self):
+        # 重新校验完成前片段状态还不确定
+        if not self.checked.is_set():
+            return
+        # 定期保存恢复数据
+        if time.time() - self.last_resume_save > resume.RESUME_SAVE_INTERVAL:
+            self.resume_data.save()
+            self.last_resume_save = time.time()
+
+        if self.pieces_manager.all_pieces_completed():
+            if not self.is_completed:
+                self.is_completed = True
+                logging.info("File(s) downloaded successfully.")
+                self.display_progression()
+            return
+        # 将超时的请求交还给调度器重新请求
+        self._expire_requests()
+        # 网络种子不依赖对等方，先从网络种子请求还没有开始下载的片段
+        for seed in self.web_seeds:
+            seed.update(self.piece_picker.pick_order())
+        # 如果没有被阻塞的对等方，也没有允许快速请求的对等方，就等待下次循环，直到找到对等方
+        if not self.peers_manager.has_unchoked_peers(self.torrent.info_hash) \
+                and not self.peers_manager.has_allowed_fast_peers(self.torrent.info_hash):
+            return
+        # 内存预算用完时，只继续下载已经开始的片段，不再开始新的片段，直到缓冲区被释放
+        budget_exhausted = self.pieces_manager.memory_budget.is_exhausted()
+        # 按照片段选择器给出的顺序遍历所有未下载的片段
+        for index in self.piece_picker.pick_order():
+            piece = self.pieces_manager.pieces[index]
+            if budget_exhausted and not piece.is_started():
+                continue
+            # 如果片段没有被下载，就随机选取一个拥有该片段的对等方
+            # 片段校验失败过时，优先从其他对等方重新下载
+            peer = self.peers_manager.get_random_peer_having_piece(self.torrent.info_hash, index,
+                                                                   piece.excluded_sources)
+            # 如果没有任何对等方拥有该片段，就继续循环等待
+            if not peer:
+                continue
+            # 获取片段首个还没有开始下载的块，将其状态置为正在下载，并返回块的信息，包括块的偏移量
+            data = self.pieces_manager.pieces[index].get_empty_block()
+            # 如果没有任何块还没有开始下载，或所有块都下载完毕，就跳过此片段
+            if not data:
+                continue
+
+            # v2种子先向对等方请求该片段的叶子哈希值，之后到达的块可以立即校验
+            self._request_block_hashes(piece, peer)
+
+            piece_index, block_offset, block_length = data
+            # 向对等方请求所缺块，之后的下载和存储在的步骤在其他代码处实现
+            requested_at = peer.request_block(piece_index, block_offset, block_length)
+            # 按照该对等方的往返时间和速率记录请求的截止时间
+            self.request_timer.add(peer, (piece_index, block_offset), requested_at, peer.request_timeout())
+        # 显示进度
+        self.display_progression()
+
+    # 向支持v2的对等方请求片段的叶子哈希值，未收到回应时超时后再请求
+    def _request_block_hashes(self, piece, peer):
+        tree = piece.tree
+        if not tree or not tree.needs_block_hashes() or not peer.supports_v2:
+            return
+        now = time.time()
+        if now - tree.hashes_requested < peer_module.REQUEST_TIMEOUT:
+            return
+        tree.hashes_requested = now
+        request = message.HashRequest(tree.pieces_root, 0, tree.first_leaf, tree.leaf_count, 0)
+        peer.send_to_peer(request.to_bytes())
+
+    # 处理超时的请求：降低对等方评分，并将数据块重置为未下载
+    def _expire_requests(self):
+        for peer, key, requested_at in self.request_timer.pop_expired():
+            if not peer.expire_request(key, requested_at):
+                continue
+            piece_index, block_offset = key
+            self.pieces_manager.pieces[piece_index].free_block(block_offset)
+
+    def display_progression(self):
+        new_progression = 0
+        # 只统计需要下载的片段
+        wanted_length = 0
+
+        for i in range(self.pieces_manager.number_of_pieces):
+            if not self.pieces_manager.is_wanted(i):
+                continue
+            wanted_length += self.pieces_manager.pieces[i].piece_size
+            # 下载完的片段会清空数据，所以只能通过block_size获取块大小
+            for j in range(self.pieces_manager.pieces[i].number_of_blocks):
+                # 加和每个片段中的每个下载完成的块的长度
+                if self.pieces_manager.pieces[i].blocks[j].state == State.FULL:
+                    new_progression += self.pieces_manager.pieces[i].blocks[j].block_size
+
+        if new_progression == self.percentage_completed:
+            return
+
+        number_of_peers = self.peers_manager.unchoked_peers_count(self.torrent.info_hash)
+        # 计算进度的百分比
+        percentage_completed = float((float(new_progression) / wanted_length) * 100) if wanted_length else 100.0
+
+        current_log_line = "{} - Connected peers: {} - {}% completed | {}/{} pieces".format(
+            self.torrent.torrent_file['info']['name'],
+            number_of_peers,
+            round(percentage_completed, 2),
+            self.pieces_manager.completed_wanted_pieces(),
+            self.pieces_manager.wanted_pieces()
+        )
+        # 如果进度有变动就打印
+        if current_log_line != self.last_log_line:
+            print(current_log_line)
+
+        self.last_log_line = current_log_line
+        self.percentage_completed = new_progression
+
+    # 设置文件的优先级，file可以是文件序号或路径，不下载的文件改为下载后需要重新开始下载
+    def set_file_priority(self, file, priority):
+        self.pieces_manager.set_file_priority(self._file_index(file), priority)
+        self.is_completed = self.pieces_manager.all_pieces_completed()
+
+    def _file_index(self, file):
+        return file if isinstance(file, int) else self.pieces_manager.file_table.paths.index(file)
+
+    # 打开种子中的一个文件进行流式读取，file可以是文件序号或路径
+    # 读取位置之后的片段会被优先下载，asynchronous为True时返回异步读取对象
+    def open_stream(self, file, asynchronous=False, readahead=stream.READAHEAD_SIZE, timeout=None):
+        file_index = self._file_index(file)
+        # 流式读取不下载的文件时，改为下载该文件
+        if self.pieces_manager.file_table.priorities[file_index] == file_table.Priority.SKIP:
+            self.set_file_priority(file_index, file_table.Priority.NORMAL)
+        file_stream = stream.FileStream(self, file_index, readahead, timeout)
+        return stream.AsyncFileStream(file_stream) if asynchronous else file_stream
+
+    # 停止下载前保存恢复数据，重新校验还没有完成时不保存，以免记录不完整的bitfield
+    def close(self):
+        if self.checked.is_set():
+            self.resume_data.save()
@@ -0,0 +1,64 @@
+__author__ = 'alexisgallepe'
+
+import socket
+import struct
+from bcoding import bencode
+from torrent_decoder import TorrentDecoder
+
+# 扩展握手消息的扩展消息编号（BEP 10）
+EXTENDED_HANDSHAKE_ID = 0
+# 本客户端为ut_pex（BEP 11）分配的扩展消息编号，在扩展握手中告知对等方
+UT_PEX_ID = 1
+# 本客户端支持的扩展，以扩展名称为关键字，值为本客户端分配的扩展消息编号
+SUPPORTED_EXTENSIONS = {'ut_pex': UT_PEX_ID}
+# 扩展握手中告知对等方的客户端名称
+CLIENT_VERSION = 'PyTorrent'
+
+# 向同一个对等方发送PEX消息的间隔（秒），BEP 11要求不超过每分钟一次
+PEX_INTERVAL = 60
+# 接收同一个对等方PEX消息的最小间隔（秒），更频繁的消息会被忽略
+PEX_MIN_RECEIVE_INTERVAL = 45
+# 每条PEX消息最多包含的新增对等方数量，收到的消息中超出的部分会被忽略
+MAX_PEX_PEERS = 50
+# PEX消息中的二进制字段，解码时不尝试解码为字符串
+PEX_BINARY_KEYS = {'added', 'added.f', 'added6', 'added6.f', 'dropped', 'dropped6'}
+
+
+# 生成扩展握手消息的内容，告知对等方本客户端支持的扩展和监听端口
+def make_handshake(listen_port):
+    return bencode({'m': SUPPORTED_EXTENSIONS, 'p': listen_port, 'v': CLIENT_VERSION})
+
+
+# 解码扩展消息的内容，扩展消息都是bencode格式的字典
+def decode(payload, binary_keys=frozenset()):
+    contents = TorrentDecoder(payload, binary_keys).decode()
+    if not isinstance(contents, dict):
+        raise ValueError("Extended message should be a dictionary")
+    return contents
+
+
+# 生成PEX消息的内容，只包含IPv4地址，每个地址为4字节IP加2字节端口号
+def make_pex(added, dropped):
+    return bencode({'added': encode_peers(added), 'added.f': b'\x00' * len(added), 'dropped': encode_peers(dropped)})
+
+
+# 解析PEX消息中新增的IPv4对等方地址
+def parse_pex(payload):
+    contents = decode(payload, PEX_BINARY_KEYS)
+    return decode_peers(bytes(contents.get('added', b''))), decode_peers(bytes(contents.get('dropped', b'')))
+
+
+# 将对等方地址编码为紧凑格式
+def encode_peers(sock_addrs):
+    return b''.join(socket.inet_aton(ip) + struct.pack(">H", port) for ip, port in sock_addrs)
+
+
+# 从紧凑格式中解码对等方地址，端口号为0的地址会被忽略
+def decode_peers(data):
+    sock_addrs = []
+    for offset in range(0, len(data) - 5, 6):
+        ip = socket.inet_ntoa(data[offset:offset + 4])
+        port, = struct.unpack(">H", data[offset + 4:offset + 6])
+        if port:
+            sock_addrs.append((ip, port))
+    return sock_addrs
@@ -0,0 +1,193 @@
+__author__ = 'alexisgallepe'
+
+import os
+import errno
+import shutil
+import logging
+from enum import Enum, IntEnum
+from array import array
+from bisect import bisect_right
+
+
+# 文件的分配方式
+class Allocation(Enum):
+    # 不预先分配，文件在第一次写入时才创建
+    NONE = 'none'
+    # 创建稀疏文件，直接将文件长度设置为最终大小
+    SPARSE = 'sparse'
+    # 预先分配全部磁盘空间，减少乱序写入造成的碎片，也避免下载到一半时空间不足
+    FULL = 'full'
+
+
+# 文件的优先级，决定文件中的片段是否下载以及下载的先后
+class Priority(IntEnum):
+    # 不下载，文件不会被创建，与其他文件共享的边界片段中属于该文件的数据保存在部分文件中
+    SKIP = 0
+    NORMAL = 1
+    # 先于普通优先级的文件下载
+    HIGH = 2
+
+
+# 紧凑的文件段表，用于将片段和字节范围映射到文件
+# 种子中的所有文件首尾相连组成一段连续的数据，只需记录每个文件的起始偏移量和长度，
+# 查找时用二分查找定位文件，无需为每个片段和文件的交集保存一个字典
+class FileTable(object):
+    def __init__(self, file_names, piece_length, part_path=None):
+        # 每个片段的长度
+        self.piece_length = piece_length
+        # 文件路径
+        self.paths = [f["path"] for f in file_names]
+        # 每个文件的长度
+        self.lengths = array('q', (f["length"] for f in file_names))
+        # 是否为填充，v2种子的文件之间用填充对齐到片段边界，填充不会在磁盘上创建，也不会被读写
+        self.pads = [f.get("pad", False) for f in file_names]
+        # 每个文件在整个种子数据中的起始偏移量，升序排列
+        self.offsets = array('q')
+        total_length = 0
+        for length in self.lengths:
+            self.offsets.append(total_length)
+            total_length += length
+        # 种子总大小
+        self.total_length = total_length
+        # 已经创建过的目录，避免重复检查
+        self.created_dirs = set()
+        # 每个文件的优先级
+        self.priorities = [Priority.NORMAL] * len(self.paths)
+        # 部分文件，保存不下载的文件在边界片段中的数据，按照在整个种子数据中的偏移量存放，是一个稀疏文件
+        self.part_path = part_path
+        # 数据保存在部分文件中的文件编号
+        self.part_files = set()
+
+    def __len__(self):
+        return len(self.paths)
+
+    # 查找包含该偏移量的文件编号，长度为0的文件会被跳过
+    def find_file(self, offset):
+        return bisect_right(self.offsets, offset) - 1
+
+    # 将一段字节范围映射到文件，依次返回(文件编号, 文件中的偏移量, 长度, 在该字节范围中的偏移量)
+    def segments(self, offset, length):
+        end = min(offset + length, self.total_length)
+        file_index = self.find_file(offset)
+        position = offset
+
+        while position < end:
+            file_start = self.offsets[file_index]
+            file_end = file_start + self.lengths[file_index]
+            if file_end > position:
+                segment_length = min(file_end, end) - position
+                yield file_index, position - file_start, segment_length, position - offset
+                position += segment_length
+            file_index += 1
+
+    # 获取片段所包含的文件段
+    def piece_segments(self, piece_index, piece_size):
+        return self.segments(piece_index * self.piece_length, piece_size)
+
+    # 获取与该文件有交集的片段编号范围
+    def file_pieces(self, file_index):
+        start = self.offsets[file_index]
+        length = self.lengths[file_index]
+        if length == 0:
+            return range(0)
+        return range(start // self.piece_length, (start + length - 1) // self.piece_length + 1)
+
+    # 文件是否需要下载，填充和长度为0的文件不需要
+    def is_wanted(self, file_index):
+        return self.priorities[file_index] > Priority.SKIP and not self.pads[file_index] \
+            and self.lengths[file_index] > 0
+
+    # 设置文件的优先级，返回数据是否需要从部分文件移回原文件
+    # 还没有创建的文件在不下载时改为使用部分文件；已经写入过数据的文件保持不变，避免丢失已下载的数据
+    def set_priority(self, file_index, priority):
+        self.priorities[file_index] = Priority(priority)
+        if self.priorities[file_index] == Priority.SKIP:
+            if self.part_path and not self.pads[file_index] and not os.path.exists(self.paths[file_index]):
+                self.part_files.add(file_index)
+            return False
+        if file_index in self.part_files:
+            self.part_files.discard(file_index)
+            return True
+        return False
+
+    # 获取文件段实际存放的位置，返回(路径, 偏移量)
+    def locate(self, file_index, file_offset):
+        if file_index in self.part_files:
+            return self.part_path, self.offsets[file_index] + file_offset
+        return self.paths[file_index], file_offset
+
+    # 创建文件的父目录，每个目录只检查并创建一次
+    def _make_dirs(self, path_file):
+        dir_name = os.path.dirname(path_file)
+        if dir_name and dir_name not in self.created_dirs:
+            os.makedirs(dir_name, exist_ok=True)
+            self.created_dirs.add(dir_name)
+
+    # 打开文件用于写入，文件和父目录都在第一次写入时才创建
+    def open_for_writing(self, path_file):
+        self._make_dirs(path_file)
+        # 以读写方式打开，文件不存在时创建，但不会清空已有内容
+        # 这样即使多个磁盘线程同时写入同一个新文件，或者与预分配同时进行，也不会覆盖彼此的数据
+        # seek移动光标时，若光标超过当前文件长度，会在中间填充空比特，当光标在文件长度内，则会覆盖写入
+        # 这样即使片段写入的顺序不一样，也不会出现最终顺序乱的情况
+        return os.fdopen(os.open(path_file, os.O_RDWR | os.O_CREAT, 0o666), 'r+b')
+
+    # 计算还需要的磁盘空间，即每个文件最终大小与已占用的磁盘空间之差，稀疏文件按实际占用计算
+    def required_space(self):
+        required = 0
+        for file_index, (path_file, length) in enumerate(zip(self.paths, self.lengths)):
+            if not self.is_wanted(file_index):
+                continue
+            try:
+                stat = os.stat(path_file)
+                allocated = stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+                required += max(length - allocated, 0)
+            except OSError:
+                required += length
+        return required
+
+    # 检查剩余空间是否足够下载所有需要的文件，不足时抛出异常
+    def check_free_space(self):
+        # 目录可能还没有创建，向上查找第一个存在的目录
+        directory = os.path.abspath(os.path.dirname(self.paths[0]) or '.')
+        while not os.path.isdir(directory):
+            directory = os.path.dirname(directory)
+
+        free = shutil.disk_usage(directory).free
+        required = self.required_space()
+        if required > free:
+            raise OSError(errno.ENOSPC, "Not enough free space: %d bytes required, %d available" % (required, free))
+
+    # 按照分配方式创建所有需要下载的文件，在后台线程中运行
+    def allocate(self, allocation):
+        if allocation == Allocation.NONE:
+            return
+
+        for file_index, path_file in enumerate(self.paths):
+            if self.pads[file_index] or self.priorities[file_index] == Priority.SKIP:
+                continue
+            length = self.lengths[file_index]
+            try:
+                f = self.open_for_writing(path_file)
+            except Exception:
+                logging.exception("Can't allocate file %s" % path_file)
+                continue
+
+            try:
+                # 只扩展文件，不会截断已下载的数据
+                if allocation == Allocation.FULL and hasattr(os, 'posix_fallocate') and length > 0:
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, length)
+                    except OSError as e:
+                        # 文件系统不支持时退化为稀疏文件
+                        if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                            raise
+                        allocation = Allocation.SPARSE
+                if os.fstat(f.fileno()).st_size < length:
+                    os.ftruncate(f.fileno(), length)
+            except OSError:
+                logging.exception("Can't allocate file %s" % path_file)
+            finally:
+                f.close()
+
+        logging.info("%d file(s) allocated (%s)" % (len(self.paths), allocation.value))
@@ -0,0 +1,138 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import socket
+import struct
+import logging
+import ipaddress
+
+# 本地服务发现使用的组播地址和端口（BEP 14）
+LSD_GROUP = '239.192.152.143'
+LSD_PORT = 6771
+# 每个种子重新宣告的间隔（秒）
+LSD_INTERVAL = 5 * 60
+# 同一个种子两次宣告之间的最小间隔（秒），收到其他客户端宣告的种子时会提前宣告
+LSD_MIN_INTERVAL = 60
+# 组播数据包的生存时间，只在局域网内传播
+LSD_TTL = 1
+# 每次可读时最多处理的数据包数量，避免阻塞对等方的事件循环
+MAX_PACKETS_PER_READ = 64
+
+
+# 判断IP地址是否位于局域网，包括私有地址、链路本地地址和回环地址
+def is_lan_address(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return address.is_private or address.is_link_local or address.is_loopback
+
+
+# 生成宣告消息，cookie用于识别本客户端自己发出的消息
+def make_announce(listen_port, info_hash, cookie):
+    return ("BT-SEARCH * HTTP/1.1\r\n"
+            "Host: %s:%d\r\n"
+            "Port: %d\r\n"
+            "Infohash: %s\r\n"
+            "cookie: %s\r\n"
+            "\r\n\r\n" % (LSD_GROUP, LSD_PORT, listen_port, info_hash.hex(), cookie)).encode()
+
+
+# 解析宣告消息，返回(端口号, 种子哈希值列表, cookie)，格式错误时返回None
+def parse_announce(data):
+    lines = data.decode('ascii', 'replace').split('\r\n')
+    if not lines[0].startswith('BT-SEARCH * HTTP/1.'):
+        return None
+
+    port, info_hashes, cookie = None, [], None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name, value = name.strip().lower(), value.strip()
+        try:
+            if name == 'port':
+                port = int(value)
+            elif name == 'infohash':
+                info_hash = bytes.fromhex(value)
+                if len(info_hash) == 20:
+                    info_hashes.append(info_hash)
+            elif name == 'cookie':
+                cookie = value
+        except ValueError:
+            return None
+
+    if not port or not 0 < port < 65536 or not info_hashes:
+        return None
+    return port, info_hashes, cookie
+
+
+# 本地服务发现（BEP 14），在局域网内组播宣告正在分享的种子，并监听其他客户端的宣告
+# 与对等方管理器共享事件循环，发现的局域网对等方优先加入候选列表
+class LSD(object):
+    def __init__(self, peers_manager, group=LSD_GROUP, port=LSD_PORT):
+        self.peers_manager = peers_manager
+        self.address = (group, port)
+        # 用于识别本客户端自己发出的宣告
+        self.cookie = os.urandom(8).hex()
+        # 每个种子上次宣告的时间
+        self.last_announce = {}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # 同一台机器上可能运行多个客户端，需要共享组播端口
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(('', port))
+        membership = struct.pack("4sl", socket.inet_aton(group), socket.INADDR_ANY)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, LSD_TTL)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.socket.setblocking(False)
+
+    # 需要事件循环监听的套接字
+    def sockets(self):
+        return [self.socket]
+
+    # 事件循环等待的最长时间（秒）
+    def timeout(self):
+        return 1
+
+    # 套接字可读时由对等方管理器调用
+    def handle_readable(self, sock):
+        for _ in range(MAX_PACKETS_PER_READ):
+            try:
+                data, (ip, _) = self.socket.recvfrom(1400)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug("LSD recv failed : %s" % e.__str__())
+                return
+
+            announce = parse_announce(data)
+            if not announce:
+                continue
+            port, info_hashes, cookie = announce
+            if cookie == self.cookie or self.peers_manager.is_banned(ip):
+                continue
+            for info_hash in info_hashes:
+                if info_hash in self.peers_manager.torrents:
+                    logging.debug("Found LAN peer %s:%d with LSD" % (ip, port))
+                    self.peers_manager.add_candidates(info_hash, [(ip, port)], from_lsd=True)
+                    # 对方可能刚启动，尽快宣告让对方也能发现本客户端
+                    self._announce(info_hash, time.time(), LSD_MIN_INTERVAL)
+
+    # 由对等方管理器在每次事件循环中调用，定期宣告每个种子
+    def update(self):
+        now = time.time()
+        for info_hash in list(self.peers_manager.torrents):
+            self._announce(info_hash, now, LSD_INTERVAL)
+
+    # 距离上次宣告超过interval秒时宣告该种子
+    def _announce(self, info_hash, now, interval):
+        if now - self.last_announce.get(info_hash, 0) < interval:
+            return
+        self.last_announce[info_hash] = now
+        try:
+            self.socket.sendto(make_announce(self.peers_manager.listen_port, info_hash, self.cookie), self.address)
+        except OSError as e:
+            logging.debug("LSD announce failed : %s" % e.__str__())
@@ -1,122 +1,68 @@
-import sys
-from block import State
-
 __author__ = 'alexisgallepe'
 
-import time
-import peers_manager
-import pieces_manager
-import torrent
-import tracker
+import argparse
 import logging
 import os
-import message
+import session
+import file_table
+import memory_budget
+import read_cache
 
 
 class Run(object):
-    percentage_completed = -1
-    last_log_line = ""
-
     def __init__(self):
-        # 从命令行获取种子文件路径
-        try:
-            torrent_file = sys.argv[1]
-        except IndexError:
+        # 从命令行获取种子文件路径，或者监视目录
+        parser = argparse.ArgumentParser(description="Download files from the BitTorrent network")
+        parser.add_argument('torrent_files', nargs='*', help="path to one or more .torrent files")
+        parser.add_argument('--watch', dest='watch_dir', help="directory watched for new .torrent files")
+        parser.add_argument('--allocation', choices=[a.value for a in file_table.Allocation],
+                            default=file_table.Allocation.SPARSE.value,
+                            help="how files are created: on first write, sparse, or fully preallocated")
+        parser.add_argument('--memory-budget', type=int, default=memory_budget.MEMORY_BUDGET // 1024 // 1024,
+                            help="memory in MiB for in-flight pieces, the write queue and send queues")
+        parser.add_argument('--read-cache', type=int, default=read_cache.READ_CACHE_SIZE // 1024 // 1024,
+                            help="memory in MiB for caching pieces requested repeatedly for upload, 0 disables the cache")
+        parser.add_argument('--cache-verified', action='store_true',
+                            help="keep freshly downloaded pieces in the read cache")
+        parser.add_argument('--no-dht', dest='dht', action='store_false', help="don't look for peers through the DHT")
+        parser.add_argument('--no-lsd', dest='lsd', action='store_false',
+                            help="don't look for peers on the local network")
+        parser.add_argument('--no-utp', dest='utp', action='store_false', help="connect to peers over TCP only")
+        parser.add_argument('--skip', type=int, nargs='+', default=[], metavar='INDEX',
+                            help="indexes of files in the torrents that are not downloaded")
+        parser.add_argument('--high', type=int, nargs='+', default=[], metavar='INDEX',
+                            help="indexes of files in the torrents that are downloaded first")
+        parser.add_argument('--seed', action='store_true',
+                            help="keep seeding after all downloads complete, until interrupted")
+        parser.add_argument('--super-seed', action='store_true',
+                            help="reveal pieces to peers one at a time when seeding a new torrent (BEP 16), implies --seed")
+        args = parser.parse_args()
+
+        if not args.torrent_files and not args.watch_dir:
             logging.error("No torrent file provided!")
-            sys.exit(0)
-        # 初始化
-        self.torrent = torrent.Torrent().load_from_path(torrent_file)
-        self.tracker = tracker.Tracker(self.torrent)
-
-        self.pieces_manager = pieces_manager.PiecesManager(self.torrent)
-        self.peers_manager = peers_manager.PeersManager(self.torrent, self.pieces_manager)
-
-        self.peers_manager.start()
-        logging.info("PeersManager Started")
-        logging.info("PiecesManager Started")
+            parser.exit(0)
+        # 初始化，所有种子共享同一个会话
+        self.session = session.Session(allocation=file_table.Allocation(args.allocation),
+                                       memory_limit=args.memory_budget * 1024 * 1024,
+                                       enable_dht=args.dht, enable_lsd=args.lsd,
+                                       enable_utp=args.utp, read_cache_size=args.read_cache * 1024 * 1024,
+                                       cache_verified_pieces=args.cache_verified,
+                                       seed=args.seed or args.super_seed)
+        # 命令行给出的文件优先级用于所有种子
+        file_priorities = {index: file_table.Priority.SKIP for index in args.skip}
+        file_priorities.update({index: file_table.Priority.HIGH for index in args.high})
+        for torrent_file in args.torrent_files:
+            self.session.add_torrent(torrent_file, file_priorities, args.super_seed)
+        if args.watch_dir:
+            self.session.watch(args.watch_dir)
 
     def start(self):
-        # 从trackers服务器获取对等方
-        peers_dict = self.tracker.get_peers_from_trackers()
-        # BUG: 此处应该删去，见tracker.Tracker.try_peer_connect
-        self.peers_manager.add_peers(peers_dict.values())
-        # 持续循环直到所有片段下载完毕
-        while not self.pieces_manager.all_pieces_completed():
-            # 如果没有被阻塞的对等方就继续循环等待，直到找到对等方
-            if not self.peers_manager.has_unchoked_peers():
-                time.sleep(1)
-                logging.info("No unchocked peers")
-                continue
-            # 遍历所有片段
-            for piece in self.pieces_manager.pieces:
-                index = piece.piece_index
-                # 如果片段已下载就跳过
-                if self.pieces_manager.pieces[index].is_full:
-                    continue
-                # 如果片段没有被下载，就随机选取一个拥有该片段的对等方
-                peer = self.peers_manager.get_random_peer_having_piece(index)
-                # 如果没有任何对等方拥有该片段，就继续循环等待
-                if not peer:
-                    continue
-                # 检查片段中的每个块，如果有块的状态为正在下载但是长时间没有更新，则重置该块的状态
-                self.pieces_manager.pieces[index].update_block_status()
-                # 获取片段首个还没有开始下载的块，将其状态置为正在下载，并返回块的信息，包括块的偏移量
-                data = self.pieces_manager.pieces[index].get_empty_block()
-                # 如果没有任何块还没有开始下载，或所有块都下载完毕，就跳过此片段
-                if not data:
-                    continue
-
-                piece_index, block_offset, block_length = data
-                # 建立所缺块的请求信息
-                piece_data = message.Request(piece_index, block_offset, block_length).to_bytes()
-                # 向对等方请求所缺块，之后的下载和存储在的步骤在其他代码处实现
-                peer.send_to_peer(piece_data)
-            # 显示进度
-            self.display_progression()
-
-            time.sleep(0.1)
-
-        logging.info("File(s) downloaded successfully.")
-        self.display_progression()
-
+        self.session.start()
         self._exit_threads()
 
-    def display_progression(self):
-        new_progression = 0
-
-        for i in range(self.pieces_manager.number_of_pieces):
-            # BUG: 下载完片段后应当清空数据，详见pieces_manager.PiecesManager.update_bitfield
-            # 由于已清空数据，所以只能通过block_size获取块大小
-            # for j in range(self.pieces_manager.pieces[i].number_of_blocks):
-            #     if self.pieces_manager.pieces[i].blocks[j].state == State.FULL:
-            #         new_progression += self.pieces_manager.pieces[i].blocks[j].block_size
-            for j in range(self.pieces_manager.pieces[i].number_of_blocks):
-                # 加和每个片段中的每个下载完成的块的长度
-                if self.pieces_manager.pieces[i].blocks[j].state == State.FULL:
-                    new_progression += len(self.pieces_manager.pieces[i].blocks[j].data)
-
-        if new_progression == self.percentage_completed:
-            return
-
-        number_of_peers = self.peers_manager.unchoked_peers_count()
-        # 计算进度的百分比
-        percentage_completed = float((float(new_progression) / self.torrent.total_length) * 100)
-
-        current_log_line = "Connected peers: {} - {}% completed | {}/{} pieces".format(
-            number_of_peers,
-            round(percentage_completed, 2),
-            self.pieces_manager.complete_pieces,
-            self.pieces_manager.number_of_pieces
-        )
-        # 如果进度有变动就打印
-        if current_log_line != self.last_log_line:
-            print(current_log_line)
-
-        self.last_log_line = current_log_line
-        self.percentage_completed = new_progression
-
     def _exit_threads(self):
-        self.peers_manager.is_active = False
+        # 退出前保存恢复数据
+        self.session.close()
         os._exit(0)
 
 
@@ -124,4 +70,7 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
     run = Run()
-    run.start()
+    try:
+        run.start()
+    except KeyboardInterrupt:
+        run._exit_threads()
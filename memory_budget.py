@@ -0,0 +1,56 @@
+__author__ = 'alexisgallepe'
+
+from threading import Lock
+
+# 默认的内存预算（字节）
+MEMORY_BUDGET = 256 * 1024 * 1024
+
+# 内存用途
+# 正在下载的片段中已收到的块
+PIECE_BUFFERS = 'piece_buffers'
+# 已校验、等待写入磁盘的片段
+WRITE_QUEUE = 'write_queue'
+# 等待发送给对等方的数据
+SEND_QUEUES = 'send_queues'
+
+
+# 全局内存预算，统计正在下载的片段、写入队列和发送队列占用的内存
+# 预算用完后，调度器不再开始下载新的片段，直到有内存被释放
+class MemoryBudget(object):
+    def __init__(self, limit=MEMORY_BUDGET):
+        # 内存预算上限
+        self.limit = limit
+        # 各用途占用的内存
+        self.usage = {PIECE_BUFFERS: 0, WRITE_QUEUE: 0, SEND_QUEUES: 0}
+        # 多个线程会同时更新占用量
+        self.lock = Lock()
+
+    # 增加占用
+    def acquire(self, category, size):
+        with self.lock:
+            self.usage[category] += size
+
+    # 释放占用
+    def release(self, category, size):
+        with self.lock:
+            self.usage[category] = max(self.usage[category] - size, 0)
+
+    # 直接设置占用量，用于定期统计的用途
+    def set_usage(self, category, size):
+        with self.lock:
+            self.usage[category] = size
+
+    # 已占用的内存总量
+    def used(self):
+        return sum(self.usage.values())
+
+    # 判断预算是否已用完
+    def is_exhausted(self):
+        return self.used() >= self.limit
+
+    # 获取统计信息
+    def stats(self):
+        stats = dict(self.usage)
+        stats['used'] = self.used()
+        stats['limit'] = self.limit
+        return stats
@@ -0,0 +1,75 @@
+__author__ = 'alexisgallepe'
+
+import hashlib
+
+from block import BLOCK_SIZE
+
+# 叶子节点数量不足2的幂时用于补齐的哈希值，全部为0
+ZERO_HASH = bytes(32)
+
+
+# 计算SHA-256哈希值
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+
+# 不小于n的最小的2的幂
+def next_power_of_two(n):
+    power = 1
+    while power < n:
+        power *= 2
+    return power
+
+
+# 计算默克尔树的根哈希值，叶子节点数量不足leaf_count时用全0的哈希值补齐
+def root_hash(leaves, leaf_count):
+    layer = list(leaves) + [ZERO_HASH] * (leaf_count - len(leaves))
+    while len(layer) > 1:
+        layer = [sha256(layer[i] + layer[i + 1]) for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+# 计算一段数据的叶子哈希值，每个16KiB的块为一个叶子节点，最后一个块可以不足16KiB
+def leaf_hashes(data):
+    return [sha256(data[i:i + BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+
+# v2种子中一个片段对应的默克尔子树（BEP 52）
+# 片段的根哈希值来自piece layers，只有一个片段的文件直接使用文件的pieces root
+# 知道每个块的叶子哈希值后，就可以在块到达时立即校验，而不必等到整个片段下载完成
+class PieceTree(object):
+    def __init__(self, root, leaf_count, pieces_root, first_leaf):
+        # 片段子树的根哈希值
+        self.root = root
+        # 子树的叶子节点数量，超出文件末尾的叶子节点为全0的哈希值
+        self.leaf_count = leaf_count
+        # 文件的默克尔树根哈希值，向对等方请求哈希值时用于指明文件
+        self.pieces_root = pieces_root
+        # 片段的第一个叶子节点在文件叶子层中的下标
+        self.first_leaf = first_leaf
+        # 已校验的每个块的叶子哈希值，未知时为None
+        self.block_hashes = None
+        # 上次向对等方请求叶子哈希值的时间
+        self.hashes_requested = 0.0
+
+    # 用叶子哈希值计算子树的根哈希值并与记录比较
+    def verify_leaves(self, leaves):
+        return len(leaves) <= self.leaf_count and root_hash(leaves, self.leaf_count) == self.root
+
+    # 校验对等方发来的叶子哈希值，校验通过后记录下来，之后到达的块可以立即校验
+    # 超出文件末尾的叶子节点为全0，同样参与根哈希值的计算
+    def set_block_hashes(self, hashes, number_of_blocks):
+        if len(hashes) != self.leaf_count or not self.verify_leaves(hashes):
+            return False
+        self.block_hashes = hashes[:number_of_blocks]
+        return True
+
+    # 校验单个块，叶子哈希值未知时返回None
+    def verify_block(self, block_index, leaf):
+        if self.block_hashes is None:
+            return None
+        return self.block_hashes[block_index] == leaf
+
+    # 是否可以向对等方请求叶子哈希值，请求的数量至少为2
+    def needs_block_hashes(self):
+        return self.block_hashes is None and self.leaf_count >= 2
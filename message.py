@@ -13,6 +13,33 @@ HANDSHAKE_PSTR_LEN = len(HANDSHAKE_PSTR_V1)
 # 可能表示消息前缀的长度，没有实装，意义不明
 LENGTH_PREFIX = 4
 
+# 握手消息保留字段中的扩展标志，格式为(字节下标, 掩码)
+# 支持v2种子（BEP 52）
+RESERVED_V2 = (7, 0x10)
+# 支持快速扩展（BEP 6）
+RESERVED_FAST = (7, 0x04)
+# 支持扩展协议（BEP 10）
+RESERVED_EXTENSION_PROTOCOL = (5, 0x10)
+# 支持DHT（BEP 5），握手后会通过PORT消息告知DHT端口
+RESERVED_DHT = (7, 0x01)
+# 本客户端支持的扩展
+SUPPORTED_EXTENSIONS = [RESERVED_V2, RESERVED_FAST, RESERVED_EXTENSION_PROTOCOL, RESERVED_DHT]
+
+
+# 根据扩展标志生成8字节的保留字段
+def make_reserved(extensions):
+    reserved = bytearray(8)
+    for byte, mask in extensions:
+        reserved[byte] |= mask
+    return bytes(reserved)
+
+
+# 判断保留字段中是否设置了该扩展标志
+def has_extension(reserved, extension):
+    byte, mask = extension
+    return bool(reserved[byte] & mask)
+
+
 # 用于抛出消息类型错误的异常
 class WrongMessageException(Exception):
     pass
@@ -42,7 +69,16 @@ class MessageDispatcher:
             6: Request,
             7: Piece,
             8: Cancel,
-            9: Port
+            9: Port,
+            13: SuggestPiece,
+            14: HaveAll,
+            15: HaveNone,
+            16: RejectRequest,
+            17: AllowedFast,
+            20: ExtendedMessage,
+            21: HashRequest,
+            22: Hashes,
+            23: HashReject
         }
         # 若收到的消息类型不再消息类型字典中则抛出异常
         if message_id not in list(map_id_to_message.keys()):
@@ -145,8 +181,10 @@ class UdpTrackerAnnounce(Message):
         Total length = 64 + 32 + 32 = 128 bytes
     """
 
-    def __init__(self, info_hash, conn_id, peer_id):
+    def __init__(self, info_hash, conn_id, peer_id, port=6881):
         super(UdpTrackerAnnounce, self).__init__()
+        # 本客户端的监听端口号
+        self.port = port
         # 本客户端的peer id
         self.peer_id = peer_id
         # 从UdpTrackerConnection得到的连接ID
@@ -180,8 +218,8 @@ class UdpTrackerAnnounce(Message):
         # i表示4字节有符号整型
         num_want = pack('>i', -1)
         # 本客户端的监听端口号
-        # h表示2字节短整型
-        port = pack('>h', 8000)
+        # H表示2字节无符号短整型
+        port = pack('>H', self.port)
         # BUG: 将self.peer_id改成上面转换的peer_id
         msg = (conn_id + action + trans_id + self.info_hash + self.peer_id + downloaded +
                left + uploaded + event + ip + key + num_want + port)
@@ -270,7 +308,7 @@ class Handshake(Message):
     payload_length = 68
     total_length = payload_length
 
-    def __init__(self, info_hash, peer_id=b'-ZZ0007-000000000000'):
+    def __init__(self, info_hash, peer_id=b'-ZZ0007-000000000000', reserved=None):
         super(Handshake, self).__init__()
         # 确保种子哈希值长度为20字节，这是BitTorrent协议的要求
         assert len(info_hash) == 20
@@ -278,10 +316,11 @@ class Handshake(Message):
         assert len(peer_id) < 255
         self.peer_id = peer_id
         self.info_hash = info_hash
+        # 8个字节的保留字段，用于表明支持的扩展，默认为本客户端支持的扩展
+        self.reserved = reserved if reserved is not None else make_reserved(SUPPORTED_EXTENSIONS)
 
     def to_bytes(self):
-        # 创建8个字节的保留字段，初始化为零
-        reserved = b'\x00' * 8
+        reserved = self.reserved
         # 将握手消息序列化为字节序列
         # B标识1字节无符号字节
         # B将HANDSHAKE_PSTR_LEN打包为1个字节
@@ -308,7 +347,7 @@ class Handshake(Message):
         if pstr != HANDSHAKE_PSTR_V1:
             raise ValueError("Invalid string identifier of the protocol")
 
-        return Handshake(info_hash, peer_id)
+        return Handshake(info_hash, peer_id, reserved)
 
 # 保持活跃
 class KeepAlive(Message):
@@ -329,7 +368,7 @@ class KeepAlive(Message):
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length = unpack(">I", payload[:cls.total_length])
+        payload_length, = unpack(">I", payload[:cls.total_length])
 
         if payload_length != 0:
             raise WrongMessageException("Not a Keep Alive message")
@@ -466,15 +505,15 @@ class Have(Message):
         self.piece_index = piece_index
 
     def to_bytes(self):
-        pack(">IBI", self.payload_length, self.message_id, self.piece_index)
+        return pack(">IBI", self.payload_length, self.message_id, self.piece_index)
 
     @classmethod
     def from_bytes(cls, payload):
         payload_length, message_id, piece_index = unpack(">IBI", payload[:cls.total_length])
         if message_id != cls.message_id:
-            raise WrongMessageException("Not a Have message")
+            raise WrongMessageException("Not a %s message" % cls.__name__)
 
-        return Have(piece_index)
+        return cls(piece_index)
 
 # 位场信息，一个字节表示一个片段，1表示拥有该片段，0表示没有该片段
 # 用于告知对等方自己拥有哪些片段
@@ -559,9 +598,9 @@ class Request(Message):
         payload_length, message_id, piece_index, block_offset, block_length = unpack(">IBIII",
                                                                                      payload[:cls.total_length])
         if message_id != cls.message_id:
-            raise WrongMessageException("Not a Request message")
+            raise WrongMessageException("Not a %s message" % cls.__name__)
 
-        return Request(piece_index, block_offset, block_length)
+        return cls(piece_index, block_offset, block_length)
 
 # 用于传输具体的数据块内容
 class Piece(Message):
@@ -652,13 +691,13 @@ class Cancel(Message):
 class Port(Message):
     """
         PORT = <length><message id><port number>
-            - length = 5 (4 bytes)
+            - length = 3 (4 bytes)
             - message id = 9 (1 byte)
-            - port number = listen_port (4 bytes)
+            - port number = DHT port (2 bytes)
     """
     message_id = 9
 
-    payload_length = 5
+    payload_length = 3
     total_length = 4 + payload_length
 
     def __init__(self, listen_port):
@@ -667,16 +706,214 @@ class Port(Message):
         self.listen_port = listen_port
 
     def to_bytes(self):
-        return pack(">IBI",
+        return pack(">IBH",
                     self.payload_length,
                     self.message_id,
                     self.listen_port)
 
     @classmethod
     def from_bytes(cls, payload):
-        payload_length, message_id, listen_port = unpack(">IBI", payload[:cls.total_length])
+        payload_length, message_id, listen_port = unpack(">IBH", payload[:cls.total_length])
 
         if message_id != cls.message_id:
             raise WrongMessageException("Not a Port message")
 
         return Port(listen_port)
+
+
+# 快速扩展（BEP 6）：建议对等方下载某个片段，通常是已在缓存中的片段
+class SuggestPiece(Have):
+    """
+        SUGGEST PIECE = <length><message id><piece index>
+            - payload length = 5 (4 bytes)
+            - message id = 13 (1 byte)
+            - piece index = zero based index of the piece (4 bytes)
+    """
+    message_id = 13
+
+# 快速扩展：拥有全部片段，代替全部为1的bitfield
+class HaveAll(Message):
+    """
+        HAVE ALL = <length><message id>
+            - payload length = 1 (4 bytes)
+            - message id = 14 (1 byte)
+    """
+    message_id = 14
+
+    payload_length = 1
+    total_length = 4 + payload_length
+
+    def to_bytes(self):
+        return pack(">IB", self.payload_length, self.message_id)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        payload_length, message_id = unpack(">IB", payload[:cls.total_length])
+        if message_id != cls.message_id:
+            raise WrongMessageException("Not a %s message" % cls.__name__)
+
+        return cls()
+
+# 快速扩展：没有任何片段，代替全部为0的bitfield
+class HaveNone(HaveAll):
+    """
+        HAVE NONE = <length><message id>
+            - payload length = 1 (4 bytes)
+            - message id = 15 (1 byte)
+    """
+    message_id = 15
+
+# 快速扩展：拒绝对等方的数据请求，对方收到后可以立即向其他对等方请求该块
+class RejectRequest(Request):
+    """
+        REJECT REQUEST = <length><message id><piece index><block offset><block length>
+            - payload length = 13 (4 bytes)
+            - message id = 16 (1 byte)
+    """
+    message_id = 16
+
+# 快速扩展：即使处于阻塞状态，对等方也可以请求这些片段
+class AllowedFast(Have):
+    """
+        ALLOWED FAST = <length><message id><piece index>
+            - payload length = 5 (4 bytes)
+            - message id = 17 (1 byte)
+            - piece index = zero based index of the piece (4 bytes)
+    """
+    message_id = 17
+
+
+# 扩展协议（BEP 10）的消息，具体的扩展由扩展消息编号区分，0为扩展握手
+class ExtendedMessage(Message):
+    """
+        EXTENDED = <length><message id><extended message id><payload>
+            - payload length = 2 + len(payload) (4 bytes)
+            - message id = 20 (1 byte)
+            - extended message id = 0 for the extension handshake (1 byte)
+            - payload = bencoded dictionary (len(payload) bytes)
+    """
+    message_id = 20
+
+    payload_length = -1
+    total_length = -1
+
+    def __init__(self, extended_id, payload):
+        super(ExtendedMessage, self).__init__()
+        # 扩展消息编号
+        self.extended_id = extended_id
+        # 扩展消息的内容
+        self.payload = payload
+
+        self.payload_length = 2 + len(payload)
+        self.total_length = 4 + self.payload_length
+
+    def to_bytes(self):
+        return pack(">IBB", self.payload_length, self.message_id, self.extended_id) + self.payload
+
+    @classmethod
+    def from_bytes(cls, payload):
+        payload_length, message_id, extended_id = unpack(">IBB", payload[:6])
+        if message_id != cls.message_id:
+            raise WrongMessageException("Not an Extended message")
+
+        return ExtendedMessage(extended_id, bytes(payload[6:4 + payload_length]))
+
+
+# v2种子中用于请求默克尔树中某一层的哈希值（BEP 52）
+class HashRequest(Message):
+    """
+        HASH REQUEST = <length><message id><pieces root><base layer><index><length><proof layers>
+            - length = 49 (4 bytes)
+            - message id = 21 (1 byte)
+            - pieces root = root hash of the file (32 bytes)
+            - base layer = lowest requested layer, 0 for the leaf layer (4 bytes)
+            - index = offset of the first requested hash in the base layer (4 bytes)
+            - length = number of requested hashes, a power of two (4 bytes)
+            - proof layers = number of ancestor layers to include (4 bytes)
+    """
+    message_id = 21
+
+    payload_length = 49
+    total_length = 4 + payload_length
+
+    def __init__(self, pieces_root, base_layer, index, length, proof_layers):
+        super(HashRequest, self).__init__()
+        # 文件的默克尔树根哈希值
+        self.pieces_root = pieces_root
+        # 请求的层，0为叶子层
+        self.base_layer = base_layer
+        # 第一个哈希值在该层中的下标
+        self.index = index
+        # 哈希值数量
+        self.length = length
+        # 需要附带的上层证明哈希值的层数
+        self.proof_layers = proof_layers
+
+    def to_bytes(self):
+        return pack(">IB32sIIII",
+                    self.payload_length,
+                    self.message_id,
+                    self.pieces_root,
+                    self.base_layer,
+                    self.index,
+                    self.length,
+                    self.proof_layers)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        payload_length, message_id, pieces_root, base_layer, index, length, proof_layers = unpack(
+            ">IB32sIIII", payload[:cls.total_length])
+        if message_id != cls.message_id:
+            raise WrongMessageException("Not a HashRequest message")
+
+        return cls(pieces_root, base_layer, index, length, proof_layers)
+
+
+# v2种子中对哈希请求的回应，在请求的字段之后附带哈希值
+class Hashes(HashRequest):
+    """
+        HASHES = <length><message id><pieces root><base layer><index><length><proof layers><hashes>
+            - length = 49 + 32 * number of hashes (4 bytes)
+            - message id = 22 (1 byte)
+            - hashes = requested hashes followed by the proof hashes (32 bytes each)
+    """
+    message_id = 22
+
+    def __init__(self, pieces_root, base_layer, index, length, proof_layers, hashes=()):
+        super(Hashes, self).__init__(pieces_root, base_layer, index, length, proof_layers)
+        # 哈希值列表
+        self.hashes = list(hashes)
+
+        self.payload_length = 49 + 32 * len(self.hashes)
+        self.total_length = 4 + self.payload_length
+
+    def to_bytes(self):
+        return pack(">IB32sIIII",
+                    self.payload_length,
+                    self.message_id,
+                    self.pieces_root,
+                    self.base_layer,
+                    self.index,
+                    self.length,
+                    self.proof_layers) + b''.join(self.hashes)
+
+    @classmethod
+    def from_bytes(cls, payload):
+        payload_length, message_id, pieces_root, base_layer, index, length, proof_layers = unpack(
+            ">IB32sIIII", payload[:HashRequest.total_length])
+        if message_id != cls.message_id:
+            raise WrongMessageException("Not a Hashes message")
+
+        raw_hashes = payload[HashRequest.total_length:4 + payload_length]
+        hashes = [bytes(raw_hashes[i:i + 32]) for i in range(0, len(raw_hashes) - 31, 32)]
+        return Hashes(pieces_root, base_layer, index, length, proof_layers, hashes)
+
+
+# v2种子中拒绝哈希请求，字段与请求相同
+class HashReject(HashRequest):
+    """
+        HASH REJECT = <length><message id><pieces root><base layer><index><length><proof layers>
+            - length = 49 (4 bytes)
+            - message id = 23 (1 byte)
+    """
+    message_id = 23
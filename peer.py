@@ -1,3 +1,4 @@
+import os
 import time
 
 __author__ = 'alexisgallepe'
@@ -5,30 +6,119 @@ __author__ = 'alexisgallepe'
 import socket
 import struct
 import bitstring
+from threading import Lock
 from pubsub import pub
 import logging
 
 import message
+import extension
+import lsd
+import upload_queue
+from block import BLOCK_SIZE
+
+# 对等方解除阻塞后，超过该时间（秒）没有发来任何数据块就视为冷落（snubbed）本客户端
+SNUB_TIMEOUT = 30
+# 每个对等方最多同时挂起的请求数量
+MAX_OUTSTANDING_REQUESTS = 5
+# 局域网对等方的带宽和延迟都更好，允许更多挂起的请求
+MAX_LAN_OUTSTANDING_REQUESTS = 20
+# 还没有测得往返时间时使用的请求超时时间（秒）
+REQUEST_TIMEOUT = 5
+# 根据往返时间和速率计算出的请求超时时间的上下限（秒）
+MIN_REQUEST_TIMEOUT = 2
+MAX_REQUEST_TIMEOUT = 30
+# 对等方评分的上下限，请求超时会降低评分，收到数据块会逐渐恢复评分
+MAX_SCORE = 1.0
+MIN_SCORE = 0.05
+# 每收到一个数据块恢复的评分
+SCORE_RECOVERY = 0.05
+# 发送PIECE消息头部时使用的标志，Linux上提示内核之后还有数据，其他平台没有该标志
+SEND_MORE = getattr(socket, 'MSG_MORE', 0)
 
 
 class Peer(object):
-    def __init__(self, number_of_pieces, ip, port=6881):
+    def __init__(self, number_of_pieces, ip, port=6881, info_hash=None):
         # 上次与该对等方通信的时间
         self.last_call = 0.0
+        # 上次从该对等方收到数据的时间，用于判断连接是否闲置超时
+        self.last_received = time.time()
+        # 上次从该对等方收到数据块的时间，用于判断是否被冷落
+        self.last_piece = time.time()
+        # 上次向该对等方请求数据块的时间
+        self.last_request = 0.0
+        # 挂起的请求，以(片段号, 块偏移量)为关键字，值为发送请求的时间
+        self.outstanding_requests = {}
+        # 平滑往返时间及其偏差（秒），从发送请求到收到数据块计算，用于调整请求超时时间
+        self.srtt = None
+        self.rttvar = 0.0
+        # 对等方评分，选择对等方请求数据块时评分越高越容易被选中
+        self.score = MAX_SCORE
         # 是否已经握手过
         self.has_handshaked = False
         # 该对等方的状态是否正常
         self.healthy = False
         # 存储从对等方接收的数据
         self.read_buffer = b''
+        # 存储还没有发送出去的数据，套接字缓冲区满时暂存在这里
+        self.write_buffer = bytearray()
+        # 主线程和对等方管理器线程都会发送消息，需要保证消息不会交错
+        self.write_lock = Lock()
+        # 对等方发来的还没有处理的请求，由对等方管理器的上传管道依次处理
+        self.upload_queue = upload_queue.UploadQueue()
         # 表示与对等方的网络连接
         self.socket = None
         self.ip = ip
         self.port = port
+        # 是否为局域网内的对等方，局域网对等方会被优先选择并允许更多挂起的请求
+        self.is_lan = lsd.is_lan_address(ip)
+        # 连接是否使用uTP传输
+        self.is_utp = False
+        # 种子哈希值，握手时用于校验对等方是否在分享同一个种子
+        self.info_hash = info_hash
+        # 是否为对等方主动发起的连接，此时由本客户端回应握手
+        self.is_inbound = False
+        # 由对等方主动发起的连接可以选择的种子，以种子哈希值为关键字
+        self.torrents = {}
+        # 对等方是否支持v2种子，可以请求默克尔树的哈希值
+        self.supports_v2 = False
+        # 对等方是否支持快速扩展（BEP 6）
+        self.supports_fast = False
+        # 对等方允许本客户端在被阻塞时请求的片段
+        self.allowed_fast = []
+        # 本客户端允许对等方在被阻塞时请求的片段
+        self.allowed_fast_sent = []
+        # 对等方是否支持扩展协议（BEP 10）
+        self.supports_extensions = False
+        # 对等方是否支持DHT（BEP 5）
+        self.supports_dht = False
+        # 对等方在扩展握手中告知的扩展，以扩展名称为关键字，值为对等方分配的扩展消息编号
+        self.extensions = {}
+        # 对等方在扩展握手中告知的监听端口，由对等方主动发起的连接只能通过它得知对方的监听端口
+        self.listen_port = None
+        # 上次收到和发送PEX消息的时间
+        self.last_pex_received = 0.0
+        self.last_pex_sent = 0.0
+        # 已经通过PEX告知该对等方的对等方地址
+        self.pex_sent = []
+        # 超级做种时已经通过HAVE消息告知该对等方的片段，最后一项是正在等待传播的片段
+        self.super_seed_pieces = []
+        # 超级做种时最后一次告知该对等方片段的时间
+        self.super_seed_offered_at = 0.0
         # 种子中的片段数量
         self.number_of_pieces = number_of_pieces
         # 初始化bitfield，全部置为0
         self.bit_field = bitstring.BitArray(number_of_pieces)
+        # 从该对等方下载的字节数
+        self.downloaded = 0
+        # 向该对等方上传的字节数
+        self.uploaded = 0
+        # 上个统计周期内的下载速率和上传速率（字节/秒），供阻塞算法使用
+        self.download_rate = 0.0
+        self.upload_rate = 0.0
+        # 上次统计速率的时间以及当时的下载和上传字节数
+        self.rate_timestamp = time.time()
+        self.rate_downloaded = 0
+        self.rate_uploaded = 0
         # 对等方状态
         self.state = {
             'am_choking': True,
@@ -41,12 +131,18 @@ class Peer(object):
         return "%s:%d" % (self.ip, self.port)
 
     # 本客户端与该对等方连接
-    def connect(self):
+    # 启用uTP时优先通过uTP连接，对方不支持时再使用TCP
+    def connect(self, utp=None):
         try:
-            self.socket = socket.create_connection((self.ip, self.port), timeout=2)
+            sock = utp.connect(self.ip, self.port) if utp else None
+            self.is_utp = sock is not None
+            if not sock:
+                sock = socket.create_connection((self.ip, self.port), timeout=2)
+            self.socket = sock
             self.socket.setblocking(False)
             logging.debug("Connected to peer ip: {} - port: {}".format(self.ip, self.port))
             self.healthy = True
+            self.last_received = time.time()
 
         except Exception as e:
             print("Failed to connect to peer (ip: %s - port: %s - %s)" % (self.ip, self.port, e.__str__()))
@@ -54,22 +150,178 @@ class Peer(object):
 
         return True
 
+    # 接受对等方主动发起的连接，torrents为本客户端正在分享的种子，握手时从中查找对等方请求的种子
+    def accept(self, sock, torrents):
+        self.torrents = torrents
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.is_inbound = True
+        logging.debug("Accepted peer ip: {} - port: {}".format(self.ip, self.port))
+        self.healthy = True
+        self.last_received = time.time()
+
     # 向对等方发送消息
+    # 套接字是非阻塞的，没能立即发送的部分存入发送缓冲区，等套接字可写时由flush发送
     def send_to_peer(self, msg):
-        try:
-            self.socket.send(msg)
-            self.last_call = time.time()
-        except Exception as e:
-            self.healthy = False
-            logging.error("Failed to send to peer : %s" % e.__str__())
+        with self.write_lock:
+            try:
+                # 发送缓冲区中还有数据时，新消息必须排在后面，保证消息顺序
+                if not self.write_buffer:
+                    sent = self.socket.send(msg)
+                    msg = msg[sent:]
+                self.write_buffer += msg
+                self.last_call = time.time()
+            except BlockingIOError:
+                self.write_buffer += msg
+                self.last_call = time.time()
+            except Exception as e:
+                self.healthy = False
+                logging.error("Failed to send to peer : %s" % e.__str__())
+
+    # 通过sendfile直接从文件发送一条PIECE消息，块数据不经过Python复制
+    # 发送缓冲区中还有数据时无法保证顺序，返回False；没能立即发送的部分从文件读入发送缓冲区
+    def send_file(self, header, fd, offset, length):
+        with self.write_lock:
+            if self.write_buffer:
+                return False
+            try:
+                try:
+                    # 提示内核头部之后还有数据，与块数据合并为完整的数据包
+                    sent = self.socket.send(header, SEND_MORE)
+                except BlockingIOError:
+                    sent = 0
+                if sent < len(header):
+                    self.write_buffer += header[sent:]
+                else:
+                    while length > 0:
+                        try:
+                            sent = os.sendfile(self.socket.fileno(), fd, offset, length)
+                        except BlockingIOError:
+                            break
+                        if not sent:
+                            break
+                        offset += sent
+                        length -= sent
+                if length > 0:
+                    data = os.pread(fd, length, offset)
+                    # 文件比预期的短，已发送的消息无法补全，只能断开连接
+                    if len(data) < length:
+                        raise OSError("Unexpected end of file")
+                    self.write_buffer += data
+                self.last_call = time.time()
+            except Exception as e:
+                self.healthy = False
+                logging.error("Failed to send to peer : %s" % e.__str__())
+            return True
+
+    # 发送缓冲区中的数据
+    def flush(self):
+        with self.write_lock:
+            if not self.write_buffer:
+                return
+            try:
+                sent = self.socket.send(self.write_buffer)
+                del self.write_buffer[:sent]
+            except BlockingIOError:
+                pass
+            except Exception as e:
+                self.healthy = False
+                logging.error("Failed to send to peer : %s" % e.__str__())
 
     # 判断对等方是否能够随机选择算法被选中以接收片段
     # 防止同一个对等方被连续要求发送片段
     # 将时间差减少到0.1能加快下载速度，但可能导致关闭连接
     # 若直接返回True，将导致对等方因短时间接收大量请求而关闭连接
+    # 同时要求挂起的请求数量未达上限
+    # 局域网对等方不受时间间隔限制，挂起的请求数量上限即为其请求队列深度
     def is_eligible(self):
         now = time.time()
-        return (now - self.last_call) > 0.2
+        return (self.is_lan or (now - self.last_call) > 0.2) and self.can_request()
+
+    # 向对等方请求数据块，并记录为挂起的请求
+    def request_block(self, piece_index, block_offset, block_length):
+        request = message.Request(piece_index, block_offset, block_length).to_bytes()
+        self.send_to_peer(request)
+        self.last_request = time.time()
+        self.outstanding_requests[(piece_index, block_offset)] = self.last_request
+        return self.last_request
+
+    # 根据往返时间和下载速率计算请求的超时时间
+    # 请求排在已挂起的请求之后，所以还要加上以当前速率传完这些请求所需的时间
+    def request_timeout(self):
+        if self.srtt is None:
+            return REQUEST_TIMEOUT
+
+        timeout = self.srtt + 4 * self.rttvar
+        if self.download_rate > 0:
+            timeout += len(self.outstanding_requests) * BLOCK_SIZE / self.download_rate
+        return min(max(timeout, MIN_REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+
+    # 请求超时，如果请求仍然挂起就移除并降低评分，返回是否确实超时
+    def expire_request(self, key, requested_at):
+        if self.outstanding_requests.get(key) != requested_at:
+            return False
+
+        del self.outstanding_requests[key]
+        self.score = max(self.score / 2, MIN_SCORE)
+        logging.debug('request timeout - %s - score: %.2f' % (self.ip, self.score))
+        return True
+
+    # 用收到数据块的往返时间更新平滑往返时间，计算方式与TCP相同
+    def _update_rtt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+
+    # 判断是否还能向该对等方发送新的请求，被冷落时只允许1个挂起的请求
+    # 超时的请求由下载的截止时间堆移除，见request_timer.RequestTimer
+    def can_request(self):
+        if self.is_snubbed():
+            max_requests = 1
+        else:
+            max_requests = MAX_LAN_OUTSTANDING_REQUESTS if self.is_lan else MAX_OUTSTANDING_REQUESTS
+        return len(self.outstanding_requests) < max_requests
+
+    # 判断该对等方是否冷落了本客户端：解除了阻塞并收到过请求，却很久没有发来数据块
+    def is_snubbed(self):
+        return self.is_unchoked() and self.last_request > self.last_piece \
+            and time.time() - self.last_piece > SNUB_TIMEOUT
+
+    # 根据上次统计以来传输的字节数计算速率
+    def update_rates(self):
+        now = time.time()
+        elapsed = now - self.rate_timestamp
+        if elapsed <= 0:
+            return
+
+        self.download_rate = (self.downloaded - self.rate_downloaded) / elapsed
+        self.upload_rate = (self.uploaded - self.rate_uploaded) / elapsed
+        self.rate_timestamp = now
+        self.rate_downloaded = self.downloaded
+        self.rate_uploaded = self.uploaded
+
+    # 阻塞该对等方，不再为其上传数据
+    def choke(self):
+        if not self.am_choking():
+            self.send_to_peer(message.Choke().to_bytes())
+            self.state['am_choking'] = True
+            logging.debug('choke - %s' % self.ip)
+            # 阻塞后丢弃还没有处理的请求，支持快速扩展的对等方需要明确拒绝，允许快速请求的片段仍然可以上传
+            if self.supports_fast:
+                for request in self.upload_queue.clear(self.allowed_fast_sent):
+                    self.reject(request)
+            else:
+                self.upload_queue.clear()
+
+    # 为该对等方解除阻塞，允许其请求数据
+    def unchoke(self):
+        if self.am_choking():
+            self.send_to_peer(message.UnChoke().to_bytes())
+            self.state['am_choking'] = False
+            logging.debug('unchoke - %s' % self.ip)
 
     # 通过bitfield判断该对等方是否拥有该片段
     def has_piece(self, index):
@@ -100,25 +352,28 @@ class Peer(object):
         return self.state['am_interested']
 
     # 设置对等方已将本客户端设置为阻塞
+    # 不支持快速扩展的对等方在阻塞时会丢弃所有请求，这些块需要立即交还给调度器
+    # 支持快速扩展时，对等方会逐个发送拒绝消息
     def handle_choke(self):
         logging.debug('handle_choke - %s' % self.ip)
         self.state['peer_choking'] = True
+        if not self.supports_fast:
+            for piece_index, block_offset in list(self.outstanding_requests):
+                self._free_request(piece_index, block_offset)
 
     # 设置对等方已将本客户端设置为非阻塞
     def handle_unchoke(self):
         logging.debug('handle_unchoke - %s' % self.ip)
+        # 从解除阻塞时开始计算冷落时间
+        if self.is_choking():
+            self.last_piece = time.time()
         self.state['peer_choking'] = False
 
     # 设置对等方对本客户端拥有的片段感兴趣
     def handle_interested(self):
         logging.debug('handle_interested - %s' % self.ip)
+        # 是否解除阻塞由阻塞算法定期决定，见choker.Choker
         self.state['peer_interested'] = True
-        # 如果本客户端已将该对等方设置为阻塞，就将解除阻塞的消息发送给对等端，表示我们现在愿意开始或继续向该对等端发送数据
-        if self.am_choking():
-            # 不知道为什么没有将self.state['am_choking']更改为False
-            # 不过程序本身在发送给对等方数据前就不检查自己有没有阻塞该对等方，应该还没有实现
-            unchoke = message.UnChoke().to_bytes()
-            self.send_to_peer(unchoke)
 
     # 设置对等方对本客户端拥有的片段不感兴趣
     def handle_not_interested(self):
@@ -159,41 +414,201 @@ class Peer(object):
 
         # pub.sendMessage('RarestPiece.updatePeersBitfield', bitfield=self.bit_field)
 
+    # 处理对等方拥有全部片段的消息
+    def handle_have_all(self):
+        logging.debug('handle_have_all - %s' % self.ip)
+        self.bit_field = bitstring.BitArray(self.number_of_pieces)
+        self.bit_field.set(True)
+        self._send_interested()
+
+    # 处理对等方没有任何片段的消息
+    def handle_have_none(self):
+        logging.debug('handle_have_none - %s' % self.ip)
+        self.bit_field = bitstring.BitArray(self.number_of_pieces)
+
+    # 处理对等方拒绝请求的消息，立即将该块交还给调度器
+    def handle_reject_request(self, reject):
+        """
+        :type reject: message.RejectRequest
+        """
+        logging.debug('handle_reject_request - %s - piece: %s' % (self.ip, reject.piece_index))
+        if (reject.piece_index, reject.block_offset) in self.outstanding_requests:
+            self._free_request(reject.piece_index, reject.block_offset)
+
+    # 处理对等方允许在阻塞时请求的片段
+    def handle_allowed_fast(self, allowed_fast):
+        """
+        :type allowed_fast: message.AllowedFast
+        """
+        logging.debug('handle_allowed_fast - %s - piece: %s' % (self.ip, allowed_fast.piece_index))
+        if allowed_fast.piece_index < self.number_of_pieces and allowed_fast.piece_index not in self.allowed_fast:
+            self.allowed_fast.append(allowed_fast.piece_index)
+
+    # 处理对等方建议下载的片段，交给片段选择器优先下载
+    def handle_suggest_piece(self, suggest):
+        """
+        :type suggest: message.SuggestPiece
+        """
+        logging.debug('handle_suggest_piece - %s - piece: %s' % (self.ip, suggest.piece_index))
+        pub.sendMessage('PiecePicker.SuggestPiece', piece_index=suggest.piece_index, info_hash=self.info_hash)
+
+    # 处理扩展协议的消息，目前支持扩展握手和ut_pex
+    def handle_extended(self, extended):
+        """
+        :type extended: message.ExtendedMessage
+        """
+        logging.debug('handle_extended - %s - id: %s' % (self.ip, extended.extended_id))
+        try:
+            if extended.extended_id == extension.EXTENDED_HANDSHAKE_ID:
+                self._handle_extended_handshake(extension.decode(extended.payload))
+            elif extended.extended_id == extension.UT_PEX_ID:
+                self._handle_pex(extended.payload)
+        except Exception as e:
+            logging.debug("Invalid extended message from %s : %s" % (self.ip, e.__str__()))
+
+    # 记录对等方支持的扩展和监听端口
+    def _handle_extended_handshake(self, contents):
+        extensions = contents.get('m', {})
+        if isinstance(extensions, dict):
+            self.extensions = {name: extended_id for name, extended_id in extensions.items()
+                               if isinstance(extended_id, int) and extended_id > 0}
+        listen_port = contents.get('p')
+        if isinstance(listen_port, int) and 0 < listen_port < 65536:
+            self.listen_port = listen_port
+
+    # 处理对等方发来的PEX消息，过于频繁的消息会被忽略，每条消息最多接受MAX_PEX_PEERS个地址
+    def _handle_pex(self, payload):
+        now = time.time()
+        if now - self.last_pex_received < extension.PEX_MIN_RECEIVE_INTERVAL:
+            logging.debug("Ignored PEX flood from %s" % self.ip)
+            return
+        self.last_pex_received = now
+
+        added, _ = extension.parse_pex(payload)
+        pub.sendMessage('PeersManager.PeerExchange', peer=self, sock_addrs=added[:extension.MAX_PEX_PEERS])
+
+    # 获取该对等方的监听地址，用于通过PEX告知其他对等方，不知道时返回None
+    def pex_address(self):
+        if not self.is_inbound:
+            return self.ip, self.port
+        if self.listen_port:
+            return self.ip, self.listen_port
+        return None
+
+    # 判断被阻塞时是否仍可以向该对等方请求该片段
+    def is_allowed_fast(self, index):
+        return self.supports_fast and index in self.allowed_fast
+
+    # 移除挂起的请求，并通知片段管理器将该块重置为未下载
+    def _free_request(self, piece_index, block_offset):
+        self.outstanding_requests.pop((piece_index, block_offset), None)
+        pub.sendMessage('PiecesManager.RequestFreed', piece_index=piece_index, block_offset=block_offset,
+                        info_hash=self.info_hash)
+
+    # 告诉对等方我们对它有兴趣
+    def _send_interested(self):
+        if self.is_choking() and not self.state['am_interested']:
+            self.send_to_peer(message.Interested().to_bytes())
+            self.state['am_interested'] = True
+
     # 处理对等方向本客户端发送的数据请求
     def handle_request(self, request):
         """
         :type request: message.Request
         """
         logging.debug('handle_request - %s' % self.ip)
-        # 如果对等方对我们有兴趣，且没有阻塞我们，就将其想要的片段发送过去
-        if self.is_interested() and self.is_unchoked():
-            # BUG: 此处应该为PeersManager.PeerRequestsPiece
-            pub.sendMessage('PiecesManager.PeerRequestsPiece', request=request, peer=self)
+        # 如果对等方对我们有兴趣，且我们没有阻塞它或该片段允许快速请求，就将其想要的片段发送过去
+        if self.is_interested() and (self.am_unchoking() or request.piece_index in self.allowed_fast_sent):
+            pub.sendMessage('PeersManager.PeerRequestsPiece', request=request, peer=self)
+        # 支持快速扩展的对等方需要明确拒绝，以便它立即向其他对等方请求
+        elif self.supports_fast:
+            self.reject(request)
+
+    # 拒绝对等方的请求
+    def reject(self, request):
+        self.send_to_peer(message.RejectRequest(request.piece_index, request.block_offset,
+                                                request.block_length).to_bytes())
 
     # 处理对等方发送过来的片段信息
     def handle_piece(self, message):
         """
         :type message: message.Piece
         """
+        # 统计下载量，用于计算下载速率
+        self.downloaded += len(message.block)
+        self.last_piece = time.time()
+        requested_at = self.outstanding_requests.pop((message.piece_index, message.block_offset), None)
+        if requested_at is not None:
+            self._update_rtt(self.last_piece - requested_at)
+            self.score = min(self.score + SCORE_RECOVERY, MAX_SCORE)
         # 存储片段信息中的块
-        pub.sendMessage('PiecesManager.Piece', piece=(message.piece_index, message.block_offset, message.block))
+        pub.sendMessage('PiecesManager.Piece', piece=(message.piece_index, message.block_offset, message.block),
+                        info_hash=self.info_hash, source=self.__hash__())
+
+    # 处理对等方请求默克尔树哈希值的消息
+    def handle_hash_request(self, request):
+        """
+        :type request: message.HashRequest
+        """
+        logging.debug('handle_hash_request - %s' % self.ip)
+        pub.sendMessage('PeersManager.PeerRequestsHashes', request=request, peer=self)
 
-    # 处理对等方发送的取消请求（未实现），撤销之前发出的数据块请求
-    def handle_cancel(self):
+    # 处理对等方发来的哈希值，由片段管理器校验并记录
+    def handle_hashes(self, hashes):
+        """
+        :type hashes: message.Hashes
+        """
+        logging.debug('handle_hashes - %s' % self.ip)
+        pub.sendMessage('PiecesManager.Hashes', hashes=hashes, info_hash=self.info_hash, source=self.__hash__())
+
+    # 处理对等方拒绝哈希请求的消息
+    def handle_hash_reject(self, reject):
+        """
+        :type reject: message.HashReject
+        """
+        logging.debug('handle_hash_reject - %s' % self.ip)
+        pub.sendMessage('PiecesManager.HashReject', reject=reject, info_hash=self.info_hash)
+
+    # 处理对等方取消的请求，从上传队列中移除还没有处理的请求
+    # 支持快速扩展的对等方要求对每个请求回应数据块或拒绝，取消成功时也需要拒绝
+    def handle_cancel(self, cancel):
         logging.debug('handle_cancel - %s' % self.ip)
+        request = self.upload_queue.cancel(cancel.piece_index, cancel.block_offset, cancel.block_length)
+        if request and self.supports_fast:
+            self.reject(request)
 
-    # 处理对等方发送的端口号信息（未实现），记录它提供的端口号
-    def handle_port_request(self):
+    # 处理对等方发送的DHT端口号，由DHT节点将其加入路由表
+    def handle_port_request(self, port):
         logging.debug('handle_port_request - %s' % self.ip)
+        if port.listen_port:
+            pub.sendMessage('DHT.AddNode', ip=self.ip, port=port.listen_port)
 
     # 处理握手消息
     def _handle_handshake(self):
         try:
             # 从缓冲区解析握手消息
             handshake_message = message.Handshake.from_bytes(self.read_buffer)
+            # 由对等方发起的连接，根据握手消息确定种子，并在校验通过后回应握手
+            if self.is_inbound:
+                if handshake_message.info_hash not in self.torrents:
+                    raise ValueError("Unknown info hash")
+                self.info_hash = handshake_message.info_hash
+                self.number_of_pieces = self.torrents[self.info_hash].number_of_pieces
+                self.bit_field = bitstring.BitArray(self.number_of_pieces)
+                self.send_to_peer(message.Handshake(self.info_hash).to_bytes())
+            # 种子哈希值不符，说明对等方分享的不是同一个种子
+            elif handshake_message.info_hash != self.info_hash:
+                raise ValueError("Info hash mismatch")
+            self.supports_v2 = message.has_extension(handshake_message.reserved, message.RESERVED_V2)
+            self.supports_fast = message.has_extension(handshake_message.reserved, message.RESERVED_FAST)
+            self.supports_extensions = message.has_extension(handshake_message.reserved,
+                                                             message.RESERVED_EXTENSION_PROTOCOL)
+            self.supports_dht = message.has_extension(handshake_message.reserved, message.RESERVED_DHT)
             self.has_handshaked = True
             # 更新缓冲区，移除已处理的握手消息部分
             self.read_buffer = self.read_buffer[handshake_message.total_length:]
+            # 握手完成后由对等方管理器告知对方本客户端拥有的片段
+            pub.sendMessage('PeersManager.PeerHandshaked', peer=self)
             logging.debug('handle_handshake - %s' % self.ip)
             return True
 
@@ -223,6 +638,9 @@ class Peer(object):
     def get_messages(self):
         # 只要读缓冲区中的数据长度超过4字节且对等端健康状态为正常就循环
         while len(self.read_buffer) > 4 and self.healthy:
+            # 握手消息尚未完整接收，等待更多数据
+            if not self.has_handshaked and len(self.read_buffer) < message.Handshake.total_length:
+                break
             # 如果尚未完成握手，则尝试处理握手消息。如果已经握手，则尝试处理保持连接活跃的消息。
             if (not self.has_handshaked and self._handle_handshake()) or self._handle_keep_alive():
                 continue
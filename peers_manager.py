@@ -3,91 +3,503 @@ import time
 __author__ = 'alexisgallepe'
 
 import select
+from collections import deque
 from threading import Thread
 from pubsub import pub
 import rarest_piece
+import choker
+import memory_budget
+import upload_queue
 import logging
 import message
 import peer
 import errno
 import socket
 import random
+import hashlib
+import struct
+import ipaddress
+import extension
+import lsd
+import super_seed
 
+# 本客户端监听的端口号，向tracker宣告时会告知该端口
+LISTEN_PORT = 6881
+# 最多接受的由对等方主动发起的连接数量
+MAX_INBOUND_PEERS = 20
+# 所有种子共享的最终成功连接的对等方的最大数量
+MAX_PEERS_CONNECTED = 8
+# 超过该时间（秒）没有向对等方发送任何消息，就发送保持活跃消息
+KEEP_ALIVE_INTERVAL = 90
+# 超过该时间（秒）没有收到对等方的任何数据，就断开连接
+PEER_TIMEOUT = 180
+# 连接数达到上限时，每隔该时间（秒）淘汰最慢的对等方，为候选对等方腾出位置
+TURNOVER_INTERVAL = 60
+# 连接失败或被淘汰的候选对等方，需要等待该时间（秒）才能再次尝试
+CANDIDATE_RETRY_INTERVAL = 300
+# 每个种子最多记录的候选对等方数量，避免PEX消息撑满候选列表
+MAX_CANDIDATES = 500
+# 候选数量达到上限后，通过本地服务发现找到的对等方还可以额外加入的数量
+MAX_LSD_CANDIDATES = 50
+# 选择对等方请求数据块时，局域网对等方的权重倍数
+LAN_PEER_WEIGHT = 4
+# 允许对等方在被阻塞时请求的片段数量（BEP 6）
+ALLOWED_FAST_COUNT = 10
+# 新下载完成的片段积累该时间（秒）后一起通过HAVE消息告知对等方
+HAVE_FLUSH_INTERVAL = 0.5
 
+
+# 按照BEP 6的算法计算允许对等方在被阻塞时请求的片段，结果只取决于对等方IP地址的前24位和种子哈希值
+def allowed_fast_set(ip, info_hash, number_of_pieces, count=ALLOWED_FAST_COUNT):
+    count = min(count, number_of_pieces)
+    try:
+        x = struct.pack(">I", struct.unpack(">I", socket.inet_aton(ip))[0] & 0xFFFFFF00) + info_hash
+    except OSError:
+        # 只支持IPv4地址
+        return []
+
+    allowed = []
+    while len(allowed) < count:
+        x = hashlib.sha1(x).digest()
+        for i in range(5):
+            if len(allowed) >= count:
+                break
+            index = struct.unpack(">I", x[i * 4:i * 4 + 4])[0] % number_of_pieces
+            if index not in allowed:
+                allowed.append(index)
+    return allowed
+
+
+# 负责所有种子的对等方连接，多个种子共享同一个监听端口、事件循环和连接数上限
 class PeersManager(Thread):
-    def __init__(self, torrent, pieces_manager):
+    def __init__(self, listen_port=LISTEN_PORT, max_inbound_peers=MAX_INBOUND_PEERS,
+                 max_peers=MAX_PEERS_CONNECTED, upload_slots=choker.UPLOAD_SLOTS, budget=None):
         Thread.__init__(self)
+        # 内存预算，统计所有对等方发送缓冲区占用的内存
+        self.memory_budget = budget if budget else memory_budget.MemoryBudget()
         # 存储已连接的对等方
         self.peers = []
-        self.torrent = torrent
-        # 片段管理器
-        self.pieces_manager = pieces_manager
-        # 管理稀缺片段，此版本未实装
-        self.rarest_pieces = rarest_piece.RarestPieces(pieces_manager)
-        # 记录拥有该片段的对等方数量和对等方列表
-        self.pieces_by_peer = [[0, []] for _ in range(pieces_manager.number_of_pieces)]
+        # 各个种子的片段管理器，以种子哈希值为关键字
+        self.torrents = {}
+        # 各个种子的稀缺片段管理，此版本未实装
+        self.rarest_pieces = {}
+        # 启用超级做种的种子，以种子哈希值为关键字
+        self.super_seeders = {}
         # 控制线程是否应该运行
         self.is_active = True
+        # 阻塞算法，负责分配所有种子共享的上传名额
+        self.choker = choker.Choker(self, upload_slots)
+        # 上传管道，处理各个对等方排队的请求
+        self.uploader = upload_queue.Uploader()
+        # 监听端口号
+        self.listen_port = listen_port
+        # 传入连接数量上限
+        self.max_inbound_peers = max_inbound_peers
+        # 用于接受对等方连接的监听套接字
+        self.listen_socket = self._create_listen_socket()
+        # 连接数量上限
+        self.max_peers = max_peers
+        # 候选对等方地址，以(种子哈希值, IP地址:端口号)为关键字
+        self.candidates = {}
+        # 记录上次尝试连接候选对等方的时间，避免反复连接
+        self.candidates_tried = {}
+        # 正在连接的候选对等方
+        self.candidates_connecting = set()
+        # 上次淘汰慢速对等方的时间
+        self.last_turnover = time.time()
+        # 因发送坏数据而被封禁的IP地址
+        self.banned_ips = []
+        # 共享事件循环的其他服务，例如DHT，每个服务提供sockets、handle_readable、update和timeout
+        self.services = []
+        # DHT使用的端口号，握手后通过PORT消息告知支持DHT的对等方，未启用DHT时为None
+        self.dht_port = None
+        # uTP传输，启用时优先通过uTP连接候选对等方，失败后再使用TCP
+        self.utp = None
+        # 已写入磁盘、还没有告知对等方的片段，每项为(种子哈希值, 片段号)，由磁盘线程加入
+        self.pending_haves = deque()
+        # 上次发送HAVE消息的时间
+        self.last_have_flush = 0.0
 
         # Events
-        # 订阅两个事件，当其他模块有函数发送了这两个事件，PeersManager将相应调用self.peer_requests_piece和self.peers_bitfield来处理
+        # 订阅事件，当其他模块有函数发送了该事件，PeersManager将相应调用self.peer_requests_piece来处理
         # 处理对等方请求片段的事件
         pub.subscribe(self.peer_requests_piece, 'PeersManager.PeerRequestsPiece')
-        # 处理对等方bitfield更新事件，尚未实装，且从注释来看此事件会被移入RarestPieces类
-        pub.subscribe(self.peers_bitfield, 'PeersManager.updatePeersBitfield')
+        # 处理对等方握手完成的事件
+        pub.subscribe(self.peer_handshaked, 'PeersManager.PeerHandshaked')
+        # 处理对等方通过PEX告知其他对等方地址的事件
+        pub.subscribe(self.peer_exchange, 'PeersManager.PeerExchange')
+        # 处理对等方请求默克尔树哈希值的事件
+        pub.subscribe(self.peer_requests_hashes, 'PeersManager.PeerRequestsHashes')
+        # 处理封禁对等方的事件
+        pub.subscribe(self.ban_peer, 'PeersManager.BanPeer')
+        # 处理片段写入磁盘的事件，之后通过HAVE消息告知对等方
+        pub.subscribe(self.piece_completed, 'PiecesManager.PieceCompleted')
+
+    # 注册共享事件循环的服务，其套接字可读时调用handle_readable，每次循环调用update
+    # 事件循环等待的时间不超过各个服务的timeout，以便及时重传和发送
+    def register_service(self, service):
+        self.services.append(service)
+
+    # 增加一个种子，此后会接受该种子的对等方连接
+    def add_torrent(self, torrent, pieces_manager):
+        self.torrents[torrent.info_hash] = pieces_manager
+        self.rarest_pieces[torrent.info_hash] = rarest_piece.RarestPieces(pieces_manager)
+
+    # 启用或关闭种子的超级做种，只在本客户端拥有全部片段时生效，只影响之后连接的对等方
+    def set_super_seeding(self, info_hash, enabled):
+        if not enabled:
+            self.super_seeders.pop(info_hash, None)
+        elif info_hash in self.torrents and info_hash not in self.super_seeders:
+            self.super_seeders[info_hash] = super_seed.SuperSeeder(self.torrents[info_hash])
+
+    # 获取正在超级做种的种子的SuperSeeder，没有启用或还没有下载完成时返回None
+    def _super_seeder(self, info_hash):
+        seeder = self.super_seeders.get(info_hash)
+        return seeder if seeder and seeder.is_active() else None
 
     # 处理对等方请求片段的事件
+    # 将对等方的请求加入它的上传队列，由事件循环中的上传管道处理，请求在发送前可以被取消
     def peer_requests_piece(self, request=None, peer=None):
         if not request or not peer:
             logging.error("empty request/peer message")
+        pieces_manager = self.torrents.get(peer.info_hash)
+        if not pieces_manager:
+            return
         # 从请求信息中提取对等方所需要的片段的片段号，块偏移量和块长度
         piece_index, block_offset, block_length = request.piece_index, request.block_offset, request.block_length
-        # 用提取得到的信息获取块的真实数据
-        block = self.pieces_manager.get_block(piece_index, block_offset, block_length)
-        # 如果该块存在，就发送给对等方
-        if block:
-            piece = message.Piece(piece_index, block_offset, block_length, block).to_bytes()
-            peer.send_to_peer(piece)
-            logging.info("Sent piece index {} to peer : {}".format(request.piece_index, peer.ip))
-
-    # 处理对等方bitfield更新事件
-    def peers_bitfield(self, bitfield=None):
-        # 遍历所有片段
-        for i in range(len(self.pieces_by_peer)):
-            # 如果bitfield显示对等方拥有该片段，且我方尚未将该对等方记录下来
-            # BUG: 此处应该删去and self.pieces_by_peer[i][0]，因为永远无法达成
-            if bitfield[i] == 1 and peer not in self.pieces_by_peer[i][1] and self.pieces_by_peer[i][0]:
-                self.pieces_by_peer[i][1].append(peer)
-                self.pieces_by_peer[i][0] = len(self.pieces_by_peer[i][1])
-
-    # 随机选择一个有指定数据片段且符合条件的对等方
-    def get_random_peer_having_piece(self, index):
+        # 只接受本客户端已有片段中的有效范围
+        valid = piece_index < pieces_manager.number_of_pieces and pieces_manager.pieces[piece_index].is_full \
+            and 0 < block_length <= upload_queue.MAX_BLOCK_LENGTH \
+            and block_offset + block_length <= pieces_manager.pieces[piece_index].piece_size
+        # 超级做种时只上传告知过该对等方的片段
+        seeder = self._super_seeder(peer.info_hash)
+        if valid and seeder and not seeder.can_upload(peer, piece_index):
+            valid = False
+        # 无效的请求或队列已满时，支持快速扩展的对等方需要明确拒绝
+        if not (valid and peer.upload_queue.add(request)) and peer.supports_fast:
+            peer.reject(request)
+
+    # 握手完成后告知对等方本客户端拥有的片段，位场必须是握手后的第一条消息
+    # 支持快速扩展的对等方拥有全部或没有任何片段时改为发送HAVE_ALL或HAVE_NONE，之后还会收到允许它在被阻塞时请求的片段
+    # 支持DHT的对等方会收到DHT端口号，支持扩展协议的对等方还会收到扩展握手消息
+    # 超级做种时不告知拥有的片段，只在最后通过HAVE消息告知一个片段，也不发送允许快速请求的片段
+    def peer_handshaked(self, peer=None):
+        pieces_manager = self.torrents.get(peer.info_hash)
+        if not pieces_manager:
+            return
+
+        seeder = self._super_seeder(peer.info_hash)
+        if seeder:
+            if peer.supports_fast:
+                peer.send_to_peer(message.HaveNone().to_bytes())
+        elif peer.supports_fast and pieces_manager.bitfield.all(True):
+            peer.send_to_peer(message.HaveAll().to_bytes())
+        elif peer.supports_fast and not pieces_manager.bitfield.any(True):
+            peer.send_to_peer(message.HaveNone().to_bytes())
+        # 不支持快速扩展时，没有任何片段可以不发送位场
+        elif pieces_manager.bitfield.any(True):
+            peer.send_to_peer(message.BitField(pieces_manager.bitfield).to_bytes())
+
+        if peer.supports_dht and self.dht_port:
+            peer.send_to_peer(message.Port(self.dht_port).to_bytes())
+
+        if peer.supports_extensions:
+            handshake = message.ExtendedMessage(extension.EXTENDED_HANDSHAKE_ID,
+                                                extension.make_handshake(self.listen_port))
+            peer.send_to_peer(handshake.to_bytes())
+
+        if seeder:
+            seeder.peer_handshaked(peer, self.peers)
+            return
+
+        if not peer.supports_fast:
+            return
+
+        for index in allowed_fast_set(peer.ip, peer.info_hash, pieces_manager.number_of_pieces):
+            if pieces_manager.bitfield[index]:
+                peer.allowed_fast_sent.append(index)
+                peer.send_to_peer(message.AllowedFast(index).to_bytes())
+
+    # 记录写入磁盘的片段，由事件循环定期批量发送HAVE消息
+    def piece_completed(self, info_hash, piece_index):
+        self.pending_haves.append((info_hash, piece_index))
+
+    # 将积累的片段通过HAVE消息告知已握手的对等方，每个对等方的消息合并为一次发送，对等方已经拥有的片段不再告知
+    # 超级做种的种子不告知，例如重新校验后完成的片段
+    def _flush_haves(self, now):
+        if not self.pending_haves or now - self.last_have_flush < HAVE_FLUSH_INTERVAL:
+            return
+        self.last_have_flush = now
+
+        completed = {}
+        while self.pending_haves:
+            info_hash, piece_index = self.pending_haves.popleft()
+            completed.setdefault(info_hash, []).append(piece_index)
+
+        for peer in self.peers:
+            if not peer.has_handshaked or peer.info_hash not in completed or self._super_seeder(peer.info_hash):
+                continue
+            haves = b''.join(message.Have(index).to_bytes() for index in completed[peer.info_hash]
+                             if not peer.has_piece(index))
+            if haves:
+                peer.send_to_peer(haves)
+
+    # 将PEX收到的地址加入候选对等方，已封禁的地址和本客户端自己的地址会被忽略
+    def peer_exchange(self, peer=None, sock_addrs=None):
+        sock_addrs = [(ip, port) for ip, port in sock_addrs
+                      if not self.is_banned(ip) and not self.is_own_address(ip, port)]
+        if sock_addrs:
+            logging.debug("Got %d peer(s) from PEX with %s" % (len(sock_addrs), peer.ip))
+            self.add_candidates(peer.info_hash, sock_addrs)
+
+    # 判断地址是否为本客户端的监听地址
+    def is_own_address(self, ip, port):
+        return port == self.listen_port and ipaddress.ip_address(ip).is_loopback
+
+    # 定期通过PEX向支持ut_pex的对等方告知同一个种子的其他对等方，只发送与上次相比新增和断开的地址
+    def _send_pex(self, now):
+        for peer in self.peers:
+            pex_id = peer.extensions.get('ut_pex')
+            if not pex_id or not peer.has_handshaked or now - peer.last_pex_sent < extension.PEX_INTERVAL:
+                continue
+
+            current = []
+            for other in self.peers:
+                if other is not peer and other.info_hash == peer.info_hash and other.has_handshaked:
+                    address = other.pex_address()
+                    if address and address not in current:
+                        current.append(address)
+
+            added = [address for address in current if address not in peer.pex_sent][:extension.MAX_PEX_PEERS]
+            dropped = [address for address in peer.pex_sent if address not in current]
+            peer.last_pex_sent = now
+            if not added and not dropped:
+                continue
+
+            peer.pex_sent = [address for address in peer.pex_sent if address not in dropped] + added
+            pex = message.ExtendedMessage(pex_id, extension.make_pex(added, dropped))
+            peer.send_to_peer(pex.to_bytes())
+
+    # 处理对等方请求哈希值的事件，无法提供时回复拒绝
+    def peer_requests_hashes(self, request=None, peer=None):
+        pieces_manager = self.torrents.get(peer.info_hash)
+        hashes = None
+        if pieces_manager:
+            hashes = pieces_manager.get_block_hashes(request.pieces_root, request.base_layer, request.index,
+                                                     request.length, request.proof_layers)
+        if hashes is None:
+            reply = message.HashReject(request.pieces_root, request.base_layer, request.index, request.length,
+                                       request.proof_layers)
+        else:
+            reply = message.Hashes(request.pieces_root, request.base_layer, request.index, request.length,
+                                   request.proof_layers, hashes)
+        peer.send_to_peer(reply.to_bytes())
+
+    # 封禁发送坏数据的对等方，断开该IP地址的所有连接且不再连接
+    # 可能在处理该对等方的消息时被调用，所以只标记为不健康，由事件循环移除
+    def ban_peer(self, source=None):
+        # 网络种子的来源为URL，由web_seed.WebSeed自行停用
+        if '://' in source:
+            return
+        ip = source.rsplit(':', 1)[0]
+        if ip in self.banned_ips:
+            return
+        logging.warning("Banned peer : %s" % ip)
+        self.banned_ips.append(ip)
+        for peer in self.peers:
+            if peer.ip == ip:
+                peer.healthy = False
+
+    # 判断该IP地址是否已被封禁
+    def is_banned(self, ip):
+        return ip in self.banned_ips
+
+    # 随机选择一个分享该种子、有指定数据片段且符合条件的对等方
+    # 片段校验失败后优先选择没有参与该片段的对等方，没有其他对等方时才再次选择它们
+    def get_random_peer_having_piece(self, info_hash, index, exclude=()):
         # 候选列表
         ready_peers = []
+        # 参与过校验失败的候选对等方
+        excluded_peers = []
 
         for peer in self.peers:
-            # 如果对等方没有被连续请求，没有将本客户端阻塞，拥有本客户端感兴趣的片段，拥有当前需要的片段
-            if peer.is_eligible() and peer.is_unchoked() and peer.am_interested() and peer.has_piece(index):
+            if peer.info_hash != info_hash:
+                continue
+            # 如果对等方没有被连续请求，没有将本客户端阻塞（或允许快速请求该片段），拥有本客户端感兴趣的片段，拥有当前需要的片段
+            if peer.is_eligible() and (peer.is_unchoked() or peer.is_allowed_fast(index)) \
+                    and peer.am_interested() and peer.has_piece(index):
                 # 加入候选列表
-                ready_peers.append(peer)
-        # 随机选取一个对等方
-        return random.choice(ready_peers) if ready_peers else None
+                if peer.__hash__() in exclude:
+                    excluded_peers.append(peer)
+                else:
+                    ready_peers.append(peer)
+        if not ready_peers:
+            ready_peers = excluded_peers
+        # 按评分加权随机选取一个对等方，请求经常超时的对等方被选中的机会更小，局域网对等方更容易被选中
+        weights = [peer.score * (LAN_PEER_WEIGHT if peer.is_lan else 1) for peer in ready_peers]
+        return random.choices(ready_peers, weights=weights)[0] if ready_peers else None
 
-    # 检查是否有未将本客户端阻塞的对等方
-    def has_unchoked_peers(self):
+    # 检查该种子是否有未将本客户端阻塞的对等方
+    def has_unchoked_peers(self, info_hash):
         for peer in self.peers:
-            if peer.is_unchoked():
+            if peer.info_hash == info_hash and peer.is_unchoked():
                 return True
         return False
 
-    # 计算未将本客户端阻塞的对等方的数量
-    def unchoked_peers_count(self):
+    # 检查该种子是否有允许在阻塞时请求片段的对等方
+    def has_allowed_fast_peers(self, info_hash):
+        for peer in self.peers:
+            if peer.info_hash == info_hash and peer.is_choking() and peer.allowed_fast:
+                return True
+        return False
+
+    # 计算该种子未将本客户端阻塞的对等方的数量
+    def unchoked_peers_count(self, info_hash):
+        cpt = 0
+        for peer in self.peers:
+            if peer.info_hash == info_hash and peer.is_unchoked():
+                cpt += 1
+        return cpt
+
+    # 创建监听套接字，失败时只能主动连接对等方
+    def _create_listen_socket(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', self.listen_port))
+            sock.listen(5)
+            sock.setblocking(False)
+            logging.info("Listening for peers on port %d" % self.listen_port)
+            return sock
+
+        except Exception as e:
+            logging.error("Failed to listen on port %d : %s" % (self.listen_port, e.__str__()))
+
+        return None
+
+    # 计算由对等方主动发起的连接数量
+    def inbound_peers_count(self):
         cpt = 0
         for peer in self.peers:
-            if peer.is_unchoked():
+            if peer.is_inbound:
                 cpt += 1
         return cpt
 
+    # 接受对等方发起的连接，等待其发送握手消息
+    def _accept_peer(self):
+        try:
+            sock, (ip, port) = self.listen_socket.accept()
+        except socket.error as e:
+            logging.debug("Accept failed : %s" % e.__str__())
+            return
+        self.accept_stream(sock, ip, port)
+
+    # 接受对等方通过TCP或uTP发起的连接，返回是否接受
+    def accept_stream(self, sock, ip, port, is_utp=False):
+        if self.is_banned(ip):
+            logging.debug("Refused banned peer %s" % ip)
+            sock.close()
+            return False
+        # 超过传入连接上限就直接关闭连接
+        if self.inbound_peers_count() >= self.max_inbound_peers:
+            logging.debug("Too many inbound peers, refused %s" % ip)
+            sock.close()
+            return False
+
+        # 在收到握手消息之前还不知道对等方分享的是哪个种子
+        new_peer = peer.Peer(0, ip, port)
+        new_peer.accept(sock, self.torrents)
+        new_peer.is_utp = is_utp
+        self.peers.append(new_peer)
+        logging.info("new inbound peer : %s" % ip)
+        return True
+
+    # 增加该种子的候选对等方地址
+    # 已记录的地址不会重复加入，候选数量达到上限后只接受通过本地服务发现找到的对等方，且数量也有上限
+    # PEX和DHT可能给出任意的局域网地址，不能因为是局域网地址就不受上限限制
+    def add_candidates(self, info_hash, sock_addrs, from_lsd=False):
+        count = sum(1 for key in self.candidates if key[0] == info_hash)
+        limit = MAX_CANDIDATES + MAX_LSD_CANDIDATES if from_lsd else MAX_CANDIDATES
+        for ip, port in sock_addrs:
+            key = (info_hash, "%s:%d" % (ip, port))
+            if key in self.candidates:
+                continue
+            if count >= limit:
+                continue
+            self.candidates[key] = (info_hash, ip, port)
+            count += 1
+
+    # 连接数不足时，在后台线程中连接候选对等方
+    def _connect_candidates(self):
+        now = time.time()
+        connected = set((peer.info_hash, peer.__hash__()) for peer in self.peers)
+        free_slots = self.max_peers - len(self.peers) - len(self.candidates_connecting)
+
+        # 优先连接局域网内的候选对等方
+        candidates = sorted(self.candidates.items(), key=lambda item: not lsd.is_lan_address(item[1][1]))
+        for key, (info_hash, ip, port) in candidates:
+            # 该种子已被移除
+            if info_hash not in self.torrents:
+                continue
+            if free_slots <= 0:
+                break
+            if key in connected or key in self.candidates_connecting or self.is_banned(ip):
+                continue
+            if now - self.candidates_tried.get(key, 0) < CANDIDATE_RETRY_INTERVAL:
+                continue
+
+            self.candidates_tried[key] = now
+            self.candidates_connecting.add(key)
+            Thread(target=self._connect_candidate, args=(key, info_hash, ip, port), daemon=True).start()
+            free_slots -= 1
+
+    # 连接候选对等方，连接并握手成功后加入对等方列表
+    def _connect_candidate(self, key, info_hash, ip, port):
+        new_peer = peer.Peer(self.torrents[info_hash].number_of_pieces, ip, port, info_hash)
+        if new_peer.connect(self.utp) and self._do_handshake(new_peer):
+            self.peers.append(new_peer)
+        self.candidates_connecting.discard(key)
+
+    # 维护连接：发送保持活跃消息，断开闲置超时的对等方，并定期淘汰最慢的对等方
+    def _maintain_peers(self):
+        now = time.time()
+
+        for peer in list(self.peers):
+            # 被封禁或出错的对等方，例如握手时给出了未知的种子哈希值
+            if self.is_banned(peer.ip) or not peer.healthy:
+                self.remove_peer(peer)
+            elif now - peer.last_received > PEER_TIMEOUT:
+                logging.info("Peer timed out : %s" % peer.ip)
+                self.remove_peer(peer)
+            # 握手完成前不能发送其他消息
+            elif peer.has_handshaked and now - peer.last_call > KEEP_ALIVE_INTERVAL:
+                peer.send_to_peer(message.KeepAlive().to_bytes())
+
+        if now - self.last_turnover >= TURNOVER_INTERVAL:
+            self.last_turnover = now
+            self._turnover_slowest_peer(now)
+
+        self._send_pex(now)
+        self._connect_candidates()
+
+    # 连接数达到上限且还有未尝试的候选对等方时，断开下载最慢的对等方，被冷落的对等方优先被淘汰
+    def _turnover_slowest_peer(self, now):
+        if len(self.peers) < self.max_peers:
+            return
+
+        connected = set((peer.info_hash, peer.__hash__()) for peer in self.peers)
+        has_candidates = any(key not in connected and now - self.candidates_tried.get(key, 0) >= CANDIDATE_RETRY_INTERVAL
+                             for key in self.candidates)
+        if not has_candidates:
+            return
+
+        for peer in self.peers:
+            peer.update_rates()
+        slowest_peer = min(self.peers, key=lambda peer: (not peer.is_snubbed(), peer.download_rate))
+        logging.info("Disconnecting slowest peer : %s" % slowest_peer.ip)
+        self.candidates_tried[(slowest_peer.info_hash, slowest_peer.__hash__())] = now
+        self.remove_peer(slowest_peer)
+
     # 从套接字中读取数据
     @staticmethod
     def _read_from_socket(sock):
@@ -122,10 +534,41 @@ class PeersManager(Thread):
         while self.is_active:
             # 创建一个包含所有对等方套接字的列表
             read = [peer.socket for peer in self.peers]
-            # 监控套接字列表，等待可读事件。select函数在这里用于非阻塞地检查哪些套接字准备好读取数据
-            read_list, _, _ = select.select(read, [], [], 1)
-            # 遍历所有准备好的套接字
+            # 同时监听新的传入连接
+            if self.listen_socket:
+                read.append(self.listen_socket)
+            # 同时监听各个服务的套接字
+            services = {}
+            for service in self.services:
+                for sock in service.sockets():
+                    services[sock] = service
+            read.extend(services)
+            timeout = min([1] + [service.timeout() for service in self.services])
+            # 有片段等待告知对等方时，不要等待太久
+            if self.pending_haves:
+                timeout = min(timeout, HAVE_FLUSH_INTERVAL)
+            # 发送缓冲区中还有数据的对等方，需要等待套接字可写
+            write = [peer.socket for peer in self.peers if peer.write_buffer]
+            # 监控套接字列表，等待可读或可写事件。select函数在这里用于非阻塞地检查哪些套接字准备好读写数据
+            read_list, write_list, _ = select.select(read, write, [], timeout)
+            # 发送缓冲区中的数据
+            for socket in write_list:
+                try:
+                    self.get_peer_by_socket(socket).flush()
+                except Exception:
+                    continue
+            # 统计所有发送缓冲区占用的内存，以及排队的上传请求将要占用的内存
+            self.memory_budget.set_usage(memory_budget.SEND_QUEUES, sum(len(peer.write_buffer) + peer.upload_queue.queued_bytes
+                                                                        for peer in self.peers))
+            # 遍历所有准备好读取的套接字
             for socket in read_list:
+                # 监听套接字可读表示有新的传入连接
+                if socket == self.listen_socket:
+                    self._accept_peer()
+                    continue
+                if socket in services:
+                    services[socket].handle_readable(socket)
+                    continue
                 # 根据套接字找到相应的对等端对象
                 peer = self.get_peer_by_socket(socket)
                 # 如果对等方状态不健康就移除
@@ -141,18 +584,52 @@ class PeersManager(Thread):
                     # 读取失败，移除该对等方
                     self.remove_peer(peer)
                     continue
+                # 套接字可读却读不到数据，说明对等方已经关闭连接
+                if not payload:
+                    self.remove_peer(peer)
+                    continue
+                peer.last_received = time.time()
                 # 将读取到的数据追加到对等方的缓冲区
                 peer.read_buffer += payload
                 # 遍历从缓冲区解析出的所有消息
                 for message in peer.get_messages():
                     # 按照消息类型处理每一条消息
                     self._process_new_message(message, peer)
+            # 处理对等方排队的请求，发送缓冲区积压较多的对等方等到缓冲区发送后再处理
+            self._serve_uploads()
+            # 告知对等方新下载完成的片段
+            self._flush_haves(time.time())
+            # 超级做种时，为片段传播超时的对等方告知新的片段
+            self._update_super_seeders()
+            # 更新各个服务的状态，例如DHT的请求超时和查找
+            for service in self.services:
+                service.update()
+            # 定期重新分配上传名额
+            self.choker.update()
+            # 维护对等方连接
+            self._maintain_peers()
+        # 事件循环结束后关闭上传时打开的文件
+        self.uploader.close()
+
+    # 更新正在超级做种的种子
+    def _update_super_seeders(self):
+        for info_hash in list(self.super_seeders):
+            seeder = self._super_seeder(info_hash)
+            if seeder:
+                seeder.update(info_hash, self.peers)
+
+    # 处理所有对等方排队的请求
+    def _serve_uploads(self):
+        for peer in self.peers:
+            pieces_manager = self.torrents.get(peer.info_hash)
+            if peer.upload_queue and pieces_manager:
+                self.uploader.serve(peer, pieces_manager)
 
     # 与对等方握手
     # BUG: 此方法应该被移动到tracker.Tracker._do_handshake，见tracker.Tracker.try_peer_connect
     def _do_handshake(self, peer):
         try:
-            handshake = message.Handshake(self.torrent.info_hash)
+            handshake = message.Handshake(peer.info_hash)
             peer.send_to_peer(handshake.to_bytes())
             logging.info("new peer added : %s" % peer.ip)
             return True
@@ -166,6 +643,8 @@ class PeersManager(Thread):
     # BUG: 此方法应该删去，见tracker.Tracker.try_peer_connect
     def add_peers(self, peers):
         for peer in peers:
+            if self.is_banned(peer.ip):
+                continue
             if self._do_handshake(peer):
                 self.peers.append(peer)
             else:
@@ -198,6 +677,20 @@ class PeersManager(Thread):
         # 如果是握手消息或保持连接消息就报错，因为这两个消息在前面已经处理过了，且只会出现一次
         if isinstance(new_message, message.Handshake) or isinstance(new_message, message.KeepAlive):
             logging.error("Handshake or KeepALive should have already been handled")
+        # 处理扩展协议的消息
+        elif isinstance(new_message, message.ExtendedMessage):
+            peer.handle_extended(new_message)
+        # 快速扩展的消息是已有消息的子类，需要先判断（BEP 6）
+        elif isinstance(new_message, message.SuggestPiece):
+            peer.handle_suggest_piece(new_message)
+        elif isinstance(new_message, message.AllowedFast):
+            peer.handle_allowed_fast(new_message)
+        elif isinstance(new_message, message.HaveNone):
+            peer.handle_have_none()
+        elif isinstance(new_message, message.HaveAll):
+            peer.handle_have_all()
+        elif isinstance(new_message, message.RejectRequest):
+            peer.handle_reject_request(new_message)
         # 处理阻塞消息
         elif isinstance(new_message, message.Choke):
             peer.handle_choke()
@@ -213,6 +706,10 @@ class PeersManager(Thread):
         # 处理拥有消息
         elif isinstance(new_message, message.Have):
             peer.handle_have(new_message)
+            # 超级做种时，对等方宣告拥有的片段可能是告知其他对等方的片段，说明该片段已经传播出去
+            seeder = self._super_seeder(peer.info_hash)
+            if seeder:
+                seeder.peer_has(peer, new_message.piece_index, self.peers)
         # 处理bitfield消息
         elif isinstance(new_message, message.BitField):
             peer.handle_bitfield(new_message)
@@ -224,10 +721,17 @@ class PeersManager(Thread):
             peer.handle_piece(new_message)
         # 处理撤销消息
         elif isinstance(new_message, message.Cancel):
-            peer.handle_cancel()
+            peer.handle_cancel(new_message)
         # 处理端口消息
         elif isinstance(new_message, message.Port):
-            peer.handle_port_request()
+            peer.handle_port_request(new_message)
+        # 处理v2种子的哈希消息，Hashes和HashReject是HashRequest的子类，需要先判断
+        elif isinstance(new_message, message.Hashes):
+            peer.handle_hashes(new_message)
+        elif isinstance(new_message, message.HashReject):
+            peer.handle_hash_reject(new_message)
+        elif isinstance(new_message, message.HashRequest):
+            peer.handle_hash_request(new_message)
 
         else:
             logging.error("Unknown message")
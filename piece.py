@@ -5,22 +5,35 @@ import math
 import time
 import logging
 
-from pubsub import pub
 from block import Block, BLOCK_SIZE, State
+import memory_budget
+import merkle
 
 
 class Piece(object):
-    def __init__(self, piece_index: int, piece_size: int, piece_hash: str):
+    def __init__(self, piece_index: int, piece_size: int, piece_hash: str, file_table=None, budget=None, tree=None):
         # 片段号
         self.piece_index: int = piece_index
         # 片段大小
         self.piece_size: int = piece_size
         # 片段哈希值
         self.piece_hash: str = piece_hash
+        # v2种子中片段对应的默克尔子树，存在时使用它校验片段和块，见merkle.PieceTree
+        self.tree = tree
         # 片段是否已完整下载
         self.is_full: bool = False
-        # 存储与该片段相关联的文件信息
-        self.files = []
+        # 文件段表，用于查找与该片段相关联的文件
+        self.file_table = file_table
+        # 内存预算，统计已收到的块占用的内存
+        self.budget = budget
+        # 已收到的块占用的内存
+        self.buffered_size: int = 0
+        # 上次校验失败时各块的来源和哈希值，以块偏移量为关键字，重新下载成功后用于找出发送坏数据的对等方
+        self.failed_blocks: dict = {}
+        # 上次校验失败时提供数据的对等方，重新下载时优先选择其他对等方
+        self.excluded_sources: list = []
+        # 重新下载成功后确认发送过坏数据的对等方
+        self.bad_sources: list = []
         # 该片段的原始数据
         self.raw_data: bytes = b''
         # 该片段包含的块数量
@@ -30,58 +43,70 @@ class Piece(object):
         # 初始化片段
         self._init_blocks()
 
-    # 如果数据块在一段时间内处于挂起状态，则重置数据块状态
-    def update_block_status(self):  # if block is pending for too long : set it free
-        for i, block in enumerate(self.blocks):
-            # 如果数据块挂起时间超过5秒则重置数据块
-            if block.state == State.PENDING and (time.time() - block.last_seen) > 5:
-                self.blocks[i] = Block()
+    # 请求超时后将挂起的数据块重置为未下载，由调度器重新请求
+    def free_block(self, block_offset):
+        index = int(block_offset / BLOCK_SIZE)
+        if not self.is_full and self.blocks and self.blocks[index].state == State.PENDING:
+            self.blocks[index].state = State.FREE
 
-    # 根据偏移量设置数据块的内容
-    def set_block(self, offset, data):
+    # 根据偏移量设置数据块的内容，v2种子中已知叶子哈希值的块校验失败时会被拒绝并返回False
+    def set_block(self, offset, data, source=None):
         # 计算块在片段中的编号
         index = int(offset / BLOCK_SIZE)
         # 如果片段未下载完成且当前块未下载完成，则存储收到的块数据并设置块状态为下载完成
         if not self.is_full and not self.blocks[index].state == State.FULL:
+            if self.tree:
+                leaf = merkle.sha256(data)
+                if self.tree.verify_block(index, leaf) is False or len(data) != self.blocks[index].block_size:
+                    logging.warning("Bad block %d in piece %d from %s" % (index, self.piece_index, source))
+                    self.blocks[index].state = State.FREE
+                    if source not in self.excluded_sources:
+                        self.excluded_sources.append(source)
+                    return False
+                self.blocks[index].hash = leaf
             self.blocks[index].data = data
             self.blocks[index].state = State.FULL
+            self.blocks[index].source = source
+            self.buffered_size += len(data)
+            if self.budget:
+                self.budget.acquire(memory_budget.PIECE_BUFFERS, len(data))
+        return True
+
+    # 记录对等方发来的叶子哈希值，校验通过后检查已收到的块，返回校验失败的块的(来源, 大小)
+    # 叶子哈希值本身校验失败时返回None
+    def set_block_hashes(self, hashes):
+        if self.is_full or not self.tree or not self.tree.set_block_hashes(hashes, self.number_of_blocks):
+            return None
+
+        bad_blocks = []
+        for index, block in enumerate(self.blocks):
+            if block.state == State.FULL and self.tree.verify_block(index, block.hash) is False:
+                bad_blocks.append((block.source, len(block.data)))
+                self.buffered_size -= len(block.data)
+                if self.budget:
+                    self.budget.release(memory_budget.PIECE_BUFFERS, len(block.data))
+                self.blocks[index] = Block(block_size=block.block_size)
+                if block.source not in self.excluded_sources:
+                    self.excluded_sources.append(block.source)
+        return bad_blocks
 
     # 根据偏移量和长度获取数据块内容
     def get_block(self, block_offset, block_length):
-        # BUG: 应当为
-        # return self.raw_data[block_offset:block_offset + block_length]
-        return self.raw_data[block_offset:block_length]
-        # BUG: 由于片段下载完后应当清空数据，这样会导致无法得到数据，详见pieces_manager.PiecesManager.update_bitfield
-        # 因此必须要实现从本地文件读取数据
-        # file_data_list = []
-        # for file in self.files:
-        #     # 文件路径
-        #     path_file = file["path"]
-        #     # 该片段中的文件数据在该文件中的偏移量
-        #     file_offset = file["fileOffset"]
-        #     # 该文件在该片段中的偏移量
-        #     piece_offset = file["pieceOffset"]
-        #     # 要写入的数据长度
-        #     length = file["length"]
-
-        #     try:
-        #         # 打开文件
-        #         f = open(path_file, 'rb')
-        #     except Exception:
-        #         logging.exception("Can't read file %s" % path_file)
-        #         return
-        #     # 将文件光标指向文件偏移量
-        #     f.seek(file_offset)
-        #     # 读取数据
-        #     data = f.read(length)
-        #     file_data_list.append((piece_offset, data))
-        #     f.close()
-        # # 根据偏移量升序排序
-        # file_data_list.sort(key=lambda x: x[0])
-        # # 将数据拼接成片段
-        # piece = b''.join([data for _, data in file_data_list])
-        # # 返回指定的块
-        # return piece[block_offset : block_offset + block_length]
+        # 已下载完成的片段会从内存中清空，此时需要从本地文件读取数据
+        if not self.raw_data:
+            piece = self._read_piece_from_disk()
+            if piece is None:
+                return None
+            return piece[block_offset:block_offset + block_length]
+
+        return self.raw_data[block_offset:block_offset + block_length]
+
+    # 判断片段是否已经开始下载，即有块正在下载或已下载完成
+    def is_started(self):
+        for block in self.blocks:
+            if block.state != State.FREE:
+                return True
+        return False
 
     # 获取一个未被占用的数据块信息
     def get_empty_block(self):
@@ -108,22 +133,50 @@ class Piece(object):
     def set_to_full(self):
         # 合并所有块
         data = self._merge_blocks()
-        # 若计算出的片段哈希值与记录不相同，则重置片段，重新下载
+        # 合并后块数据不再需要，写入队列占用的内存由片段管理器统计
+        self._release_buffers()
+        # 若计算出的片段哈希值与记录不相同，则记录各块的来源后重置片段，重新下载
         if not self._valid_blocks(data):
+            self._record_failed_blocks()
             self._init_blocks()
             return False
 
+        self._find_bad_sources(data)
         self.is_full = True
+        # 写入磁盘由片段管理器在磁盘线程中完成，见pieces_manager.PiecesManager._write_piece
         self.raw_data = data
-        # 将片段写入磁盘
-        self._write_piece_on_disk()
-        # 通知片段管理器更新bitfield
-        pub.sendMessage('PiecesManager.PieceCompleted', piece_index=self.piece_index)
 
         return True
 
+    # 记录校验失败时每个块的来源和哈希值
+    def _record_failed_blocks(self):
+        self.failed_blocks = {}
+        self.excluded_sources = []
+        for i, block in enumerate(self.blocks):
+            self.failed_blocks[i * BLOCK_SIZE] = (block.source, hashlib.sha1(block.data).digest())
+            if block.source not in self.excluded_sources:
+                self.excluded_sources.append(block.source)
+
+    # 校验通过后，与上次失败时的块逐一比较，数据不同的块的来源就是发送坏数据的对等方
+    def _find_bad_sources(self, data):
+        self.bad_sources = []
+        for block_offset, (source, block_hash) in self.failed_blocks.items():
+            block_size = self.blocks[block_offset // BLOCK_SIZE].block_size
+            good_hash = hashlib.sha1(data[block_offset:block_offset + block_size]).digest()
+            if good_hash != block_hash and source not in self.bad_sources:
+                self.bad_sources.append(source)
+        self.failed_blocks = {}
+        self.excluded_sources = []
+
+    # 释放已收到的块占用的内存预算
+    def _release_buffers(self):
+        if self.budget and self.buffered_size:
+            self.budget.release(memory_budget.PIECE_BUFFERS, self.buffered_size)
+        self.buffered_size = 0
+
     # 初始化片段
     def _init_blocks(self):
+        self._release_buffers()
         # 将块列表清空
         self.blocks = []
         # 增加空的块对象，如果块数量大于1则遍历增加
@@ -139,52 +192,76 @@ class Piece(object):
         else:
             self.blocks.append(Block(block_size=int(self.piece_size)))
 
-    # BUG: 用于清空已下载的片段在内存中的数据
-    # def clear(self):
-    #     self.raw_data = b''
-    #     self.blocks = []
-
-    #     if self.number_of_blocks > 1:
-    #         for _ in range(self.number_of_blocks):
-    #             self.blocks.append(Block(state=State.FULL))
-
-    #         # Last block of last piece, the special block
-    #         if (self.piece_size % BLOCK_SIZE) > 0:
-    #             self.blocks[self.number_of_blocks - 1].block_size = self.piece_size % BLOCK_SIZE
-
-    #     else:
-    #         self.blocks.append(Block(state=State.FULL, block_size=int(self.piece_size)))
-
-    # 将片段数据写入磁盘
-    def _write_piece_on_disk(self):
-        # 遍历片段中包含的文件
-        for file in self.files:
-            # 文件路径
-            path_file = file["path"]
-            # 该片段中的文件数据在该文件中的偏移量
-            file_offset = file["fileOffset"]
-            # 该文件在该片段中的偏移量
-            piece_offset = file["pieceOffset"]
-            # 要写入的数据长度
-            length = file["length"]
+    # 清空已下载的片段在内存中的数据，所有块标记为已下载完成
+    def clear(self):
+        self._release_buffers()
+        self.raw_data = b''
+        self.blocks = []
+
+        if self.number_of_blocks > 1:
+            for _ in range(self.number_of_blocks):
+                self.blocks.append(Block(state=State.FULL))
 
+            # Last block of last piece, the special block
+            if (self.piece_size % BLOCK_SIZE) > 0:
+                self.blocks[self.number_of_blocks - 1].block_size = self.piece_size % BLOCK_SIZE
+
+        else:
+            self.blocks.append(Block(state=State.FULL, block_size=int(self.piece_size)))
+
+    # 从本地文件读取整个片段的数据
+    def _read_piece_from_disk(self):
+        buf = bytearray()
+        # 文件段按照在片段中的偏移量升序返回，直接拼接即可
+        for file_index, file_offset, length, _ in self.file_table.piece_segments(self.piece_index, self.piece_size):
+            # 填充文件没有在磁盘上创建，数据全部为0
+            if self.file_table.pads[file_index]:
+                buf += bytes(length)
+                continue
+            # 不下载的文件的数据在部分文件中
+            path_file, file_offset = self.file_table.locate(file_index, file_offset)
             try:
-                # 尝试部分覆盖写入
-                # 有别于a+，r+在seek移动光标时，若光标超过当前文件长度，会在中间填充空比特，当光标在文件长度内，则会覆盖写入
-                # 这样即使片段写入的顺序不一样，也不会出现最终顺序乱的情况
-                f = open(path_file, 'r+b')  # Already existing file
-            except IOError:
-                # 无法追加写入，说明文件还未被创建，则使用覆盖写入
-                f = open(path_file, 'wb')  # New file
+                # 打开文件
+                f = open(path_file, 'rb')
             except Exception:
-                logging.exception("Can't write to file")
-                return
+                logging.exception("Can't read file %s" % path_file)
+                return None
             # 将文件光标指向文件偏移量
             f.seek(file_offset)
-            # 写入数据
-            f.write(self.raw_data[piece_offset:piece_offset + length])
+            # 读取数据
+            buf += f.read(length)
             f.close()
 
+        return bytes(buf)
+
+    # 将片段数据写入磁盘，写入失败时返回False
+    def write_piece_on_disk(self):
+        # 遍历片段中包含的文件段
+        for file_index, file_offset, length, piece_offset in self.file_table.piece_segments(self.piece_index,
+                                                                                              self.piece_size):
+            # 填充文件不写入磁盘
+            if self.file_table.pads[file_index]:
+                continue
+            # 不下载的文件的数据写入部分文件
+            path_file, file_offset = self.file_table.locate(file_index, file_offset)
+            try:
+                # 文件在第一次写入时才创建
+                with self.file_table.open_for_writing(path_file) as f:
+                    # 将文件光标指向文件偏移量
+                    f.seek(file_offset)
+                    # 写入数据
+                    f.write(self.raw_data[piece_offset:piece_offset + length])
+            except OSError:
+                logging.exception("Can't write to file %s" % path_file)
+                return False
+        return True
+
+    # 写入磁盘失败后重置片段，丢弃数据后重新下载
+    def reset(self):
+        self.is_full = False
+        self.raw_data = b''
+        self._init_blocks()
+
     # 拼接所有块的数据
     def _merge_blocks(self):
         buf = b''
@@ -194,13 +271,23 @@ class Piece(object):
 
         return buf
 
+    # 校验片段数据，v1种子比较SHA-1哈希值，v2种子比较默克尔子树的根哈希值
+    def verify(self, piece_raw_data):
+        if self.tree:
+            return self.tree.verify_leaves(merkle.leaf_hashes(piece_raw_data))
+        return hashlib.sha1(piece_raw_data).digest() == self.piece_hash
+
     # 计算片段哈希值，检查是否匹配
     def _valid_blocks(self, piece_raw_data):
-        hashed_piece_raw_data = hashlib.sha1(piece_raw_data).digest()
+        # v2种子的叶子哈希值在块到达时已经计算过，无需再次计算
+        if self.tree:
+            valid = self.tree.verify_leaves([block.hash for block in self.blocks])
+        else:
+            valid = self.verify(piece_raw_data)
 
-        if hashed_piece_raw_data == self.piece_hash:
+        if valid:
             return True
 
         logging.warning("Error Piece Hash")
-        logging.debug("{} : {}".format(hashed_piece_raw_data, self.piece_hash))
+        logging.debug("Piece %d : %s" % (self.piece_index, self.tree.root if self.tree else self.piece_hash))
         return False
@@ -0,0 +1,74 @@
+__author__ = 'alexisgallepe'
+
+from pubsub import pub
+import file_table
+
+# 每个种子最多记录的建议片段数量，超过时丢弃最早的建议
+MAX_SUGGESTED_PIECES = 32
+
+
+# 片段选择器，决定调度器请求片段的顺序
+# 流式读取的优先窗口排在最前面，越靠近读取位置的片段越先请求；
+# 之后是对等方建议的片段（BEP 6的SUGGEST_PIECE，通常已在对方的缓存中），其余片段先高优先级后普通优先级，按顺序排列
+# 不下载的片段（只属于不下载的文件）不会被选取，除非在流式读取的优先窗口中
+class PiecePicker(object):
+    def __init__(self, pieces_manager):
+        self.pieces_manager = pieces_manager
+        # 对等方建议的片段，按照收到的顺序排列
+        self.suggested_pieces = []
+        # 流式读取的优先窗口，以读取者为关键字，值为读取位置之后需要的片段，按需要的先后排列
+        self.priority_windows = {}
+
+        # events
+        # 订阅事件，记录对等方建议的片段
+        pub.subscribe(self.suggest_piece, 'PiecePicker.SuggestPiece')
+
+    # 记录对等方建议的片段，已下载的片段会被忽略
+    def suggest_piece(self, piece_index, info_hash):
+        # 多个种子共享同一个事件，只处理属于本种子的建议
+        if info_hash != self.pieces_manager.torrent.info_hash:
+            return
+        if piece_index >= self.pieces_manager.number_of_pieces or self.pieces_manager.pieces[piece_index].is_full:
+            return
+        if not self.pieces_manager.is_wanted(piece_index):
+            return
+        if piece_index in self.suggested_pieces:
+            return
+
+        self.suggested_pieces = (self.suggested_pieces + [piece_index])[-MAX_SUGGESTED_PIECES:]
+
+    # 设置读取者的优先窗口，pieces为空时移除
+    def set_priority_window(self, owner, pieces):
+        if pieces:
+            self.priority_windows[owner] = list(pieces)
+        else:
+            self.priority_windows.pop(owner, None)
+
+    # 合并所有读取者的优先窗口，各个窗口中排在第n位的片段先于排在第n+1位的片段，相当于按截止时间排列
+    def _priority_pieces(self):
+        pieces = self.pieces_manager.pieces
+        ranked = []
+        for window in list(self.priority_windows.values()):
+            window = [index for index in window if not pieces[index].is_full]
+            ranked.extend((rank, index) for rank, index in enumerate(window))
+        order = []
+        for _, index in sorted(ranked):
+            if index not in order:
+                order.append(index)
+        return order
+
+    # 获取还没有下载完成的片段，按照请求的优先顺序排列
+    def pick_order(self):
+        pieces = self.pieces_manager.pieces
+        self.suggested_pieces = [index for index in self.suggested_pieces
+                                 if not pieces[index].is_full and self.pieces_manager.is_wanted(index)]
+
+        order = self._priority_pieces()
+        order.extend(index for index in self.suggested_pieces if index not in order)
+        first = set(order)
+        # 其余需要下载的片段按优先级从高到低排列，同一优先级内按顺序排列，sorted是稳定排序
+        priorities = self.pieces_manager.piece_priorities
+        rest = [piece.piece_index for piece in pieces if not piece.is_full and piece.piece_index not in first
+                and priorities[piece.piece_index] > file_table.Priority.SKIP]
+        order.extend(sorted(rest, key=lambda index: -priorities[index]))
+        return order
@@ -1,80 +1,295 @@
 __author__ = 'alexisgallepe'
 
 import piece
+import disk_io
+import file_table
+import memory_budget
+import read_cache
+import merkle
+from block import BLOCK_SIZE
 import bitstring
 import logging
 from pubsub import pub
 
+# 对等方参与校验失败的片段达到该次数后被封禁
+MAX_HASH_FAILURES = 3
+
 
 class PiecesManager(object):
-    def __init__(self, torrent):
+    def __init__(self, torrent, disk=None, budget=None, priorities=None, cache=None):
         self.torrent = torrent
+        # 磁盘读写线程池，多个种子可以共享同一个
+        self.disk_io = disk if disk else disk_io.DiskIO()
+        # 内存预算，多个种子可以共享同一个
+        self.memory_budget = budget if budget else memory_budget.MemoryBudget()
+        # 上传时使用的读取缓存，多个种子可以共享同一个
+        self.read_cache = cache if cache else read_cache.ReadCache()
         self.number_of_pieces = int(torrent.number_of_pieces)
         self.bitfield = bitstring.BitArray(self.number_of_pieces)
+        # 加载文件信息为文件段表，片段通过它查找对应的文件
+        self.file_table = self._load_files()
+        # 每个片段的优先级，取片段所包含的文件中最高的优先级，为SKIP时不下载
+        self.piece_priorities = [file_table.Priority.NORMAL] * self.number_of_pieces
+        # v2种子的片段，以(文件的根哈希值, 第一个叶子节点的下标)为关键字，用于处理哈希请求和回应
+        self.pieces_by_root = {}
         # 片段列表初始化
         self.pieces = self._generate_pieces()
-        # 加载文件信息为列表
-        self.files = self._load_files()
         # 已完成的片段数量
         self.complete_pieces = 0
-
-        # 遍历文件并将它们关联到相应的数据片段
-        for file in self.files:
-            id_piece = file['idPiece']
-            self.pieces[id_piece].files.append(file)
+        # 因校验失败而丢弃的字节数
+        self.wasted_bytes = 0
+        # 各对等方参与校验失败的片段的次数，以IP地址:端口号为关键字
+        self.hash_failures = {}
+        # 设置每个文件的优先级，需要在重新校验和预分配之前完成
+        if priorities:
+            self.set_file_priorities(priorities)
 
         # events
         # 订阅事件，存储收到的块数据
         pub.subscribe(self.receive_block_piece, 'PiecesManager.Piece')
-        # 订阅事件，在收到片段下载完成的通知后更新bitfield
-        pub.subscribe(self.update_bitfield, 'PiecesManager.PieceCompleted')
+        # 订阅事件，处理v2种子的叶子哈希值
+        pub.subscribe(self.receive_hashes, 'PiecesManager.Hashes')
+        pub.subscribe(self.receive_hash_reject, 'PiecesManager.HashReject')
+        # 订阅事件，被拒绝或被丢弃的请求对应的块需要重新请求
+        pub.subscribe(self.free_requested_block, 'PiecesManager.RequestFreed')
+
+    # 设置多个文件的优先级，priorities为按文件顺序排列的列表，或以文件编号为关键字的字典
+    def set_file_priorities(self, priorities):
+        items = priorities.items() if isinstance(priorities, dict) else enumerate(priorities)
+        for file_index, priority in items:
+            if 0 <= file_index < len(self.file_table):
+                self.set_file_priority(file_index, priority)
+
+    # 设置文件的优先级，并重新计算该文件包含的片段的优先级
+    # 文件从不下载改为下载时，将已下载的边界片段中属于该文件的数据从部分文件移回原文件
+    def set_file_priority(self, file_index, priority):
+        if self.file_table.set_priority(file_index, priority):
+            self._move_out_of_part_file(file_index)
+
+        for piece_index in self.file_table.file_pieces(file_index):
+            self.piece_priorities[piece_index] = self._piece_priority(piece_index)
+
+    # 恢复上次运行时数据保存在部分文件中的文件，需要在bitfield加载之后调用
+    # priorities为上次保存的文件优先级，为None时保留当前的优先级；之后不再跳过的文件，其数据从部分文件移回原文件
+    def restore_part_files(self, part_files, priorities=None):
+        table = self.file_table
+        table.part_files.update(file_index for file_index in part_files if 0 <= file_index < len(table))
+        if priorities is not None:
+            self.set_file_priorities(priorities)
+        for file_index in sorted(table.part_files):
+            if table.priorities[file_index] != file_table.Priority.SKIP:
+                self.set_file_priority(file_index, table.priorities[file_index])
+
+    # 片段的优先级为片段所包含的需要下载的文件中最高的优先级
+    def _piece_priority(self, piece_index):
+        table = self.file_table
+        priority = file_table.Priority.SKIP
+        for file_index, _, _, _ in table.piece_segments(piece_index, self.pieces[piece_index].piece_size):
+            if table.is_wanted(file_index):
+                priority = max(priority, table.priorities[file_index])
+        return priority
+
+    # 将已写入磁盘的片段中属于该文件的数据从部分文件复制到原文件
+    def _move_out_of_part_file(self, file_index):
+        table = self.file_table
+        for piece_index in table.file_pieces(file_index):
+            if not self.bitfield[piece_index]:
+                continue
+            for segment_file, file_offset, length, _ in table.piece_segments(piece_index,
+                                                                               self.pieces[piece_index].piece_size):
+                if segment_file != file_index:
+                    continue
+                try:
+                    with open(table.part_path, 'rb') as part:
+                        part.seek(table.offsets[file_index] + file_offset)
+                        data = part.read(length)
+                    with table.open_for_writing(table.paths[file_index]) as f:
+                        f.seek(file_offset)
+                        f.write(data)
+                except OSError:
+                    logging.exception("Can't move piece %d out of part file" % piece_index)
+
+    # 片段是否需要下载
+    def is_wanted(self, piece_index):
+        return self.piece_priorities[piece_index] > file_table.Priority.SKIP
+
+    # 需要下载的片段数量
+    def wanted_pieces(self):
+        return sum(1 for priority in self.piece_priorities if priority > file_table.Priority.SKIP)
+
+    # 已完成的需要下载的片段数量
+    def completed_wanted_pieces(self):
+        return sum(1 for piece in self.pieces if piece.is_full and self.is_wanted(piece.piece_index))
 
     # 更新bitfield，将对应的片段置为1
     def update_bitfield(self, piece_index):
         self.bitfield[piece_index] = 1
-        # BUG: 应当清空片段中的数据，否则下载下来的文件仍然存在内存中
-        # 需要实现clear方法，前往piece.py查看注释
-        # 还要更改main.Client.display_progression，前往查看详情
-        # self.pieces[piece_index].clear()
+        # 清空片段中的数据，片段已写入磁盘，之后需要时从本地文件读取
+        self.pieces[piece_index].clear()
+
+    # 将本地文件中已有的片段直接标记为已下载，用于快速恢复和重新校验
+    def set_piece_completed(self, piece_index):
+        piece = self.pieces[piece_index]
+        if piece.is_full:
+            return
+
+        piece.is_full = True
+        piece.clear()
+        self.bitfield[piece_index] = 1
+        self.complete_pieces += 1
+
+    # 将片段写入磁盘，写入完成后更新bitfield，并通知其他模块
+    # 写入失败时片段被重置，之后重新下载，写入队列占用的内存预算无论成功与否都会释放
+    def _write_piece(self, piece_index):
+        piece = self.pieces[piece_index]
+        written = False
+        try:
+            written = piece.write_piece_on_disk()
+        except Exception:
+            logging.exception("Can't write piece %d" % piece_index)
+        finally:
+            self.memory_budget.release(memory_budget.WRITE_QUEUE, piece.piece_size)
+        if not written:
+            self.read_cache.discard((self.torrent.info_hash, piece_index))
+            piece.reset()
+            self.complete_pieces -= 1
+            return
+        self.update_bitfield(piece_index)
+        pub.sendMessage('PiecesManager.PieceCompleted', info_hash=self.torrent.info_hash, piece_index=piece_index)
 
     # 存储收到的块数据
-    def receive_block_piece(self, piece):
+    def receive_block_piece(self, piece, info_hash, source=None):
+        # 多个种子共享同一个事件，只处理属于本种子的块
+        if info_hash != self.torrent.info_hash:
+            return
         # 提取片段号，块在片段中的偏移量，块数据
         piece_index, piece_offset, piece_data = piece
 
         if self.pieces[piece_index].is_full:
             return
         # 将块数据存入片段
-        self.pieces[piece_index].set_block(piece_offset, piece_data)
+        # v2种子中校验失败的块会被立即拒绝，可以确定就是来源发送了坏数据
+        if not self.pieces[piece_index].set_block(piece_offset, piece_data, source):
+            self.wasted_bytes += len(piece_data)
+            self._ban_source(source)
+            return
         # 如果片段中的块已全部下载完成
         if self.pieces[piece_index].are_all_blocks_full():
             # 设置片段状态为下载完成
-            if self.pieces[piece_index].set_to_full():
+            if not self.pieces[piece_index].set_to_full():
+                self._handle_hash_failure(self.pieces[piece_index])
+            else:
+                # 重新下载成功后，封禁确认发送过坏数据的对等方
+                for bad_source in self.pieces[piece_index].bad_sources:
+                    self._ban_source(bad_source)
                 # 已完成的片段数量加1
                 self.complete_pieces +=1
+                # 刚下载的片段很可能马上被其他对等方请求，可以直接放入读取缓存
+                if self.read_cache.keep_verified:
+                    self.read_cache.put((self.torrent.info_hash, piece_index), self.pieces[piece_index].raw_data)
+                # 在磁盘线程中写入片段，写入完成前仍然从内存中提供该片段的数据
+                self.memory_budget.acquire(memory_budget.WRITE_QUEUE, self.pieces[piece_index].piece_size)
+                self.disk_io.submit(self._write_piece, piece_index)
+
+    # 将被拒绝或被丢弃的请求对应的块重置为未下载，调度器可以立即向其他对等方请求
+    def free_requested_block(self, piece_index, block_offset, info_hash):
+        if info_hash != self.torrent.info_hash or piece_index >= self.number_of_pieces:
+            return
+        self.pieces[piece_index].free_block(block_offset)
 
-    # 获取块数据
+    # 处理对等方发来的叶子哈希值，校验通过后用它检查已收到的块
+    def receive_hashes(self, hashes, info_hash, source=None):
+        if info_hash != self.torrent.info_hash or hashes.base_layer != 0:
+            return
+        target = self.pieces_by_root.get((hashes.pieces_root, hashes.index))
+        if not target or not target.tree or target.tree.block_hashes is not None:
+            return
+
+        bad_blocks = target.set_block_hashes(hashes.hashes[:hashes.length])
+        if bad_blocks is None:
+            logging.warning("Invalid hashes for piece %d from %s" % (target.piece_index, source))
+            target.tree.hashes_requested = 0.0
+            self._ban_source(source)
+            return
+        for bad_source, size in bad_blocks:
+            self.wasted_bytes += size
+            self._ban_source(bad_source)
+
+    # 对等方拒绝了哈希请求，允许向其他对等方请求
+    def receive_hash_reject(self, reject, info_hash):
+        if info_hash != self.torrent.info_hash:
+            return
+        target = self.pieces_by_root.get((reject.pieces_root, reject.index))
+        if target and target.tree:
+            target.tree.hashes_requested = 0.0
+
+    # 为对等方提供已下载片段的叶子哈希值，只支持请求一个完整片段的叶子层且不附带证明哈希值
+    def get_block_hashes(self, pieces_root, base_layer, index, length, proof_layers):
+        target = self.pieces_by_root.get((pieces_root, index))
+        if base_layer != 0 or proof_layers != 0 or not target or length != target.tree.leaf_count:
+            return None
+        if not self.bitfield[target.piece_index]:
+            return None
+
+        data = target.get_block(0, target.piece_size)
+        if data is None:
+            return None
+        leaves = merkle.leaf_hashes(data)
+        return leaves + [merkle.ZERO_HASH] * (length - len(leaves))
+
+    # 片段校验失败：统计浪费的字节数，记录参与的对等方
+    # 只有一个对等方提供数据时可以确定就是它，直接封禁；否则多次参与校验失败后封禁
+    def _handle_hash_failure(self, failed_piece):
+        self.wasted_bytes += failed_piece.piece_size
+        sources = [source for source in failed_piece.excluded_sources if source]
+        logging.warning("Piece %d failed hash check, sources : %s" % (failed_piece.piece_index, sources))
+
+        for source in sources:
+            self.hash_failures[source] = self.hash_failures.get(source, 0) + 1
+            if len(sources) == 1 or self.hash_failures[source] >= MAX_HASH_FAILURES:
+                self._ban_source(source)
+
+    # 通知对等方管理器封禁该对等方
+    def _ban_source(self, source):
+        if source:
+            pub.sendMessage('PeersManager.BanPeer', source=source)
+
+    # 获取块数据，只有已下载的片段才会发送块数据
+    # 启用读取缓存时读取并缓存整个片段，同一片段之后的请求直接从缓存中获取
     def get_block(self, piece_index, block_offset, block_length):
-        for piece in self.pieces:
-            if piece_index == piece.piece_index:
-                # 如果片段已满，才会发送块数据
-                if piece.is_full:
-                    return piece.get_block(block_offset, block_length)
-                else:
-                    break
+        if piece_index >= self.number_of_pieces or not self.pieces[piece_index].is_full:
+            return None
+        piece = self.pieces[piece_index]
+        if not self.read_cache.is_enabled():
+            return piece.get_block(block_offset, block_length)
+
+        key = (self.torrent.info_hash, piece_index)
+        data = self.read_cache.get(key)
+        if data is None:
+            data = piece.get_block(0, piece.piece_size)
+            if data is None:
+                return None
+            self.read_cache.put(key, data)
+        return data[block_offset:block_offset + block_length]
 
-        return None
+    # 上传时是否从读取缓存中提供该片段的数据，否则由上传管道直接从文件发送，见read_cache.ReadCache.admit
+    def is_upload_cached(self, piece_index, length):
+        return self.read_cache.is_enabled() and \
+            self.read_cache.admit((self.torrent.info_hash, piece_index), length, self.pieces[piece_index].piece_size)
 
-    # 判断是否所有片段都已下载
+    # 判断是否所有需要下载的片段都已下载
     def all_pieces_completed(self):
         for piece in self.pieces:
-            if not piece.is_full:
+            if not piece.is_full and self.is_wanted(piece.piece_index):
                 return False
 
         return True
 
     # 片段初始化
     def _generate_pieces(self):
+        if self.torrent.meta_version == 2:
+            return self._generate_pieces_v2()
+
         pieces = []
         # 最后一个片段的大小可能会小于正常大小，需要特殊处理
         last_piece = self.number_of_pieces - 1
@@ -83,66 +298,52 @@ class PiecesManager(object):
             # 每个片段的哈希值在种子中占20字节
             start = i * 20
             end = start + 20
+            # 种子中的哈希值是memoryview，每个片段只复制自己的20字节
+            piece_hash = bytes(self.torrent.pieces[start:end])
             # 如果是最后一个片段
             if i == last_piece:
-                # 片段大小为种子总大小减去前面片段的总大小
-                piece_length = self.torrent.total_length - (self.number_of_pieces - 1) * self.torrent.piece_length
-                pieces.append(piece.Piece(i, piece_length, self.torrent.pieces[start:end]))
+                # 片段大小为种子总大小（包括填充文件）减去前面片段的总大小
+                piece_length = self.file_table.total_length - (self.number_of_pieces - 1) * self.torrent.piece_length
+                pieces.append(piece.Piece(i, piece_length, piece_hash, self.file_table, self.memory_budget))
+            else:
+                pieces.append(piece.Piece(i, self.torrent.piece_length, piece_hash, self.file_table,
+                                          self.memory_budget))
+
+        return pieces
+
+    # v2种子的片段初始化，每个文件从新的片段开始，文件的最后一个片段不包含填充
+    # 片段使用默克尔子树校验，混合种子同样优先使用v2的哈希值
+    def _generate_pieces_v2(self):
+        pieces = [None] * self.number_of_pieces
+        piece_length = self.torrent.piece_length
+        blocks_per_piece = piece_length // BLOCK_SIZE
+
+        for file_index, file in enumerate(self.torrent.file_names):
+            if file.get("pad") or file["length"] == 0:
+                continue
+            offset = self.file_table.offsets[file_index]
+            length = file["length"]
+            pieces_root = file["pieces_root"]
+            # 只有一个片段的文件，片段子树就是整个文件的默克尔树
+            if length <= piece_length:
+                layer = [pieces_root]
+                leaf_count = merkle.next_power_of_two(-(-length // BLOCK_SIZE))
             else:
-                pieces.append(piece.Piece(i, self.torrent.piece_length, self.torrent.pieces[start:end]))
+                raw_layer = self.torrent.piece_layers[pieces_root]
+                layer = [raw_layer[i:i + 32] for i in range(0, len(raw_layer), 32)]
+                leaf_count = blocks_per_piece
+
+            for file_piece in range(-(-length // piece_length)):
+                index = offset // piece_length + file_piece
+                size = min(piece_length, length - file_piece * piece_length)
+                tree = merkle.PieceTree(layer[file_piece], leaf_count, pieces_root, file_piece * blocks_per_piece)
+                piece_hash = bytes(self.torrent.pieces[index * 20:index * 20 + 20]) if self.torrent.is_hybrid else b''
+                pieces[index] = piece.Piece(index, size, piece_hash, self.file_table, self.memory_budget, tree)
+                self.pieces_by_root[(pieces_root, tree.first_leaf)] = pieces[index]
 
         return pieces
 
-    # 处理文件信息
+    # 处理文件信息，生成文件段表
     def _load_files(self):
-        files = []
-        # 当前处理的总数据片段的偏移量
-        piece_offset = 0
-        # 已使用的片段大小
-        piece_size_used = 0
-        # 根据文件名遍历
-        for f in self.torrent.file_names:
-            # 文件大小
-            current_size_file = f["length"]
-            # 文件中的偏移量
-            file_offset = 0
-            # 如果当前文件还有未处理完的部分就继续循环
-            while current_size_file > 0:
-                # 计算当前偏移量对应的片段号
-                id_piece = int(piece_offset / self.torrent.piece_length)
-                # 计算当前片段中剩余的可用大小
-                piece_size = self.pieces[id_piece].piece_size - piece_size_used
-                # 如果文件剩余部分小于当前片段的剩余部分，片段没有被用完。这是文件的最后一部分
-                if current_size_file - piece_size < 0:
-                    # 记录文件信息
-                    file = {"length": current_size_file,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    # 更新偏移量
-                    piece_offset += current_size_file
-                    file_offset += current_size_file
-                    # 记录片段已被使用的大小
-                    piece_size_used += current_size_file
-                    current_size_file = 0
-                # 这是文件的普通部分，片段会被用完
-                else:
-                    # 剩余文件大小
-                    current_size_file -= piece_size
-                    # 记录文件信息
-                    file = {"length": piece_size,
-                            "idPiece": id_piece,
-                            "fileOffset": file_offset,
-                            "pieceOffset": piece_size_used,
-                            "path": f["path"]
-                            }
-                    # 更新偏移量
-                    piece_offset += piece_size
-                    file_offset += piece_size
-                    # 片段已被用完，重置为0
-                    piece_size_used = 0
-
-                files.append(file)
-        return files
+        part_path = self.torrent.torrent_file['info']['name'] + '.parts'
+        return file_table.FileTable(self.torrent.file_names, self.torrent.piece_length, part_path)
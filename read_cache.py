@@ -0,0 +1,99 @@
+__author__ = 'alexisgallepe'
+
+from collections import OrderedDict
+from threading import Lock
+
+# 默认的读取缓存大小（字节），为0时不缓存，上传时都通过sendfile直接从文件发送
+READ_CACHE_SIZE = 32 * 1024 * 1024
+# 最多记录的未缓存片段的请求量，用于判断片段是否被重复请求
+MAX_TRACKED_PIECES = 4096
+
+
+# 已下载片段的读取缓存，按最近最少使用的顺序淘汰
+# 片段第一次被上传时不缓存，由上传管道通过sendfile直接从文件发送；
+# 请求量超过片段大小，即片段被重复请求时，才读取整个片段并缓存，热门片段之后的请求无需再读取磁盘
+# 多个种子共享同一个缓存，以(种子哈希值, 片段号)为关键字
+class ReadCache(object):
+    def __init__(self, limit=READ_CACHE_SIZE, keep_verified=False):
+        # 缓存大小上限
+        self.limit = limit
+        # 是否缓存下载时刚校验通过的片段，做种时刚下载的片段往往也会被其他对等方请求
+        self.keep_verified = keep_verified
+        # 缓存的片段数据，按最近使用的顺序排列
+        self.pieces = OrderedDict()
+        # 缓存占用的字节数
+        self.size = 0
+        # 命中和未命中的次数
+        self.hits = 0
+        self.misses = 0
+        # 未缓存片段已被请求的字节数，按最近请求的顺序排列
+        self.requested = OrderedDict()
+        # 对等方管理器线程读取，主线程和磁盘线程写入
+        self.lock = Lock()
+
+    # 是否启用缓存
+    def is_enabled(self):
+        return self.limit > 0
+
+    # 获取缓存的片段数据，未缓存时返回None
+    def get(self, key):
+        with self.lock:
+            data = self.pieces.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.pieces.move_to_end(key)
+            self.hits += 1
+            return data
+
+    # 上传请求到达时判断是否通过缓存提供数据，已缓存或者被重复请求的片段返回True
+    # 其他片段返回False并记为未命中，由调用者直接从文件发送，不占用缓存
+    def admit(self, key, length, piece_size):
+        with self.lock:
+            if key in self.pieces:
+                return True
+            requested = self.requested.pop(key, 0) + length
+            self.requested[key] = requested
+            while len(self.requested) > MAX_TRACKED_PIECES:
+                self.requested.popitem(last=False)
+            if requested > piece_size:
+                return True
+            self.misses += 1
+            return False
+
+    # 缓存片段数据，超过上限时淘汰最久没有使用的片段
+    def put(self, key, data):
+        if len(data) > self.limit:
+            return
+        with self.lock:
+            old = self.pieces.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.pieces[key] = data
+            self.size += len(data)
+            self.requested.pop(key, None)
+            while self.size > self.limit:
+                _, evicted = self.pieces.popitem(last=False)
+                self.size -= len(evicted)
+
+    # 移除缓存的片段，例如片段写入磁盘失败、需要重新下载时
+    def discard(self, key):
+        with self.lock:
+            data = self.pieces.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+
+    # 命中率
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    # 获取统计信息
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hit_ratio(),
+            'used': self.size,
+            'limit': self.limit
+        }
@@ -0,0 +1,142 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 读取文件时使用的缓冲区大小，较大的顺序读取可以接近磁盘带宽
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+# 校验线程数量，hashlib在计算较大数据的哈希值时会释放GIL，因此多个线程能同时利用多个CPU核心
+RECHECK_WORKERS = os.cpu_count() or 4
+# 打印校验进度的间隔时间（秒）
+PROGRESS_INTERVAL = 2
+
+
+# 负责重新校验本地已有的数据
+# 按片段顺序顺序读取文件，通过片段管理器的文件段信息将字节范围映射到片段，然后在线程池中并行计算SHA-1
+class Recheck(object):
+    def __init__(self, torrent, pieces_manager, workers=RECHECK_WORKERS):
+        self.torrent = torrent
+        self.pieces_manager = pieces_manager
+        # 校验线程数量
+        self.workers = workers
+        # 当前打开的文件
+        self.current_path = None
+        self.current_file = None
+        # 无法打开的文件，避免重复尝试
+        self.missing_paths = set()
+        # 已读取的字节数，用于计算吞吐量
+        self.bytes_read = 0
+
+    # 校验所有片段，将校验通过的片段标记为已下载，返回校验通过的片段数量
+    def run(self):
+        # 没有任何文件存在就无需校验
+        paths = [file["path"] for file in self.torrent.file_names if not file.get("pad")]
+        paths.append(self.pieces_manager.file_table.part_path)
+        if not any(os.path.exists(path) for path in paths):
+            return 0
+
+        start_time = time.time()
+        last_progress = start_time
+        valid_pieces = 0
+        checked_pieces = 0
+        # 正在计算的片段，限制数量以免读取速度超过计算速度时占用过多内存
+        in_flight = deque()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for piece in self.pieces_manager.pieces:
+                if len(in_flight) >= self.workers * 2:
+                    valid_pieces += self._collect(in_flight.popleft())
+                    checked_pieces += 1
+
+                data = self._read_piece(piece)
+                if data is None:
+                    checked_pieces += 1
+                else:
+                    in_flight.append((piece.piece_index, executor.submit(self._check_piece, piece, data)))
+
+                now = time.time()
+                if now - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = now
+                    self._display_progression(checked_pieces, now - start_time)
+
+            while in_flight:
+                valid_pieces += self._collect(in_flight.popleft())
+                checked_pieces += 1
+
+        self._close_file()
+        self._display_progression(checked_pieces, time.time() - start_time)
+        logging.info("Recheck done : %d/%d pieces valid" % (valid_pieces, self.pieces_manager.number_of_pieces))
+        return valid_pieces
+
+    # 获取校验结果，校验通过就标记片段为已下载
+    def _collect(self, task):
+        piece_index, future = task
+        if future.result():
+            self.pieces_manager.set_piece_completed(piece_index)
+            return 1
+        return 0
+
+    # 计算片段哈希值，检查是否匹配，v1种子使用SHA-1，v2种子使用默克尔树
+    @staticmethod
+    def _check_piece(piece, data):
+        return piece.verify(data)
+
+    # 按照片段的文件段信息读取片段数据，任一文件缺失或长度不足时返回None
+    def _read_piece(self, piece):
+        buf = bytearray()
+        table = self.pieces_manager.file_table
+        for file_index, file_offset, length, _ in table.piece_segments(piece.piece_index, piece.piece_size):
+            # 填充文件没有在磁盘上创建，数据全部为0
+            if table.pads[file_index]:
+                buf += bytes(length)
+                continue
+            path_file, file_offset = table.locate(file_index, file_offset)
+            f = self._open_file(path_file)
+            if f is None:
+                return None
+            # 文件段是按顺序排列的，只有切换文件或者跳过数据时才需要移动光标
+            if f.tell() != file_offset:
+                f.seek(file_offset)
+            data = f.read(length)
+            self.bytes_read += len(data)
+            if len(data) < length:
+                return None
+            buf += data
+
+        return bytes(buf)
+
+    # 打开文件，同一时间只保持一个文件打开
+    def _open_file(self, path):
+        if path == self.current_path:
+            return self.current_file
+
+        self._close_file()
+        if path in self.missing_paths:
+            return None
+
+        try:
+            self.current_file = open(path, 'rb', buffering=READ_BUFFER_SIZE)
+        except OSError:
+            self.missing_paths.add(path)
+            return None
+        # 告知内核将会顺序读取，以便提前预读
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self.current_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.current_path = path
+        return self.current_file
+
+    def _close_file(self):
+        if self.current_file:
+            self.current_file.close()
+        self.current_file = None
+        self.current_path = None
+
+    # 显示校验进度和吞吐量
+    def _display_progression(self, checked_pieces, elapsed):
+        throughput = self.bytes_read / elapsed / 1024 / 1024 if elapsed > 0 else 0
+        print("Rechecking: {}/{} pieces | {} MiB/s".format(checked_pieces,
+                                                            self.pieces_manager.number_of_pieces,
+                                                            round(throughput, 2)))
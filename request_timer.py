@@ -0,0 +1,30 @@
+__author__ = 'alexisgallepe'
+
+import heapq
+import itertools
+import time
+
+
+# 挂起请求的截止时间堆，只需处理已经超时的请求，不必每次遍历所有片段的所有块
+class RequestTimer(object):
+    def __init__(self):
+        # 堆中的元素为(截止时间, 序号, 对等方, (片段号, 块偏移量), 发送请求的时间)
+        # 序号保证截止时间相同时不会比较对等方对象
+        self.heap = []
+        self.counter = itertools.count()
+
+    # 记录一个请求及其截止时间
+    def add(self, peer, key, requested_at, timeout):
+        heapq.heappush(self.heap, (requested_at + timeout, next(self.counter), peer, key, requested_at))
+
+    # 取出所有已超时的请求，已收到回应的请求由调用者通过发送请求的时间判断后忽略
+    def pop_expired(self, now=None):
+        now = now if now is not None else time.time()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, peer, key, requested_at = heapq.heappop(self.heap)
+            expired.append((peer, key, requested_at))
+        return expired
+
+    def __len__(self):
+        return len(self.heap)
@@ -0,0 +1,122 @@
+__author__ = 'alexisgallepe'
+
+import os
+import logging
+from bcoding import bencode
+from block import BLOCK_SIZE
+from torrent_decoder import TorrentDecoder
+
+# 定期保存恢复数据的间隔时间（秒）
+RESUME_SAVE_INTERVAL = 60
+# 恢复数据中的二进制字段，即使恰好能以utf-8解码也保持为字节串
+BINARY_KEYS = {'info_hash', 'bitfield', 'data'}
+
+
+# 负责快速恢复数据的保存和加载
+# 恢复数据记录本客户端的bitfield、每个文件的大小和修改时间、每个文件的优先级和数据保存在部分文件中的文件，
+# 以及可选的未下载完成片段的块数据
+# 重启时如果文件与记录相符，就直接将片段标记为已下载，无需重新计算哈希值
+class ResumeData(object):
+    def __init__(self, torrent, pieces_manager, path=None, save_partial_pieces=True):
+        self.torrent = torrent
+        self.pieces_manager = pieces_manager
+        # 恢复数据文件路径，默认保存在下载目录旁边
+        self.path = path if path else self.torrent.torrent_file['info']['name'] + '.resume'
+        # 是否保存未下载完成的片段中已收到的块
+        self.save_partial_pieces = save_partial_pieces
+
+    # 将恢复数据写入磁盘，先写入临时文件再替换，防止中途退出导致文件损坏
+    def save(self):
+        contents = {
+            'info_hash': self.torrent.info_hash,
+            'bitfield': self.pieces_manager.bitfield.tobytes(),
+            'files': self._get_files_state(),
+            'priorities': [int(priority) for priority in self.pieces_manager.file_table.priorities],
+            'part_files': sorted(self.pieces_manager.file_table.part_files),
+            'partial_pieces': self._get_partial_pieces() if self.save_partial_pieces else []
+        }
+
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(bencode(contents))
+            os.replace(temp_path, self.path)
+        except Exception:
+            logging.exception("Can't save resume data")
+            return False
+
+        logging.debug("Resume data saved : %s" % self.path)
+        return True
+
+    # 加载恢复数据，文件与记录不符时返回False，需要重新校验或重新下载
+    # restore_priorities为True时恢复上次保存的文件优先级，用于没有指定文件优先级时
+    def load(self, restore_priorities=False):
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'rb') as f:
+                contents = TorrentDecoder(f.read(), BINARY_KEYS).decode()
+            info_hash = bytes(contents['info_hash'])
+            bitfield = bytes(contents['bitfield'])
+            partial_pieces = [(partial_piece['index'], [(block['offset'], bytes(block['data']))
+                                                        for block in partial_piece['blocks']])
+                              for partial_piece in contents['partial_pieces']]
+        except Exception:
+            logging.exception("Can't read resume data")
+            return False
+
+        if info_hash != self.torrent.info_hash:
+            logging.warning("Resume data belongs to another torrent")
+            return False
+        # 任何一个文件的大小或修改时间变化，都说明记录已经过期
+        if contents['files'] != self._get_files_state() or len(bitfield) * 8 < self.pieces_manager.number_of_pieces:
+            logging.warning("Resume data is out of date")
+            return False
+
+        for piece in self.pieces_manager.pieces:
+            index = piece.piece_index
+            # bitfield的第0位代表第1个片段，每个字节从高位开始
+            if bitfield[index // 8] & (0x80 >> (index % 8)):
+                self.pieces_manager.set_piece_completed(index)
+        # 上次运行时不下载的文件在边界片段中的数据保存在部分文件中，需要在读取片段之前恢复
+        # 不再跳过的文件的数据会被移回原文件
+        self.pieces_manager.restore_part_files(contents.get('part_files', []),
+                                               contents.get('priorities') if restore_priorities else None)
+
+        for index, blocks in partial_pieces:
+            if not 0 <= index < self.pieces_manager.number_of_pieces:
+                continue
+            piece = self.pieces_manager.pieces[index]
+            for block_offset, data in blocks:
+                piece.set_block(block_offset, data)
+
+        logging.info("Resume data loaded : %d/%d pieces" % (self.pieces_manager.complete_pieces,
+                                                             self.pieces_manager.number_of_pieces))
+        return True
+
+    # 获取每个文件以及部分文件的大小和修改时间，文件不存在时记为-1
+    def _get_files_state(self):
+        paths = [file["path"] for file in self.torrent.file_names if not file.get("pad")]
+        paths.append(self.pieces_manager.file_table.part_path)
+        files = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                files.append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+            except OSError:
+                files.append({'path': path, 'size': -1, 'mtime': -1})
+        return files
+
+    # 获取未下载完成的片段中已收到的块
+    def _get_partial_pieces(self):
+        partial_pieces = []
+        for piece in self.pieces_manager.pieces:
+            if piece.is_full:
+                continue
+
+            blocks = [{'offset': block_index * BLOCK_SIZE, 'data': block.data}
+                      for block_index, block in enumerate(piece.blocks) if block.data]
+            if blocks:
+                partial_pieces.append({'index': piece.piece_index, 'blocks': blocks})
+        return partial_pieces
@@ -0,0 +1,238 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import logging
+import choker
+import dht
+import disk_io
+import download
+import file_table
+import lsd
+import memory_budget
+import peers_manager
+import read_cache
+import torrent
+import utp
+
+# 扫描监视目录的间隔时间（秒）
+WATCH_INTERVAL = 5
+# 打印统计信息的间隔时间（秒）
+STATS_INTERVAL = 10
+
+
+# 在同一个进程中管理多个种子
+# 所有种子共享同一个对等方管理器（事件循环和监听端口）、磁盘读写线程池，以及全局的连接数和上传名额上限
+class Session(object):
+    def __init__(self, listen_port=peers_manager.LISTEN_PORT, max_peers=peers_manager.MAX_PEERS_CONNECTED,
+                 max_inbound_peers=peers_manager.MAX_INBOUND_PEERS, upload_slots=choker.UPLOAD_SLOTS,
+                 allocation=file_table.Allocation.SPARSE, memory_limit=memory_budget.MEMORY_BUDGET,
+                 enable_dht=True, dht_bootstrap_nodes=None, dht_state_path=dht.STATE_PATH, enable_lsd=True,
+                 enable_utp=True, read_cache_size=read_cache.READ_CACHE_SIZE, cache_verified_pieces=False,
+                 seed=False):
+        self.disk_io = disk_io.DiskIO()
+        # 所有种子共享的内存预算
+        self.memory_budget = memory_budget.MemoryBudget(memory_limit)
+        # 所有种子共享的上传读取缓存
+        self.read_cache = read_cache.ReadCache(read_cache_size, cache_verified_pieces)
+        # 新种子的文件分配方式
+        self.allocation = allocation
+        # 所有种子下载完成后是否继续做种，直到被中断
+        self.seed = seed
+        self.peers_manager = peers_manager.PeersManager(listen_port=listen_port,
+                                                        max_inbound_peers=max_inbound_peers,
+                                                        max_peers=max_peers,
+                                                        upload_slots=upload_slots,
+                                                        budget=self.memory_budget)
+        # DHT节点，与对等方管理器共享事件循环，找到的对等方加入同一个候选列表
+        self.dht = None
+        if enable_dht:
+            self._start_dht(listen_port, dht_bootstrap_nodes, dht_state_path)
+        # uTP传输，与DHT共享UDP端口
+        self.utp = None
+        if enable_utp:
+            self._start_utp(listen_port)
+        # 本地服务发现，在局域网内寻找分享同一个种子的对等方
+        self.lsd = None
+        if enable_lsd:
+            self._start_lsd()
+        # 正在下载或做种的种子，以种子哈希值为关键字
+        self.downloads = {}
+        # 监视目录，其中新出现的种子文件会被自动加入
+        self.watch_dir = None
+        # 监视目录中已经加入的种子文件
+        self.watched_files = set()
+        # 监视目录中加载失败的种子文件，值为失败时文件的(大小, 修改时间)，文件变化后重试
+        self.failed_watch_files = {}
+        # 上次扫描监视目录的时间
+        self.last_watch_scan = 0.0
+        # 上次打印统计信息的时间
+        self.last_stats = time.time()
+
+    # 创建DHT节点，使用与监听端口相同的UDP端口，失败时只通过tracker和PEX获取对等方
+    def _start_dht(self, port, bootstrap_nodes, state_path):
+        try:
+            self.dht = dht.DHT(self.peers_manager, port, state_path, bootstrap_nodes)
+        except OSError as e:
+            logging.error("Failed to start DHT on port %d : %s" % (port, e.__str__()))
+            return
+        self.peers_manager.register_service(self.dht)
+        self.peers_manager.dht_port = port
+
+    # 创建uTP传输，启用DHT时共享DHT的UDP套接字，由DHT转交uTP数据包
+    def _start_utp(self, port):
+        try:
+            self.utp = utp.UTP(self.peers_manager, port, self.dht.socket if self.dht else None)
+        except OSError as e:
+            logging.error("Failed to start uTP on port %d : %s" % (port, e.__str__()))
+            return
+        if self.dht:
+            self.dht.other_packet_handler = self.utp.handle_packet
+        self.peers_manager.register_service(self.utp)
+        self.peers_manager.utp = self.utp
+
+    # 加入本地服务发现的组播组，失败时（例如没有组播路由）只使用其他方式获取对等方
+    def _start_lsd(self):
+        try:
+            self.lsd = lsd.LSD(self.peers_manager)
+        except OSError as e:
+            logging.error("Failed to start local service discovery : %s" % e.__str__())
+            return
+        self.peers_manager.register_service(self.lsd)
+
+    # 增加一个种子，重复的种子会被忽略，file_priorities为每个文件的优先级，见file_table.Priority
+    # super_seed为True时，拥有全部片段后以超级做种的方式做种（BEP 16）
+    # 先只解析种子文件，重复的种子不会创建片段管理器，也不会重新校验或替换已有种子的状态
+    def add_torrent(self, torrent_file, file_priorities=None, super_seed=False):
+        try:
+            new_torrent = torrent.Torrent().load_from_path(torrent_file)
+        except Exception:
+            logging.exception("Can't load torrent %s" % torrent_file)
+            return None
+
+        info_hash = new_torrent.info_hash
+        if info_hash in self.downloads:
+            logging.warning("Torrent already added : %s" % torrent_file)
+            return self.downloads[info_hash]
+
+        try:
+            new_download = download.Download(new_torrent, self.peers_manager, self.disk_io, self.allocation,
+                                             self.memory_budget, file_priorities, self.read_cache,
+                                             super_seed)
+        except Exception:
+            logging.exception("Can't load torrent %s" % torrent_file)
+            return None
+
+        self.downloads[info_hash] = new_download
+        # 会话已经启动时立即开始获取对等方
+        if self.peers_manager.is_alive():
+            new_download.start()
+        return new_download
+
+    # 设置监视目录
+    def watch(self, directory):
+        self.watch_dir = directory
+
+    # 扫描监视目录，加入新出现的种子文件
+    # 还在复制中的种子文件会加载失败，等文件的大小或修改时间变化后重试
+    def _scan_watch_dir(self):
+        now = time.time()
+        if not self.watch_dir or now - self.last_watch_scan < WATCH_INTERVAL:
+            return
+        self.last_watch_scan = now
+
+        for file_name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, file_name)
+            if not file_name.endswith('.torrent') or path in self.watched_files:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self.failed_watch_files.get(path) == state:
+                continue
+
+            logging.info("New torrent in watch directory : %s" % path)
+            if self.add_torrent(path) is not None:
+                self.watched_files.add(path)
+                self.failed_watch_files.pop(path, None)
+            else:
+                self.failed_watch_files[path] = state
+
+    # 获取会话的统计信息
+    def get_stats(self):
+        return {
+            'memory': self.memory_budget.stats(),
+            'read_cache': self.read_cache.stats(),
+            'peers': len(self.peers_manager.peers),
+            'torrents': len(self.downloads),
+            'wasted_bytes': sum(d.pieces_manager.wasted_bytes for d in self.downloads.values()),
+            'banned_peers': list(self.peers_manager.banned_ips),
+            'dht_nodes': len(self.dht.routing_table) if self.dht else 0,
+            'utp_peers': sum(1 for peer in self.peers_manager.peers if peer.is_utp)
+        }
+
+    # 定期打印统计信息
+    def display_stats(self):
+        now = time.time()
+        if now - self.last_stats < STATS_INTERVAL:
+            return
+        self.last_stats = now
+
+        stats = self.get_stats()
+        print("Session: {} torrent(s) - {} peer(s) | memory {}/{} MiB | read cache {}/{} MiB, {}% hits | wasted {} KiB | {} banned peer(s) | {} DHT node(s) | {} uTP peer(s)".format(
+            stats['torrents'],
+            stats['peers'],
+            round(stats['memory']['used'] / 1024 / 1024, 1),
+            round(stats['memory']['limit'] / 1024 / 1024, 1),
+            round(stats['read_cache']['used'] / 1024 / 1024, 1),
+            round(stats['read_cache']['limit'] / 1024 / 1024, 1),
+            round(stats['read_cache']['hit_ratio'] * 100, 1),
+            stats['wasted_bytes'] // 1024,
+            len(stats['banned_peers']),
+            stats['dht_nodes'],
+            stats['utp_peers']
+        ))
+
+    # 判断是否所有种子都已下载完成
+    def all_downloads_completed(self):
+        for current_download in self.downloads.values():
+            if not current_download.pieces_manager.all_pieces_completed():
+                return False
+        return True
+
+    # 会话是否需要继续运行：有监视目录、继续做种、有种子在超级做种，或者还有种子没有下载完成
+    def _should_run(self):
+        return self.watch_dir or self.seed or self.peers_manager.super_seeders \
+            or not self.all_downloads_completed()
+
+    # 启动会话，没有监视目录且不做种时，所有种子下载完成后退出
+    def start(self):
+        self._scan_watch_dir()
+        self.peers_manager.start()
+        logging.info("PeersManager Started")
+
+        for current_download in list(self.downloads.values()):
+            current_download.start()
+
+        while self._should_run():
+            self._scan_watch_dir()
+
+            for current_download in list(self.downloads.values()):
+                current_download.update()
+            self.display_stats()
+
+            time.sleep(0.1)
+
+        for current_download in self.downloads.values():
+            current_download.display_progression()
+
+    # 保存所有种子的恢复数据和DHT路由表，等待磁盘写入完成后停止对等方管理器
+    def close(self):
+        self.disk_io.close()
+        for current_download in self.downloads.values():
+            current_download.close()
+        if self.dht:
+            self.dht.close()
+        self.peers_manager.is_active = False
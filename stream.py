@@ -0,0 +1,153 @@
+__author__ = 'alexisgallepe'
+
+import io
+import time
+import asyncio
+from threading import Condition
+from pubsub import pub
+
+# 流式读取时，读取位置之后优先下载的数据量
+READAHEAD_SIZE = 8 * 1024 * 1024
+# 优先窗口至少包含的片段数量
+MIN_READAHEAD_PIECES = 2
+# 等待片段下载完成时的检查间隔（秒）
+WAIT_INTERVAL = 1
+
+
+# 流式读取种子中的一个文件，读取位置之后的片段会被优先下载
+# 读取时只等待读取位置所在的片段校验通过并写入磁盘，然后立即返回该片段中的数据，不必等待整个文件下载完成
+# 可以用io.BufferedReader包装；下载由会话循环进行，读取应在其他线程中调用
+class FileStream(io.RawIOBase):
+    def __init__(self, download, file_index, readahead=READAHEAD_SIZE, timeout=None):
+        super(FileStream, self).__init__()
+        self.pieces_manager = download.pieces_manager
+        self.piece_picker = download.piece_picker
+        self.info_hash = download.torrent.info_hash
+        self.piece_length = download.torrent.piece_length
+        file_table = self.pieces_manager.file_table
+        self.path = file_table.paths[file_index]
+        # 文件在整个种子数据中的起始偏移量和文件长度
+        self.start = file_table.offsets[file_index]
+        self.length = file_table.lengths[file_index]
+        # 读取位置之后优先下载的数据量
+        self.readahead = readahead
+        # 等待一个片段的最长时间（秒），为None时一直等待
+        self.timeout = timeout
+        self.position = 0
+        self.file = None
+        # 片段下载完成时唤醒等待的读取
+        self.condition = Condition()
+        self._update_window()
+
+        # events
+        # 订阅事件，片段写入磁盘后唤醒等待的读取
+        pub.subscribe(self._piece_completed, 'PiecesManager.PieceCompleted')
+
+    def _piece_completed(self, info_hash, piece_index):
+        if info_hash != self.info_hash:
+            return
+        with self.condition:
+            self.condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        self._update_window()
+        return self.position
+
+    # 读取位置所在片段中的数据，最多读取到该片段末尾
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        size = min(len(buffer), self.length - self.position)
+        if size <= 0:
+            return 0
+
+        absolute = self.start + self.position
+        piece_index = absolute // self.piece_length
+        size = min(size, (piece_index + 1) * self.piece_length - absolute)
+        self._wait_for_piece(piece_index)
+
+        # 不使用缓冲，避免读到缓冲区中片段写入之前的旧数据
+        if not self.file:
+            self.file = open(self.path, 'rb', buffering=0)
+        self.file.seek(self.position)
+        data = self.file.read(size)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self._update_window()
+        return len(data)
+
+    # 等待片段校验通过并写入磁盘
+    def _wait_for_piece(self, piece_index):
+        deadline = time.time() + self.timeout if self.timeout is not None else None
+        with self.condition:
+            while not self.pieces_manager.bitfield[piece_index]:
+                if self.closed:
+                    raise ValueError("I/O operation on closed file.")
+                if deadline is not None and time.time() >= deadline:
+                    raise TimeoutError("Piece %d is not available yet" % piece_index)
+                self.condition.wait(WAIT_INTERVAL)
+
+    # 将读取位置之后还没有下载的片段设为优先窗口，越靠近读取位置越先下载
+    def _update_window(self):
+        if self.position >= self.length:
+            self.piece_picker.set_priority_window(self, None)
+            return
+        first = (self.start + self.position) // self.piece_length
+        last = (self.start + self.length - 1) // self.piece_length
+        count = max(self.readahead // self.piece_length, MIN_READAHEAD_PIECES)
+        window = [index for index in range(first, min(first + count, last + 1))
+                  if not self.pieces_manager.bitfield[index]]
+        self.piece_picker.set_priority_window(self, window)
+
+    def close(self):
+        if self.closed:
+            return
+        self.piece_picker.set_priority_window(self, None)
+        pub.unsubscribe(self._piece_completed, 'PiecesManager.PieceCompleted')
+        if self.file:
+            self.file.close()
+        super(FileStream, self).close()
+        with self.condition:
+            self.condition.notify_all()
+
+
+# FileStream的异步版本，阻塞的等待和读取在线程池中进行
+class AsyncFileStream(object):
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def read(self, size=-1):
+        return await asyncio.get_running_loop().run_in_executor(None, self.stream.read, size)
+
+    async def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    async def tell(self):
+        return self.stream.tell()
+
+    async def close(self):
+        self.stream.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
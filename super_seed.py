@@ -0,0 +1,81 @@
+__author__ = 'alexisgallepe'
+
+import time
+import random
+import message
+
+# 告知对等方的片段超过该时间（秒）仍没有被其他对等方宣告拥有，而该对等方已经下载完成时，直接告知新的片段
+# 例如能够从它那里下载的对等方断开了连接，或者下载者之间没有互相连接
+SUPER_SEED_TIMEOUT = 30
+
+
+# 超级做种（BEP 16），用于新发布的种子只有本客户端一个做种者时
+# 不发送完整的位场，每个对等方每次只通过HAVE消息告知一个片段，且只上传告知过的片段
+# 告知某个对等方的片段被其他对等方宣告拥有，说明它已经开始传播，此时才告知该对等方新的片段
+# 这样在群体拥有完整的分布式副本之前，本客户端上传的数据量接近种子大小的一倍
+class SuperSeeder(object):
+    def __init__(self, pieces_manager):
+        self.pieces_manager = pieces_manager
+        # 每个片段被告知给对等方的次数
+        self.offered = [0] * pieces_manager.number_of_pieces
+
+    # 只有在本客户端拥有全部片段时才超级做种，否则按普通方式告知片段
+    def is_active(self):
+        return self.pieces_manager.bitfield.all(True)
+
+    # 对等方只能请求告知过它的片段
+    def can_upload(self, peer, piece_index):
+        return piece_index in peer.super_seed_pieces
+
+    # 握手后告知对等方第一个片段
+    def peer_handshaked(self, peer, peers):
+        self._offer(peer, self._torrent_peers(peer.info_hash, peers))
+
+    # 对等方宣告拥有某个片段
+    # 告知给其他对等方的该片段已经传播出去，为它们告知新的片段
+    # 对等方下载完告知给它的片段，而其他对等方都已经拥有该片段（例如只有一个对等方）时，片段无法再传播，直接告知新的片段
+    def peer_has(self, peer, piece_index, peers):
+        torrent_peers = self._torrent_peers(peer.info_hash, peers)
+        for other in torrent_peers:
+            if other is not peer and self._waiting_piece(other) == piece_index:
+                self._offer(other, torrent_peers)
+        if self._waiting_piece(peer) == piece_index and \
+                all(other.has_piece(piece_index) for other in torrent_peers if other is not peer):
+            self._offer(peer, torrent_peers)
+
+    # 由对等方管理器定期调用，已经下载完告知的片段、但等待传播超时的对等方会被告知新的片段
+    def update(self, info_hash, peers):
+        now = time.time()
+        torrent_peers = self._torrent_peers(info_hash, peers)
+        for peer in torrent_peers:
+            index = self._waiting_piece(peer)
+            if index is not None and peer.has_piece(index) and now - peer.super_seed_offered_at > SUPER_SEED_TIMEOUT:
+                self._offer(peer, torrent_peers)
+
+    # 该种子已握手的对等方
+    @staticmethod
+    def _torrent_peers(info_hash, peers):
+        return [p for p in peers if p.info_hash == info_hash and p.has_handshaked]
+
+    # 最后告知对等方、正在等待传播的片段
+    @staticmethod
+    def _waiting_piece(peer):
+        return peer.super_seed_pieces[-1] if peer.super_seed_pieces else None
+
+    # 选择对等方没有的片段中被告知次数和拥有的对等方最少的片段，通过HAVE消息告知
+    # 没有可以告知的片段时也记录时间，避免每次更新都重新查找
+    def _offer(self, peer, peers):
+        peer.super_seed_offered_at = time.time()
+        availability = {}
+        for index in range(self.pieces_manager.number_of_pieces):
+            if peer.has_piece(index) or index in peer.super_seed_pieces:
+                continue
+            availability[index] = self.offered[index] + sum(1 for p in peers if p.has_piece(index))
+        if not availability:
+            return
+
+        rarest = min(availability.values())
+        index = random.choice([i for i, count in availability.items() if count == rarest])
+        self.offered[index] += 1
+        peer.super_seed_pieces.append(index)
+        peer.send_to_peer(message.Have(index).to_bytes())
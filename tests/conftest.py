@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import select
+import socket
+import struct
+import hashlib
+
+# 模块直接放在仓库根目录下，测试从根目录导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bcoding import bencode
+from block import BLOCK_SIZE
+import message
+import extension
+
+# 测试对等方为ut_pex分配的扩展消息编号，与本客户端的编号不同
+PEER_PEX_ID = 3
+
+
+# 代替对等方管理器的事件循环，驱动各个服务直到condition成立或超时，返回condition的结果
+def pump(services, condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        sockets = {}
+        for service in services:
+            for sock in service.sockets():
+                sockets[sock] = service
+        readable, _, _ = select.select(list(sockets), [], [], 0.01)
+        for sock in readable:
+            sockets[sock].handle_readable(sock)
+        for service in services:
+            service.update()
+        if condition():
+            return True
+    return condition()
+
+
+# 等待condition成立或超时，用于等待在其他线程中运行的对等方管理器，返回condition的结果
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+# 在线程中运行对等方管理器，返回实际监听的端口号
+def start_manager(manager):
+    manager.start()
+    return manager.listen_socket.getsockname()[1]
+
+
+def stop_manager(manager):
+    manager.is_active = False
+    manager.join()
+    manager.listen_socket.close()
+    for peer in manager.peers:
+        peer.socket.close()
+
+
+# 在回环地址上直接收发消息的对等方，发起连接后发送握手消息
+# 指定listen_port时还会发送扩展握手，告知监听端口并为ut_pex分配编号PEER_PEX_ID
+class WirePeer(object):
+    def __init__(self, port, info_hash, listen_port=None, reserved=None):
+        self.socket = socket.create_connection(('127.0.0.1', port), timeout=10)
+        self.read_buffer = b''
+        # 收到的握手消息
+        self.handshake = None
+        self.messages = []
+        # 对方是否已经关闭连接
+        self.closed = False
+        data = message.Handshake(info_hash, reserved=reserved).to_bytes()
+        if listen_port is not None:
+            handshake = bencode({'m': {'ut_pex': PEER_PEX_ID}, 'p': listen_port})
+            data += message.ExtendedMessage(extension.EXTENDED_HANDSHAKE_ID, handshake).to_bytes()
+        self.send(data)
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    # 收到的某种消息，不包括子类，例如AllowedFast不算作Have
+    def received(self, message_class):
+        return [m for m in self.messages if type(m) is message_class]
+
+    # 收到的PEX消息，每项为(新增的地址, 断开的地址)
+    def pex_messages(self):
+        return [extension.parse_pex(m.payload) for m in self.received(message.ExtendedMessage)
+                if m.extended_id == PEER_PEX_ID]
+
+    # 接收消息直到condition成立、连接被关闭或超时
+    def receive_until(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition() and not self.closed and time.time() < deadline:
+            self.socket.settimeout(max(deadline - time.time(), 0.01))
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                break
+            except OSError:
+                data = b''
+            if not data:
+                self.closed = True
+                break
+            self.read_buffer += data
+            self._parse()
+        return condition()
+
+    def _parse(self):
+        if not self.handshake:
+            if len(self.read_buffer) < message.Handshake.total_length:
+                return
+            self.handshake = message.Handshake.from_bytes(self.read_buffer)
+            self.read_buffer = self.read_buffer[message.Handshake.total_length:]
+        while len(self.read_buffer) >= 4:
+            length, = struct.unpack(">I", self.read_buffer[:4])
+            if len(self.read_buffer) < 4 + length:
+                return
+            payload, self.read_buffer = self.read_buffer[:4 + length], self.read_buffer[4 + length:]
+            if length:
+                self.messages.append(message.MessageDispatcher(payload).dispatch())
+
+    def close(self):
+        self.socket.close()
+
+
+# 计算默克尔树的根，叶子数量补齐到count个，补充的叶子为全0
+def merkle_root(leaves, count):
+    layer = leaves + [bytes(32)] * (count - len(leaves))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def _power_of_two(n):
+    count = 1
+    while count < n:
+        count *= 2
+    return count
+
+
+# 在directory/name下生成随机内容的文件和对应的种子，files为(相对路径, 大小)的列表
+# meta_version为2时生成混合种子（BEP 52），同时包含v1的片段哈希值和v2的file tree，文件之间用填充文件对齐到片段边界
+# pad为True时v1种子也在文件之间加入填充文件（BEP 47）
+# 返回种子文件路径和以相对路径为关键字的文件内容
+def make_torrent(directory, files, piece_length=32768, meta_version=1, pad=False, url_list=None, name='data'):
+    # v2的file tree按路径排序，混合种子中v1的文件列表需要使用相同的顺序
+    if meta_version == 2:
+        files = sorted(files)
+    # 单文件的v1种子，文件名就是种子名称
+    single_file = len(files) == 1 and '/' not in files[0][0] and meta_version == 1
+    contents = {}
+    layout = b''
+    v1_files = []
+    file_tree = {}
+    piece_layers = {}
+    for i, (path, size) in enumerate(files):
+        data = os.urandom(size)
+        contents[path] = data
+        full_path = os.path.join(directory, name) if single_file else os.path.join(directory, name, *path.split('/'))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(data)
+
+        layout += data
+        v1_files.append({'length': size, 'path': path.split('/')})
+        padding = -size % piece_length
+        if (pad or meta_version == 2) and padding and i < len(files) - 1:
+            layout += bytes(padding)
+            v1_files.append({'length': padding, 'path': ['.pad', str(padding)], 'attr': 'p'})
+
+        if meta_version == 2:
+            leaves = [hashlib.sha256(data[j:j + BLOCK_SIZE]).digest() for j in range(0, size, BLOCK_SIZE)]
+            node = {'length': size}
+            if size:
+                node['pieces root'] = merkle_root(leaves, _power_of_two(len(leaves)))
+                # 超过一个片段的文件需要片段层哈希值
+                if size > piece_length:
+                    blocks = piece_length // BLOCK_SIZE
+                    piece_layers[node['pieces root']] = b''.join(
+                        merkle_root(leaves[j:j + blocks], blocks) for j in range(0, len(leaves), blocks))
+            tree = file_tree
+            for part in path.split('/'):
+                tree = tree.setdefault(part, {})
+            tree[''] = node
+
+    info = {'name': name, 'piece length': piece_length,
+            'pieces': b''.join(hashlib.sha1(layout[i:i + piece_length]).digest()
+                               for i in range(0, len(layout), piece_length))}
+    if single_file:
+        info['length'] = files[0][1]
+    else:
+        info['files'] = v1_files
+    metainfo = {'announce': 'http://127.0.0.1:1/announce', 'info': info}
+    if meta_version == 2:
+        info['meta version'] = 2
+        info['file tree'] = file_tree
+        metainfo['piece layers'] = piece_layers
+    if url_list:
+        metainfo['url-list'] = url_list
+
+    torrent_path = os.path.join(directory, name + '.torrent')
+    with open(torrent_path, 'wb') as f:
+        f.write(bencode(metainfo))
+    return torrent_path, contents
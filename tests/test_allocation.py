@@ -0,0 +1,70 @@
+import os
+import errno
+import collections
+
+import pytest
+
+import file_table
+from file_table import Allocation, Priority
+
+Usage = collections.namedtuple('Usage', 'total used free')
+
+
+@pytest.fixture
+def table(tmp_path):
+    names = [{'path': str(tmp_path / 'data' / 'a.bin'), 'length': 300000},
+             {'path': str(tmp_path / 'data' / '.pad' / '100'), 'length': 100, 'pad': True},
+             {'path': str(tmp_path / 'data' / 'sub' / 'b.bin'), 'length': 200000},
+             {'path': str(tmp_path / 'data' / 'c.bin'), 'length': 50000}]
+    new_table = file_table.FileTable(names, 32 * 1024, str(tmp_path / 'data.parts'))
+    new_table.set_priority(3, Priority.SKIP)
+    return new_table
+
+
+@pytest.mark.parametrize('allocation', [Allocation.SPARSE, Allocation.FULL])
+def test_wanted_files_are_created_at_full_size(table, allocation):
+    table.allocate(allocation)
+    assert os.path.getsize(table.paths[0]) == 300000
+    assert os.path.getsize(table.paths[2]) == 200000
+    # 填充和不下载的文件不会被创建
+    assert not os.path.exists(table.paths[1])
+    assert not os.path.exists(table.paths[3])
+
+
+def test_full_allocation_reserves_disk_space(table):
+    if not hasattr(os, 'posix_fallocate'):
+        pytest.skip('posix_fallocate is not available')
+    table.allocate(Allocation.FULL)
+    assert table.required_space() == 0
+
+
+def test_no_allocation_creates_nothing(table):
+    table.allocate(Allocation.NONE)
+    assert not any(os.path.exists(path) for path in table.paths)
+
+
+def test_allocation_keeps_existing_data(table):
+    os.makedirs(os.path.dirname(table.paths[0]))
+    with open(table.paths[0], 'wb') as f:
+        f.write(b'downloaded')
+    table.allocate(Allocation.SPARSE)
+    with open(table.paths[0], 'rb') as f:
+        assert f.read(10) == b'downloaded'
+    assert os.path.getsize(table.paths[0]) == 300000
+
+
+def test_required_space_counts_missing_and_sparse_files(table):
+    assert table.required_space() == 500000
+    table.allocate(Allocation.SPARSE)
+    # 稀疏文件只占用很少的磁盘空间，仍然需要几乎全部空间
+    assert table.required_space() > 400000
+
+
+def test_check_free_space(table, monkeypatch):
+    monkeypatch.setattr(file_table.shutil, 'disk_usage', lambda path: Usage(10 ** 9, 0, 499999))
+    with pytest.raises(OSError) as error:
+        table.check_free_space()
+    assert error.value.errno == errno.ENOSPC
+
+    monkeypatch.setattr(file_table.shutil, 'disk_usage', lambda path: Usage(10 ** 9, 0, 500000))
+    table.check_free_space()
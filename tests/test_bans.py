@@ -0,0 +1,120 @@
+import pytest
+from pubsub import pub
+
+import peer
+import torrent
+import peers_manager
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent
+
+PIECE_LENGTH = 64 * 1024
+GOOD = '10.0.0.1:6881'
+BAD = '10.0.0.2:6881'
+OTHER = '10.0.0.3:6881'
+
+
+# 记录被封禁的来源
+class Bans(object):
+    def __init__(self):
+        self.sources = []
+        pub.subscribe(self.ban, 'PeersManager.BanPeer')
+
+    def ban(self, source=None):
+        self.sources.append(source)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), [('a.bin', 2 * PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path))
+    yield manager, contents['a.bin'][:PIECE_LENGTH]
+    manager.disk_io.close()
+
+
+def corrupt(data):
+    return bytes([data[0] ^ 0xff]) + data[1:]
+
+
+# 按块发送片段0，sources为每个块的来源，bad为发送坏数据的块编号
+def send_piece(manager, data, sources, bad=()):
+    for i, offset in enumerate(range(0, len(data), BLOCK_SIZE)):
+        block = data[offset:offset + BLOCK_SIZE]
+        pub.sendMessage('PiecesManager.Piece', piece=(0, offset, corrupt(block) if i in bad else block),
+                        info_hash=manager.torrent.info_hash, source=sources[i])
+
+
+def test_single_source_is_banned_immediately(storage):
+    manager, data = storage
+    bans = Bans()
+    send_piece(manager, data, [BAD] * 4, bad={2})
+    assert bans.sources == [BAD]
+    assert manager.wasted_bytes == PIECE_LENGTH
+    assert not manager.pieces[0].is_full
+    assert manager.pieces[0].excluded_sources == [BAD]
+
+
+def test_bad_block_is_attributed_after_redownload(storage):
+    manager, data = storage
+    bans = Bans()
+    send_piece(manager, data, [GOOD, BAD, GOOD, BAD], bad={3})
+    # 多个来源时无法确定是谁，先不封禁
+    assert bans.sources == []
+    assert manager.hash_failures == {GOOD: 1, BAD: 1}
+    assert manager.pieces[0].excluded_sources == [GOOD, BAD]
+
+    send_piece(manager, data, [OTHER] * 4)
+    assert manager.pieces[0].is_full
+    # 重新下载后只有数据不同的块的来源被封禁
+    assert bans.sources == [BAD]
+    assert manager.pieces[0].excluded_sources == []
+
+
+def test_repeated_failures_are_banned(storage):
+    manager, data = storage
+    bans = Bans()
+    for _ in range(pieces_manager.MAX_HASH_FAILURES):
+        send_piece(manager, data, [GOOD, BAD, GOOD, BAD], bad={1})
+    assert bans.sources == [GOOD, BAD]
+
+
+@pytest.fixture
+def manager():
+    new_manager = peers_manager.PeersManager(listen_port=0)
+    yield new_manager
+    new_manager.listen_socket.close()
+
+
+def make_peer(ip, info_hash):
+    new_peer = peer.Peer(2, ip, info_hash=info_hash)
+    new_peer.healthy = True
+    new_peer.state['peer_choking'] = False
+    new_peer.state['am_interested'] = True
+    new_peer.bit_field.set(True)
+    return new_peer
+
+
+def test_banned_ip_is_disconnected(manager):
+    info_hash = b'\x03' * 20
+    bad = make_peer('10.0.0.2', info_hash)
+    good = make_peer('10.0.0.1', info_hash)
+    manager.peers.extend([bad, good])
+    manager.ban_peer(BAD)
+    assert manager.is_banned('10.0.0.2')
+    assert not bad.healthy and good.healthy
+    # 网络种子的来源不会被当作IP地址封禁
+    manager.ban_peer('http://10.0.0.1/data')
+    assert not manager.is_banned('10.0.0.1')
+    # 封禁的地址不会再成为候选
+    manager.peer_exchange(good, [('10.0.0.2', 6881), ('10.0.0.4', 6881)])
+    assert list(manager.candidates) == [(info_hash, '10.0.0.4:6881')]
+
+
+def test_peers_not_involved_in_failures_are_preferred(manager):
+    info_hash = b'\x03' * 20
+    manager.peers.extend([make_peer('10.0.0.1', info_hash), make_peer('10.0.0.2', info_hash)])
+    for _ in range(20):
+        assert manager.get_random_peer_having_piece(info_hash, 0, [GOOD]).ip == '10.0.0.2'
+    # 没有其他对等方时仍然会选择参与过校验失败的对等方
+    assert manager.get_random_peer_having_piece(info_hash, 0, [GOOD, BAD]) is not None
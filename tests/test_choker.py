@@ -0,0 +1,132 @@
+import time
+import socket
+
+import pytest
+
+import peer
+import choker
+import message
+from block import BLOCK_SIZE
+
+INFO_HASH = b'\x01' * 20
+
+
+# 只提供阻塞算法需要的接口的片段管理器
+class Storage(object):
+    def __init__(self, complete):
+        self.complete = complete
+
+    def all_pieces_completed(self):
+        return self.complete
+
+
+class Manager(object):
+    def __init__(self):
+        self.peers = []
+        self.torrents = {INFO_HASH: Storage(False)}
+
+
+@pytest.fixture
+def manager():
+    new_manager = Manager()
+    yield new_manager
+    for new_peer in new_manager.peers:
+        new_peer.socket.close()
+        new_peer.remote.close()
+
+
+# 已握手的对等方，上个统计周期内下载了downloaded字节、上传了uploaded字节
+def add_peer(manager, number, downloaded=0, uploaded=0, interested=True):
+    new_peer = peer.Peer(4, '10.0.0.%d' % number, info_hash=INFO_HASH)
+    new_peer.socket, new_peer.remote = socket.socketpair()
+    new_peer.socket.setblocking(False)
+    new_peer.remote.settimeout(1)
+    new_peer.healthy = True
+    new_peer.has_handshaked = True
+    new_peer.state['peer_interested'] = interested
+    new_peer.rate_timestamp = time.time() - 1
+    new_peer.downloaded = downloaded
+    new_peer.uploaded = uploaded
+    manager.peers.append(new_peer)
+    return new_peer
+
+
+def unchoked(manager):
+    return [new_peer.ip for new_peer in manager.peers if new_peer.am_unchoking()]
+
+
+def test_fastest_uploaders_get_regular_slots(manager):
+    for number in range(1, 7):
+        add_peer(manager, number, downloaded=number * 1000)
+    # 不感兴趣的对等方即使最快也不会被解除阻塞
+    add_peer(manager, 7, downloaded=10 ** 6, interested=False)
+    new_choker = choker.Choker(manager, upload_slots=4)
+    new_choker.rechoke(time.time())
+
+    regular = ['10.0.0.6', '10.0.0.5', '10.0.0.4']
+    assert set(unchoked(manager)) == set(regular + [new_choker.optimistic_peer.ip])
+    assert new_choker.optimistic_peer.ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert manager.peers[5].remote.recv(5) == message.UnChoke().to_bytes()
+
+
+def test_seeding_ranks_peers_by_upload_rate(manager):
+    manager.torrents[INFO_HASH].complete = True
+    add_peer(manager, 1, downloaded=10 ** 6, uploaded=1000)
+    add_peer(manager, 2, uploaded=5000)
+    add_peer(manager, 3, uploaded=3000)
+    new_choker = choker.Choker(manager, upload_slots=2)
+    new_choker.rechoke(time.time())
+    # 做种时下载速率最快的对等方不占常规名额
+    assert new_choker.optimistic_peer.ip in ['10.0.0.1', '10.0.0.3']
+    assert set(unchoked(manager)) == {'10.0.0.2', new_choker.optimistic_peer.ip}
+
+
+def test_optimistic_unchoke_rotates(manager, monkeypatch):
+    for number in range(1, 5):
+        add_peer(manager, number)
+    new_choker = choker.Choker(manager, upload_slots=1)
+    picks = iter([manager.peers[0], manager.peers[3]])
+    monkeypatch.setattr(choker.random, 'choice', lambda candidates: next(picks))
+
+    now = time.time()
+    new_choker.rechoke(now)
+    assert unchoked(manager) == ['10.0.0.1']
+    # 轮换时间之前保持不变
+    new_choker.rechoke(now + choker.CHOKE_INTERVAL)
+    assert unchoked(manager) == ['10.0.0.1']
+    new_choker.rechoke(now + choker.OPTIMISTIC_UNCHOKE_INTERVAL)
+    assert unchoked(manager) == ['10.0.0.4']
+    assert manager.peers[0].am_choking()
+
+
+def test_disconnected_optimistic_peer_is_replaced(manager):
+    add_peer(manager, 1)
+    add_peer(manager, 2)
+    new_choker = choker.Choker(manager, upload_slots=1)
+    now = time.time()
+    new_choker.rechoke(now)
+    optimistic = new_choker.optimistic_peer
+    optimistic.healthy = False
+    new_choker.rechoke(now + choker.CHOKE_INTERVAL)
+    assert new_choker.optimistic_peer is not optimistic
+    assert new_choker.optimistic_peer.healthy
+
+
+def test_choking_drops_queued_requests(manager):
+    plain = add_peer(manager, 1)
+    fast = add_peer(manager, 2)
+    fast.supports_fast = True
+    fast.allowed_fast_sent = [3]
+    for new_peer in (plain, fast):
+        new_peer.unchoke()
+        new_peer.remote.recv(5)
+        new_peer.upload_queue.add(message.Request(1, 0, BLOCK_SIZE))
+        new_peer.upload_queue.add(message.Request(3, 0, BLOCK_SIZE))
+        new_peer.choke()
+
+    assert not plain.upload_queue
+    # 支持快速扩展的对等方收到拒绝，允许快速请求的片段仍然保留
+    assert list(fast.upload_queue.requests) == [(3, 0, BLOCK_SIZE)]
+    assert fast.remote.recv(5) == message.Choke().to_bytes()
+    reject = message.RejectRequest.from_bytes(fast.remote.recv(17))
+    assert (reject.piece_index, reject.block_offset) == (1, 0)
@@ -0,0 +1,71 @@
+import dht
+from conftest import pump
+
+INFO_HASH = b'\x11' * 20
+
+
+# 代替对等方管理器，记录DHT找到的对等方
+class Manager(object):
+    def __init__(self, listen_port, torrents=()):
+        self.listen_port = listen_port
+        self.torrents = dict.fromkeys(torrents)
+        self.candidates = []
+
+    def add_candidates(self, info_hash, sock_addrs):
+        self.candidates.extend((info_hash, ip, port) for ip, port in sock_addrs)
+
+    def is_banned(self, ip):
+        return False
+
+    def is_own_address(self, ip, port):
+        return port == self.listen_port
+
+
+# 在随机端口上创建DHT节点，只通过bootstrap节点引导
+def make_node(tmp_path, name, listen_port, torrents=(), bootstrap=None):
+    return dht.DHT(Manager(listen_port, torrents), 0, str(tmp_path / (name + '.state')),
+                   [('127.0.0.1', bootstrap.socket.getsockname()[1])] if bootstrap else [])
+
+
+def close(nodes):
+    for node in nodes:
+        node.socket.close()
+
+
+def test_announce_is_found_by_another_node(tmp_path):
+    root = make_node(tmp_path, 'root', 7001)
+    seeder = make_node(tmp_path, 'seeder', 7002, [INFO_HASH], bootstrap=root)
+    nodes = [root, seeder]
+    try:
+        # 做种节点引导后查找该种子，结束时向回应了令牌的节点宣告
+        assert pump(nodes, lambda: INFO_HASH in root.peer_store)
+        assert ('127.0.0.1', 7002) in root.peer_store[INFO_HASH]
+
+        leecher = make_node(tmp_path, 'leecher', 7003, [INFO_HASH], bootstrap=root)
+        nodes.append(leecher)
+        assert pump(nodes, lambda: leecher.peers_manager.candidates)
+        assert (INFO_HASH, '127.0.0.1', 7002) in leecher.peers_manager.candidates
+    finally:
+        close(nodes)
+
+
+def test_response_from_another_address_is_ignored(tmp_path):
+    node = make_node(tmp_path, 'node', 7001)
+    target = make_node(tmp_path, 'target', 7002)
+    try:
+        target_address = ('127.0.0.1', target.socket.getsockname()[1])
+        node._send_query(target_address, 'ping', {})
+        transaction_id = next(iter(node.transactions))
+        # 事务ID是随机的
+        assert len(transaction_id) == dht.TRANSACTION_ID_LENGTH
+
+        # 其他地址发来的伪造回应被忽略
+        node._handle_response({'t': transaction_id, 'y': 'r', 'r': {'id': b'\x22' * 20}}, ('127.0.0.1', 9), True)
+        assert transaction_id in node.transactions
+        assert len(node.routing_table) == 0
+
+        # 真正的节点的回应仍然被接受
+        assert pump([node, target], lambda: len(node.routing_table) == 1)
+        assert not node.transactions
+    finally:
+        close([node, target])
@@ -0,0 +1,134 @@
+import time
+
+import pytest
+from pubsub import pub
+
+import peer
+import choker
+import torrent
+import message
+import peers_manager
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent, start_manager, stop_manager, WirePeer
+
+PIECE_LENGTH = 32 * 1024
+NUMBER_OF_PIECES = 20
+
+
+def test_allowed_fast_set_matches_specification():
+    # BEP 6中的示例
+    info_hash = b'\xaa' * 20
+    assert peers_manager.allowed_fast_set('80.4.4.200', info_hash, 1313, 7) == \
+        [1059, 431, 808, 1217, 287, 376, 1188]
+    assert peers_manager.allowed_fast_set('80.4.4.200', info_hash, 1313, 9) == \
+        [1059, 431, 808, 1217, 287, 376, 1188, 353, 508]
+    # 同一个/24网段的地址得到相同的片段
+    assert peers_manager.allowed_fast_set('80.4.4.1', info_hash, 1313) == \
+        peers_manager.allowed_fast_set('80.4.4.200', info_hash, 1313)
+    assert peers_manager.allowed_fast_set('::1', info_hash, 1313) == []
+
+
+# 在事件循环中运行的对等方管理器，complete为True时拥有全部片段，否则没有任何片段
+# 阻塞算法不运行，连接的对等方一直被阻塞
+@pytest.fixture(params=[True, False], ids=['seed', 'empty'])
+def running(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    monkeypatch.setattr(choker.Choker, 'update', lambda self: None)
+    torrent_path, _ = make_torrent(str(tmp_path), [('a.bin', NUMBER_OF_PIECES * PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    storage = pieces_manager.PiecesManager(new_torrent)
+    if request.param:
+        for index in range(storage.number_of_pieces):
+            storage.set_piece_completed(index)
+    manager = peers_manager.PeersManager(listen_port=0)
+    manager.add_torrent(new_torrent, storage)
+    yield request.param, new_torrent.info_hash, start_manager(manager)
+    stop_manager(manager)
+
+
+def test_have_all_or_none_and_allowed_fast_on_connect(running):
+    complete, info_hash, port = running
+    wire = WirePeer(port, info_hash)
+    try:
+        expected = peers_manager.allowed_fast_set('127.0.0.1', info_hash, NUMBER_OF_PIECES) if complete else []
+        if complete:
+            assert wire.receive_until(lambda: len(wire.received(message.AllowedFast)) == len(expected))
+            assert wire.received(message.HaveAll)
+        else:
+            assert wire.receive_until(lambda: wire.received(message.HaveNone))
+            wire.receive_until(lambda: False, 0.5)
+        assert not wire.received(message.BitField)
+        assert [m.piece_index for m in wire.received(message.AllowedFast)] == expected
+    finally:
+        wire.close()
+
+
+@pytest.mark.parametrize('running', [True], indirect=True, ids=['seed'])
+def test_choked_peer_is_served_allowed_fast_pieces_only(running):
+    complete, info_hash, port = running
+    wire = WirePeer(port, info_hash)
+    try:
+        assert wire.receive_until(lambda: len(wire.received(message.AllowedFast)) == peers_manager.ALLOWED_FAST_COUNT)
+        allowed = wire.received(message.AllowedFast)[0].piece_index
+        other = next(index for index in range(NUMBER_OF_PIECES)
+                     if index not in [m.piece_index for m in wire.received(message.AllowedFast)])
+        wire.send(message.Interested().to_bytes() +
+                  message.Request(other, 0, BLOCK_SIZE).to_bytes() +
+                  message.Request(allowed, 0, BLOCK_SIZE).to_bytes())
+        assert wire.receive_until(lambda: wire.received(message.RejectRequest) and wire.received(message.Piece))
+        assert wire.received(message.RejectRequest)[0].piece_index == other
+        assert wire.received(message.Piece)[0].piece_index == allowed
+        assert not wire.received(message.UnChoke)
+    finally:
+        wire.close()
+
+
+# 记录被交还给调度器的块
+class Freed(object):
+    def __init__(self):
+        self.blocks = []
+        pub.subscribe(self.freed, 'PiecesManager.RequestFreed')
+
+    def freed(self, piece_index, block_offset, info_hash):
+        self.blocks.append((piece_index, block_offset))
+
+
+def make_peer(supports_fast):
+    new_peer = peer.Peer(NUMBER_OF_PIECES, '10.0.0.1', info_hash=b'\x04' * 20)
+    new_peer.supports_fast = supports_fast
+    new_peer.outstanding_requests = {(1, 0): time.time(), (1, BLOCK_SIZE): time.time()}
+    return new_peer
+
+
+def test_rejected_block_is_freed_immediately():
+    freed = Freed()
+    new_peer = make_peer(True)
+    new_peer.handle_reject_request(message.RejectRequest(1, BLOCK_SIZE, BLOCK_SIZE))
+    # 没有挂起的请求被拒绝时忽略
+    new_peer.handle_reject_request(message.RejectRequest(2, 0, BLOCK_SIZE))
+    assert freed.blocks == [(1, BLOCK_SIZE)]
+    assert list(new_peer.outstanding_requests) == [(1, 0)]
+    # 支持快速扩展的对等方在阻塞时逐个拒绝请求，挂起的请求保留
+    new_peer.handle_choke()
+    assert list(new_peer.outstanding_requests) == [(1, 0)]
+
+
+def test_choke_frees_requests_without_fast_extension():
+    freed = Freed()
+    new_peer = make_peer(False)
+    new_peer.handle_choke()
+    assert sorted(freed.blocks) == [(1, 0), (1, BLOCK_SIZE)]
+    assert not new_peer.outstanding_requests
+
+
+def test_allowed_fast_pieces_can_be_requested_while_choked():
+    new_peer = make_peer(True)
+    new_peer.handle_have_none()
+    assert not new_peer.bit_field.any(True)
+    new_peer.handle_allowed_fast(message.AllowedFast(3))
+    new_peer.handle_allowed_fast(message.AllowedFast(3))
+    new_peer.handle_allowed_fast(message.AllowedFast(NUMBER_OF_PIECES))
+    assert new_peer.allowed_fast == [3]
+    assert new_peer.is_allowed_fast(3) and not new_peer.is_allowed_fast(4)
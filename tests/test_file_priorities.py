@@ -0,0 +1,90 @@
+import os
+
+import pytest
+from pubsub import pub
+
+import torrent
+import piece_picker
+import pieces_manager
+from block import BLOCK_SIZE
+from file_table import Priority
+from conftest import make_torrent
+
+PIECE_LENGTH = 32 * 1024
+# b.bin占据片段1-4，其中片段2和3只属于b.bin，片段1和4是与a.bin、c.bin共享的边界片段
+FILES = [('a.bin', 40000), ('b.bin', 100000), ('c.bin', 40000)]
+
+
+@pytest.fixture
+def layout(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), FILES, PIECE_LENGTH)
+    # 下载的文件保存在当前目录下
+    monkeypatch.chdir(tmp_path)
+    data = b''.join(contents[path] for path, _ in FILES)
+    return torrent_path, contents, [data[i:i + PIECE_LENGTH] for i in range(0, len(data), PIECE_LENGTH)]
+
+
+def load(torrent_path, priorities):
+    return pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path), priorities=priorities)
+
+
+def send_piece(manager, index, data):
+    for offset in range(0, len(data), BLOCK_SIZE):
+        pub.sendMessage('PiecesManager.Piece', piece=(index, offset, data[offset:offset + BLOCK_SIZE]),
+                        info_hash=manager.torrent.info_hash, source='127.0.0.1:6881')
+
+
+def test_pieces_only_in_skipped_file_are_not_wanted(layout):
+    torrent_path, contents, pieces = layout
+    manager = load(torrent_path, [Priority.NORMAL, Priority.SKIP, Priority.HIGH])
+    assert [manager.is_wanted(index) for index in range(manager.number_of_pieces)] == \
+        [True, True, False, False, True, True]
+    # 边界片段取所包含的文件中最高的优先级
+    assert manager.piece_priorities[4] == Priority.HIGH
+    assert manager.wanted_pieces() == 4
+
+
+def test_high_priority_pieces_are_picked_first(layout):
+    torrent_path, contents, pieces = layout
+    manager = load(torrent_path, {2: Priority.HIGH, 1: Priority.SKIP})
+    picker = piece_picker.PiecePicker(manager)
+    assert picker.pick_order() == [4, 5, 0, 1]
+    # 不下载的片段即使被建议也不会被选取
+    picker.suggest_piece(2, manager.torrent.info_hash)
+    assert picker.pick_order() == [4, 5, 0, 1]
+
+
+def test_skipped_file_is_not_created(layout, tmp_path):
+    torrent_path, contents, pieces = layout
+    manager = load(torrent_path, {1: Priority.SKIP})
+    for index in range(manager.number_of_pieces):
+        if manager.is_wanted(index):
+            send_piece(manager, index, pieces[index])
+    manager.disk_io.close()
+
+    assert manager.all_pieces_completed()
+    assert not manager.bitfield[2] and not manager.bitfield[3]
+    assert not (tmp_path / 'data' / 'b.bin').exists()
+    for path in ('a.bin', 'c.bin'):
+        assert (tmp_path / 'data' / path).read_bytes() == contents[path]
+    # 边界片段中属于b.bin的数据保存在部分文件中对应的偏移量
+    with open(manager.file_table.part_path, 'rb') as part:
+        part.seek(40000)
+        assert part.read(2 * PIECE_LENGTH - 40000) == contents['b.bin'][:2 * PIECE_LENGTH - 40000]
+
+
+def test_file_wanted_again_is_moved_out_of_part_file(layout, tmp_path):
+    torrent_path, contents, pieces = layout
+    manager = load(torrent_path, {1: Priority.SKIP})
+    send_piece(manager, 4, pieces[4])
+    manager.disk_io.close()
+    assert not (tmp_path / 'data' / 'b.bin').exists()
+
+    manager.set_file_priority(1, Priority.NORMAL)
+    assert not manager.file_table.part_files
+    assert manager.is_wanted(2) and manager.is_wanted(3)
+    # 已下载的边界片段中属于b.bin的数据写回原文件
+    start = 4 * PIECE_LENGTH - 40000
+    with open(os.path.join('data', 'b.bin'), 'rb') as f:
+        f.seek(start)
+        assert f.read() == contents['b.bin'][start:]
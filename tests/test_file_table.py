@@ -0,0 +1,67 @@
+import random
+
+import file_table
+
+PIECE_LENGTH = 100
+
+
+def make_table(lengths, pads=()):
+    return file_table.FileTable([{'path': 'f%d' % i, 'length': length, 'pad': i in pads}
+                                 for i, length in enumerate(lengths)], PIECE_LENGTH)
+
+
+# 逐个字节查找所属文件的简单实现，用于对照
+def naive_segments(lengths, offset, length):
+    owners = [i for i, size in enumerate(lengths) for _ in range(size)]
+    starts = [sum(lengths[:i]) for i in range(len(lengths))]
+    segments = []
+    for position in range(offset, min(offset + length, sum(lengths))):
+        file_index = owners[position]
+        if segments and segments[-1][0] == file_index:
+            segments[-1][2] += 1
+        else:
+            segments.append([file_index, position - starts[file_index], 1, position - offset])
+    return [tuple(segment) for segment in segments]
+
+
+def test_find_file_skips_empty_files():
+    table = make_table([50, 0, 0, 120, 30])
+    assert table.total_length == 200
+    assert [table.find_file(offset) for offset in (0, 49, 50, 169, 170, 199)] == [0, 0, 3, 3, 4, 4]
+
+
+def test_segments_match_naive_mapping():
+    rng = random.Random(1)
+    lengths = [rng.choice([0, 1, 7, 99, 100, 101, 250]) for _ in range(40)]
+    table = make_table(lengths)
+    for _ in range(200):
+        offset = rng.randrange(table.total_length)
+        length = rng.randrange(1, 400)
+        assert list(table.segments(offset, length)) == naive_segments(lengths, offset, length)
+
+
+def test_piece_segments_and_file_pieces():
+    table = make_table([150, 0, 100, 60])
+    assert list(table.piece_segments(1, PIECE_LENGTH)) == [(0, 100, 50, 0), (2, 0, 50, 50)]
+    # 最后一个片段不足一个片段长度
+    assert list(table.piece_segments(3, 10)) == [(3, 50, 10, 0)]
+    assert list(table.file_pieces(0)) == [0, 1]
+    assert list(table.file_pieces(1)) == []
+    assert list(table.file_pieces(2)) == [1, 2]
+    assert list(table.file_pieces(3)) == [2, 3]
+
+
+def test_pads_and_empty_files_are_not_wanted():
+    table = make_table([150, 50, 0, 100], pads={1})
+    assert [table.is_wanted(i) for i in range(len(table))] == [True, False, False, True]
+    table.set_priority(3, file_table.Priority.SKIP)
+    assert not table.is_wanted(3)
+    assert table.priorities[3] == file_table.Priority.SKIP
+
+
+def test_lookup_with_many_files():
+    count = 100000
+    table = make_table([3] * count)
+    assert len(table) == count
+    assert table.find_file(3 * count - 1) == count - 1
+    assert list(table.segments(3 * 5000 + 2, 4)) == [(5000, 2, 1, 0), (5001, 0, 3, 1)]
@@ -0,0 +1,112 @@
+import socket
+
+import pytest
+from pubsub import pub
+
+import peer
+import choker
+import torrent
+import message
+import peers_manager
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent, start_manager, stop_manager, WirePeer
+
+PIECE_LENGTH = 32 * 1024
+INFO_HASH = b'\x05' * 20
+OTHER_HASH = b'\x06' * 20
+
+
+# 不启动事件循环的对等方管理器
+@pytest.fixture
+def manager():
+    new_manager = peers_manager.PeersManager(listen_port=0)
+    # 对等方套接字另一端，按对等方加入的顺序排列
+    new_manager.remotes = []
+    yield new_manager
+    new_manager.listen_socket.close()
+    for new_peer in new_manager.peers:
+        new_peer.socket.close()
+    for remote in new_manager.remotes:
+        remote.close()
+
+
+def add_peer(manager, info_hash=INFO_HASH, handshaked=True):
+    new_peer = peer.Peer(8, '10.0.0.%d' % (len(manager.peers) + 1), info_hash=info_hash)
+    new_peer.socket, remote = socket.socketpair()
+    new_peer.socket.setblocking(False)
+    remote.setblocking(False)
+    manager.remotes.append(remote)
+    new_peer.healthy = True
+    new_peer.has_handshaked = handshaked
+    manager.peers.append(new_peer)
+    return new_peer
+
+
+# 读取对等方已收到的HAVE消息中的片段号
+def received_haves(remote):
+    try:
+        data = remote.recv(65536)
+    except BlockingIOError:
+        return []
+    return [message.Have.from_bytes(data[i:i + 9]).piece_index for i in range(0, len(data), 9)]
+
+
+def test_haves_are_batched_per_peer(manager):
+    add_peer(manager)
+    second = add_peer(manager)
+    add_peer(manager, handshaked=False)
+    add_peer(manager, OTHER_HASH)
+    # 对等方已经拥有的片段不再告知
+    second.bit_field[3] = True
+    for index in (1, 3, 5):
+        manager.piece_completed(INFO_HASH, index)
+
+    manager._flush_haves(manager.last_have_flush + 0.1)
+    assert len(manager.pending_haves) == 3
+    manager._flush_haves(manager.last_have_flush + peers_manager.HAVE_FLUSH_INTERVAL)
+    assert not manager.pending_haves
+
+    assert received_haves(manager.remotes[0]) == [1, 3, 5]
+    assert received_haves(manager.remotes[1]) == [1, 5]
+    assert received_haves(manager.remotes[2]) == []
+    assert received_haves(manager.remotes[3]) == []
+
+
+# 在事件循环中运行、已下载片段0和2的对等方管理器
+@pytest.fixture
+def running(tmp_path, monkeypatch):
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    monkeypatch.setattr(choker.Choker, 'update', lambda self: None)
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), [('a.bin', 4 * PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    storage = pieces_manager.PiecesManager(new_torrent)
+    storage.set_piece_completed(0)
+    storage.set_piece_completed(2)
+    manager = peers_manager.PeersManager(listen_port=0)
+    manager.add_torrent(new_torrent, storage)
+    yield storage, contents['a.bin'], start_manager(manager)
+    stop_manager(manager)
+    storage.disk_io.close()
+
+
+@pytest.mark.parametrize('reserved', [None, bytes(8)], ids=['fast', 'plain'])
+def test_bitfield_first_then_have_for_new_pieces(running, reserved):
+    storage, data, port = running
+    wire = WirePeer(port, storage.torrent.info_hash, reserved=reserved)
+    try:
+        assert wire.receive_until(lambda: wire.messages)
+        # 只拥有部分片段时，无论是否支持快速扩展都发送位场，且必须是握手后的第一条消息
+        assert isinstance(wire.messages[0], message.BitField)
+        assert wire.messages[0].bitfield[:4].bin == '1010'
+
+        offset = PIECE_LENGTH
+        for block_offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            pub.sendMessage('PiecesManager.Piece',
+                            piece=(1, block_offset, data[offset + block_offset:offset + block_offset + BLOCK_SIZE]),
+                            info_hash=storage.torrent.info_hash, source='127.0.0.1:6881')
+        assert wire.receive_until(lambda: wire.received(message.Have))
+        assert [m.piece_index for m in wire.received(message.Have)] == [1]
+    finally:
+        wire.close()
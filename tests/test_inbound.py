@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+import torrent
+import message
+import peers_manager
+import pieces_manager
+from conftest import make_torrent, start_manager, stop_manager, wait_for, WirePeer
+
+# 不支持任何扩展的对等方
+NO_EXTENSIONS = bytes(8)
+
+
+# 在事件循环中运行、已拥有全部片段的对等方管理器，不主动连接其他对等方
+@pytest.fixture
+def seed(tmp_path, monkeypatch):
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    torrent_path, _ = make_torrent(str(tmp_path), [('a.bin', 5 * 32 * 1024)])
+    monkeypatch.chdir(tmp_path)
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    storage = pieces_manager.PiecesManager(new_torrent)
+    for index in range(storage.number_of_pieces):
+        storage.set_piece_completed(index)
+    manager = peers_manager.PeersManager(listen_port=0, max_inbound_peers=2)
+    manager.add_torrent(new_torrent, storage)
+    yield manager, new_torrent.info_hash, start_manager(manager)
+    stop_manager(manager)
+
+
+def test_inbound_peer_receives_handshake_and_bitfield(seed):
+    manager, info_hash, port = seed
+    wire = WirePeer(port, info_hash, reserved=NO_EXTENSIONS)
+    try:
+        assert wire.receive_until(lambda: wire.received(message.BitField))
+        assert wire.handshake.info_hash == info_hash
+        # 位场按字节补齐，多出的位为0
+        bitfield = wire.received(message.BitField)[0].bitfield
+        assert bitfield[:5].all(True) and not bitfield[5:].any(True)
+        assert wait_for(lambda: len(manager.peers) == 1 and manager.peers[0].has_handshaked)
+        assert manager.peers[0].is_inbound
+        assert manager.peers[0].info_hash == info_hash
+        assert manager.inbound_peers_count() == 1
+    finally:
+        wire.close()
+
+
+def test_unknown_info_hash_is_disconnected(seed):
+    manager, info_hash, port = seed
+    wire = WirePeer(port, os.urandom(20), reserved=NO_EXTENSIONS)
+    try:
+        wire.receive_until(lambda: False)
+        assert wire.closed
+        assert wire.handshake is None
+        assert wait_for(lambda: not manager.peers)
+    finally:
+        wire.close()
+
+
+def test_inbound_connections_are_limited(seed):
+    manager, info_hash, port = seed
+    wires = [WirePeer(port, info_hash, reserved=NO_EXTENSIONS) for _ in range(2)]
+    try:
+        for wire in wires:
+            assert wire.receive_until(lambda: wire.handshake)
+        # 超过上限的连接被直接关闭
+        extra = WirePeer(port, info_hash, reserved=NO_EXTENSIONS)
+        wires.append(extra)
+        extra.receive_until(lambda: False)
+        assert extra.closed
+        assert extra.handshake is None
+        assert manager.inbound_peers_count() == 2
+
+        # 断开一个连接后可以再接受新的连接
+        wires[0].close()
+        assert wait_for(lambda: manager.inbound_peers_count() == 1)
+        again = WirePeer(port, info_hash, reserved=NO_EXTENSIONS)
+        wires.append(again)
+        assert again.receive_until(lambda: again.handshake)
+    finally:
+        for wire in wires:
+            wire.close()
+
+
+def test_banned_address_is_refused(seed):
+    manager, info_hash, port = seed
+    manager.banned_ips.append('127.0.0.1')
+    wire = WirePeer(port, info_hash, reserved=NO_EXTENSIONS)
+    try:
+        wire.receive_until(lambda: False)
+        assert wire.closed
+        assert not manager.peers
+    finally:
+        wire.close()
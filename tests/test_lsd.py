@@ -0,0 +1,103 @@
+import socket
+
+import pytest
+
+import lsd
+import peers_manager
+from conftest import pump
+
+INFO_HASH = b'\x33' * 20
+OTHER_HASH = b'\x44' * 20
+
+
+# 代替对等方管理器，记录本地服务发现找到的对等方
+class Manager(object):
+    def __init__(self, listen_port, torrents=()):
+        self.listen_port = listen_port
+        self.torrents = dict.fromkeys(torrents)
+        self.candidates = []
+
+    def add_candidates(self, info_hash, sock_addrs, from_lsd=False):
+        self.candidates.extend((info_hash, ip, port, from_lsd) for ip, port in sock_addrs)
+
+    def is_banned(self, ip):
+        return False
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def node():
+    port = free_udp_port()
+    try:
+        node = lsd.LSD(Manager(7001, [INFO_HASH]), port=port)
+    except OSError as e:
+        pytest.skip("multicast is not available : %s" % e)
+    yield node
+    node.socket.close()
+
+
+def test_announce_round_trip():
+    data = lsd.make_announce(6881, INFO_HASH, 'abcd')
+    assert lsd.parse_announce(data) == (6881, [INFO_HASH], 'abcd')
+
+
+def test_parse_announce_with_several_info_hashes():
+    data = ("BT-SEARCH * HTTP/1.1\r\nHost: 239.192.152.143:6771\r\nPort: 7000\r\n"
+            "Infohash: %s\r\nInfohash: %s\r\n\r\n\r\n" % (INFO_HASH.hex(), OTHER_HASH.hex())).encode()
+    assert lsd.parse_announce(data) == (7000, [INFO_HASH, OTHER_HASH], None)
+
+
+@pytest.mark.parametrize('data', [
+    b'GET / HTTP/1.1\r\n\r\n',
+    b'BT-SEARCH * HTTP/1.1\r\nPort: 0\r\nInfohash: ' + INFO_HASH.hex().encode() + b'\r\n\r\n',
+    b'BT-SEARCH * HTTP/1.1\r\nPort: abc\r\nInfohash: ' + INFO_HASH.hex().encode() + b'\r\n\r\n',
+    b'BT-SEARCH * HTTP/1.1\r\nPort: 7000\r\nInfohash: 1234\r\n\r\n',
+])
+def test_parse_announce_rejects_malformed(data):
+    assert lsd.parse_announce(data) is None
+
+
+def test_own_announce_is_ignored(node):
+    port = node.socket.getsockname()[1]
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        sender.sendto(lsd.make_announce(7001, INFO_HASH, node.cookie), ('127.0.0.1', port))
+        sender.sendto(lsd.make_announce(7002, INFO_HASH, 'other'), ('127.0.0.1', port))
+        sender.sendto(lsd.make_announce(7003, OTHER_HASH, 'other'), ('127.0.0.1', port))
+        # 只有其他客户端宣告的、本客户端正在分享的种子被加入候选
+        assert pump([node], lambda: node.peers_manager.candidates, timeout=5)
+    assert node.peers_manager.candidates == [(INFO_HASH, '127.0.0.1', 7002, True)]
+
+
+def test_multicast_announce_is_found(node):
+    port = node.socket.getsockname()[1]
+    try:
+        other = lsd.LSD(Manager(7002, [INFO_HASH]), port=port)
+    except OSError as e:
+        pytest.skip("multicast is not available : %s" % e)
+    try:
+        other.update()
+        if not pump([node, other], lambda: node.peers_manager.candidates, timeout=3):
+            pytest.skip("multicast loopback is not routed here")
+        assert (INFO_HASH, 7002, True) in [(h, p, f) for h, _, p, f in node.peers_manager.candidates]
+        assert all(port != 7001 for _, _, port, _ in node.peers_manager.candidates)
+    finally:
+        other.socket.close()
+
+
+def test_lan_candidates_from_pex_are_capped():
+    manager = peers_manager.PeersManager(listen_port=0)
+    try:
+        manager.add_candidates(INFO_HASH, [('10.0.%d.%d' % (i // 250, i % 250), 1) for i in range(1000)])
+        assert len(manager.candidates) == peers_manager.MAX_CANDIDATES
+        # 本地服务发现找到的对等方还可以额外加入，但数量也有上限
+        manager.add_candidates(INFO_HASH, [('192.168.%d.%d' % (i // 250, i % 250), 1) for i in range(1000)],
+                               from_lsd=True)
+        assert len(manager.candidates) == peers_manager.MAX_CANDIDATES + peers_manager.MAX_LSD_CANDIDATES
+    finally:
+        if manager.listen_socket:
+            manager.listen_socket.close()
@@ -0,0 +1,175 @@
+import os
+import hashlib
+
+import pytest
+from pubsub import pub
+
+import merkle
+import message
+import torrent
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent, merkle_root
+
+PIECE_LENGTH = 64 * 1024
+# 多个片段的文件（最后一个片段的叶子节点不足，需要补0）、只有一个片段的文件和只有一个块的文件
+FILES = [('a.bin', 100000), ('b.bin', 20000), ('c.bin', 10000)]
+SOURCE = '127.0.0.1:6881'
+
+
+# 记录被封禁的来源
+class Bans(object):
+    def __init__(self):
+        self.sources = []
+        pub.subscribe(self.ban, 'PeersManager.BanPeer')
+
+    def ban(self, source=None):
+        self.sources.append(source)
+
+
+@pytest.fixture
+def hybrid(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), FILES, PIECE_LENGTH, 2)
+    # 下载的文件保存在当前目录下
+    monkeypatch.chdir(tmp_path)
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    manager = pieces_manager.PiecesManager(new_torrent)
+    yield manager, piece_data(manager, contents)
+    manager.disk_io.close()
+
+
+# 按照种子的布局拼接文件和填充，返回每个片段的数据
+def piece_data(manager, contents):
+    table = manager.file_table
+    layout = bytearray(table.total_length)
+    for file_index, path in enumerate(table.paths):
+        if not table.pads[file_index]:
+            relative = os.path.relpath(path, 'data').replace(os.sep, '/')
+            layout[table.offsets[file_index]:table.offsets[file_index] + table.lengths[file_index]] = contents[relative]
+    return [bytes(layout[piece.piece_index * PIECE_LENGTH:piece.piece_index * PIECE_LENGTH + piece.piece_size])
+            for piece in manager.pieces]
+
+
+def corrupt(data, position=0):
+    return data[:position] + bytes([data[position] ^ 0xff]) + data[position + 1:]
+
+
+def send_piece(manager, index, data, source=SOURCE):
+    for offset in range(0, len(data), BLOCK_SIZE):
+        pub.sendMessage('PiecesManager.Piece', piece=(index, offset, data[offset:offset + BLOCK_SIZE]),
+                        info_hash=manager.torrent.info_hash, source=source)
+
+
+# 片段完整的叶子层，超出文件末尾的叶子节点为全0
+def block_hashes(piece, data):
+    leaves = merkle.leaf_hashes(data)
+    return leaves + [merkle.ZERO_HASH] * (piece.tree.leaf_count - len(leaves))
+
+
+def send_hashes(manager, piece, hashes, source=SOURCE):
+    tree = piece.tree
+    pub.sendMessage('PiecesManager.Hashes', hashes=message.Hashes(tree.pieces_root, 0, tree.first_leaf,
+                                                                  tree.leaf_count, 0, hashes),
+                    info_hash=manager.torrent.info_hash, source=source)
+
+
+def test_merkle_root_matches_generator():
+    leaves = [hashlib.sha256(os.urandom(32)).digest() for _ in range(5)]
+    assert merkle.root_hash(leaves, 8) == merkle_root(leaves, 8)
+    assert merkle.next_power_of_two(5) == 8
+    assert merkle.next_power_of_two(1) == 1
+
+
+def test_pieces_follow_file_boundaries(hybrid):
+    manager, data = hybrid
+    assert manager.torrent.is_hybrid
+    # 每个文件从新的片段开始，文件的最后一个片段不包含填充
+    assert [piece.piece_size for piece in manager.pieces] == [65536, 34464, 20000, 10000]
+    assert [piece.tree.leaf_count for piece in manager.pieces] == [4, 4, 2, 1]
+    for piece in manager.pieces:
+        assert manager.pieces_by_root[(piece.tree.pieces_root, piece.tree.first_leaf)] is piece
+
+
+def test_verify_accepts_good_and_rejects_corrupted_pieces(hybrid):
+    manager, data = hybrid
+    for piece, piece_bytes in zip(manager.pieces, data):
+        assert piece.verify(piece_bytes)
+        assert not piece.verify(corrupt(piece_bytes))
+        assert not piece.verify(corrupt(piece_bytes, len(piece_bytes) - 1))
+        # 多出的数据会增加叶子节点，同样校验失败
+        assert not piece.verify(piece_bytes + bytes(BLOCK_SIZE))
+        # 混合种子中v1的片段哈希值覆盖到片段末尾的填充
+        padded = piece_bytes + bytes(-len(piece_bytes) % PIECE_LENGTH) if piece.piece_index < 3 else piece_bytes
+        assert hashlib.sha1(padded).digest() == piece.piece_hash
+
+
+def test_download_is_verified_and_written(hybrid, tmp_path):
+    manager, data = hybrid
+    bans = Bans()
+    # 没有叶子哈希值时坏块只能在片段完成后发现，片段被重置后重新下载
+    send_piece(manager, 0, corrupt(data[0], BLOCK_SIZE + 1))
+    assert not manager.pieces[0].is_full
+    assert manager.wasted_bytes == manager.pieces[0].piece_size
+    assert bans.sources == [SOURCE]
+
+    for index, piece_bytes in enumerate(data):
+        send_piece(manager, index, piece_bytes, '127.0.0.2:6881')
+    manager.disk_io.close()
+    assert manager.bitfield.all(True)
+    for path, size in FILES:
+        with open(str(tmp_path / 'data' / path), 'rb') as f, open(str(tmp_path / 'source' / 'data' / path), 'rb') as g:
+            assert f.read() == g.read()
+    assert not (tmp_path / 'data' / '.pad').exists()
+
+    # 已下载的片段可以为其他对等方提供叶子哈希值
+    piece = manager.pieces[1]
+    assert manager.get_block_hashes(piece.tree.pieces_root, 0, piece.tree.first_leaf, piece.tree.leaf_count, 0) == \
+        block_hashes(piece, data[1])
+
+
+def test_block_hashes_reject_bad_blocks_on_arrival(hybrid):
+    manager, data = hybrid
+    bans = Bans()
+    piece = manager.pieces[1]
+    send_hashes(manager, piece, block_hashes(piece, data[1]))
+    assert piece.tree.block_hashes is not None
+
+    bad = corrupt(data[1][BLOCK_SIZE:2 * BLOCK_SIZE])
+    pub.sendMessage('PiecesManager.Piece', piece=(1, BLOCK_SIZE, bad), info_hash=manager.torrent.info_hash,
+                    source=SOURCE)
+    assert manager.wasted_bytes == len(bad)
+    assert bans.sources == [SOURCE]
+    # 坏块被立即拒绝，片段中的其他块不受影响
+    send_piece(manager, 1, data[1], '127.0.0.2:6881')
+    assert piece.is_full
+    assert manager.wasted_bytes == len(bad)
+
+
+def test_bad_blocks_found_when_hashes_arrive(hybrid):
+    manager, data = hybrid
+    bans = Bans()
+    piece = manager.pieces[0]
+    pub.sendMessage('PiecesManager.Piece', piece=(0, 0, data[0][:BLOCK_SIZE]), info_hash=manager.torrent.info_hash,
+                    source='127.0.0.2:6881')
+    pub.sendMessage('PiecesManager.Piece', piece=(0, BLOCK_SIZE, corrupt(data[0][BLOCK_SIZE:2 * BLOCK_SIZE])),
+                    info_hash=manager.torrent.info_hash, source=SOURCE)
+
+    send_hashes(manager, piece, block_hashes(piece, data[0]))
+    assert bans.sources == [SOURCE]
+    assert manager.wasted_bytes == BLOCK_SIZE
+    # 只有坏块需要重新下载
+    assert piece.get_empty_block()[1] == BLOCK_SIZE
+
+
+def test_invalid_block_hashes_are_rejected(hybrid):
+    manager, data = hybrid
+    bans = Bans()
+    piece = manager.pieces[0]
+    hashes = block_hashes(piece, data[0])
+    hashes[2] = merkle.sha256(b'bad')
+    send_hashes(manager, piece, hashes)
+    assert piece.tree.block_hashes is None
+    assert bans.sources == [SOURCE]
+    # 不完整的叶子层同样被拒绝
+    send_hashes(manager, piece, hashes[:2], '127.0.0.3:6881')
+    assert piece.tree.block_hashes is None
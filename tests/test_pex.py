@@ -0,0 +1,82 @@
+import time
+
+import pytest
+from bcoding import bencode
+
+import torrent
+import message
+import extension
+import peers_manager
+import pieces_manager
+from conftest import make_torrent, start_manager, stop_manager, WirePeer
+
+
+# 在事件循环中运行的对等方管理器B，所有对等方都通过回环地址连接它
+@pytest.fixture
+def manager_b(tmp_path, monkeypatch):
+    monkeypatch.setattr(extension, 'PEX_INTERVAL', 0)
+    # 不连接通过PEX得知的地址
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    torrent_path, _ = make_torrent(str(tmp_path), [('a.bin', 64 * 1024)])
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    manager = peers_manager.PeersManager(listen_port=0)
+    manager.add_torrent(new_torrent, pieces_manager.PiecesManager(new_torrent))
+    yield manager, new_torrent.info_hash, start_manager(manager)
+    stop_manager(manager)
+
+
+def test_peer_learns_and_forgets_address_through_pex(manager_b):
+    manager, info_hash, port = manager_b
+    peer_a = WirePeer(port, info_hash, 7001)
+    peer_c = WirePeer(port, info_hash, 7003)
+    try:
+        # B通过PEX把A的监听地址告知C，使用C在扩展握手中分配的编号
+        assert peer_c.receive_until(lambda: any(('127.0.0.1', 7001) in added
+                                                for added, _ in peer_c.pex_messages()))
+        # A也会得知C的地址
+        assert peer_a.receive_until(lambda: any(('127.0.0.1', 7003) in added
+                                                for added, _ in peer_a.pex_messages()))
+
+        # A断开后，B在下一条PEX消息中告知C该地址已断开
+        peer_a.close()
+        assert peer_c.receive_until(lambda: any(('127.0.0.1', 7001) in dropped
+                                                for _, dropped in peer_c.pex_messages()))
+        # 每个地址只新增一次
+        added = [address for added, _ in peer_c.pex_messages() for address in added]
+        assert added == [('127.0.0.1', 7001)]
+    finally:
+        peer_a.close()
+        peer_c.close()
+
+
+def test_addresses_from_pex_become_candidates(manager_b):
+    manager, info_hash, port = manager_b
+    peer_a = WirePeer(port, info_hash, 7001)
+    try:
+        # 等待B完成扩展握手
+        assert peer_a.receive_until(lambda: any(isinstance(m, message.ExtendedMessage) for m in peer_a.messages))
+        pex = extension.make_pex([('10.0.0.1', 6881), ('10.0.0.2', 6882)], [])
+        peer_a.send(message.ExtendedMessage(extension.UT_PEX_ID, pex).to_bytes())
+        deadline = time.time() + 10
+        while len(manager.candidates) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert set(manager.candidates) == {(info_hash, '10.0.0.1:6881'), (info_hash, '10.0.0.2:6882')}
+    finally:
+        peer_a.close()
+
+
+def test_make_and_parse_pex():
+    added = [('1.2.3.4', 6881), ('5.6.7.8', 80)]
+    assert extension.parse_pex(extension.make_pex(added, [('9.9.9.9', 1)])) == (added, [('9.9.9.9', 1)])
+
+
+def test_parse_pex_ignores_truncated_and_invalid_addresses():
+    added = extension.encode_peers([('1.2.3.4', 6881), ('5.6.7.8', 0), ('9.10.11.12', 80)])
+    # 最后一个地址被截断，端口号为0的地址无效
+    payload = bencode({'added': added[:-2], 'dropped': b'\x01\x02'})
+    assert extension.parse_pex(payload) == ([('1.2.3.4', 6881)], [])
+
+
+def test_parse_pex_rejects_non_dictionary():
+    with pytest.raises(ValueError):
+        extension.parse_pex(bencode([1, 2]))
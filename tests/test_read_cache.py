@@ -0,0 +1,112 @@
+import os
+
+import pytest
+from pubsub import pub
+
+import torrent
+import read_cache
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent
+
+PIECE_LENGTH = 64 * 1024
+
+
+def test_least_recently_used_piece_is_evicted():
+    cache = read_cache.ReadCache(limit=300)
+    cache.put('a', bytes(100))
+    cache.put('b', bytes(100))
+    cache.put('c', bytes(100))
+    assert cache.get('a') is not None
+    cache.put('d', bytes(100))
+    assert cache.get('b') is None
+    assert [key for key in cache.pieces] == ['c', 'a', 'd']
+    assert cache.size == 300
+    # 超过上限的片段不会被缓存
+    cache.put('e', bytes(301))
+    assert cache.get('e') is None
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+def test_replacing_and_discarding_keep_size():
+    cache = read_cache.ReadCache(limit=300)
+    cache.put('a', bytes(100))
+    cache.put('a', bytes(50))
+    assert cache.size == 50
+    cache.discard('a')
+    cache.discard('a')
+    assert cache.size == 0 and not cache.pieces
+
+
+def test_only_repeated_pieces_are_admitted():
+    cache = read_cache.ReadCache(limit=10 ** 6)
+    # 第一次请求整个片段时不缓存
+    for _ in range(4):
+        assert not cache.admit('a', BLOCK_SIZE, 4 * BLOCK_SIZE)
+    # 片段被再次请求时缓存
+    assert cache.admit('a', BLOCK_SIZE, 4 * BLOCK_SIZE)
+    cache.put('a', bytes(4 * BLOCK_SIZE))
+    assert not cache.requested
+    assert cache.admit('a', BLOCK_SIZE, 4 * BLOCK_SIZE)
+
+
+def test_tracked_pieces_are_bounded(monkeypatch):
+    monkeypatch.setattr(read_cache, 'MAX_TRACKED_PIECES', 3)
+    cache = read_cache.ReadCache()
+    for key in 'abcd':
+        cache.admit(key, 10, 100)
+    assert list(cache.requested) == ['b', 'c', 'd']
+
+
+# 所有片段都已写入磁盘、使用读取缓存的片段管理器
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path), [('a.bin', 2 * PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path),
+                                           cache=read_cache.ReadCache(PIECE_LENGTH))
+    for index in range(manager.number_of_pieces):
+        manager.set_piece_completed(index)
+    yield manager, contents['a.bin']
+    manager.disk_io.close()
+
+
+def test_repeatedly_uploaded_piece_is_served_from_cache(storage):
+    manager, data = storage
+    cache = manager.read_cache
+    # 第一次上传由sendfile直接从文件发送
+    for _ in range(PIECE_LENGTH // BLOCK_SIZE):
+        assert not manager.is_upload_cached(0, BLOCK_SIZE)
+    assert not cache.pieces
+
+    # 再次被请求时读取整个片段并缓存，之后的请求不再读取磁盘
+    assert manager.is_upload_cached(0, BLOCK_SIZE)
+    assert manager.get_block(0, 0, BLOCK_SIZE) == data[:BLOCK_SIZE]
+    os.remove('data')
+    assert manager.get_block(0, BLOCK_SIZE, BLOCK_SIZE) == data[BLOCK_SIZE:2 * BLOCK_SIZE]
+    assert cache.hits == 1
+    # 缓存已满时淘汰最久没有使用的片段
+    cache.put((manager.torrent.info_hash, 1), bytes(PIECE_LENGTH))
+    assert manager.get_block(0, 0, BLOCK_SIZE) is None
+
+
+def test_verified_pieces_are_kept_when_enabled(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), [('a.bin', PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    cache = read_cache.ReadCache(keep_verified=True)
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path), cache=cache)
+    for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+        pub.sendMessage('PiecesManager.Piece', piece=(0, offset, contents['a.bin'][offset:offset + BLOCK_SIZE]),
+                        info_hash=manager.torrent.info_hash, source='127.0.0.1:6881')
+    manager.disk_io.close()
+    assert cache.get((manager.torrent.info_hash, 0)) == contents['a.bin']
+    assert manager.is_upload_cached(0, BLOCK_SIZE)
+
+
+def test_cache_can_be_disabled(storage):
+    manager, data = storage
+    manager.read_cache = read_cache.ReadCache(0)
+    for _ in range(8):
+        assert not manager.is_upload_cached(0, PIECE_LENGTH)
+    assert manager.get_block(0, 0, BLOCK_SIZE) == data[:BLOCK_SIZE]
+    assert not manager.read_cache.pieces
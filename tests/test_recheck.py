@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+import torrent
+import recheck
+import pieces_manager
+from conftest import make_torrent
+
+PIECE_LENGTH = 16 * 1024
+# 片段数量远多于正在计算的片段的上限
+FILES = [('a.bin', 300000), ('sub/b.bin', 200000), ('c.bin', 5000)]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # 种子中的文件生成在当前目录下，相当于已经下载过的数据
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def run(torrent_path, workers=2):
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    manager = pieces_manager.PiecesManager(new_torrent)
+    return manager, recheck.Recheck(new_torrent, manager, workers).run()
+
+
+@pytest.mark.parametrize('meta_version, pad, workers', [(1, False, 1), (1, True, 4), (2, True, 3)])
+def test_complete_data_is_valid(workdir, meta_version, pad, workers):
+    torrent_path, contents = make_torrent(str(workdir), FILES, PIECE_LENGTH, meta_version, pad)
+    manager, valid = run(torrent_path, workers)
+    assert valid == manager.number_of_pieces
+    assert manager.bitfield.all(True)
+    assert manager.complete_pieces == manager.number_of_pieces
+
+
+def test_damaged_and_missing_data_is_not_valid(workdir):
+    torrent_path, contents = make_torrent(str(workdir), FILES, PIECE_LENGTH)
+    # 损坏片段3，b.bin缺失，c.bin被截断
+    with open(os.path.join('data', 'a.bin'), 'r+b') as f:
+        f.seek(3 * PIECE_LENGTH + 10)
+        f.write(b'\x00' if contents['a.bin'][3 * PIECE_LENGTH + 10] else b'\x01')
+    os.remove(os.path.join('data', 'sub', 'b.bin'))
+    with open(os.path.join('data', 'c.bin'), 'r+b') as f:
+        f.truncate(4000)
+
+    manager, valid = run(torrent_path)
+    table = manager.file_table
+    invalid = {3} | set(table.file_pieces(1)) | set(table.file_pieces(2))
+    assert [not manager.bitfield[index] for index in range(manager.number_of_pieces)] == \
+        [index in invalid for index in range(manager.number_of_pieces)]
+    assert valid == manager.number_of_pieces - len(invalid)
+
+
+def test_nothing_to_check_without_files(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), FILES, PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager, valid = run(torrent_path)
+    assert valid == 0
+    assert not manager.bitfield.any(True)
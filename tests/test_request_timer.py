@@ -0,0 +1,96 @@
+import time
+import socket
+
+import pytest
+
+import peer
+import torrent
+import disk_io
+import download
+import peers_manager
+import request_timer
+from block import BLOCK_SIZE, State
+from conftest import make_torrent
+
+
+def test_only_expired_requests_are_popped_in_deadline_order():
+    timer = request_timer.RequestTimer()
+    timer.add('a', (0, 0), 100.0, 5)
+    timer.add('b', (0, BLOCK_SIZE), 100.0, 2)
+    timer.add('c', (1, 0), 101.0, 30)
+    assert timer.pop_expired(101.0) == []
+    assert timer.pop_expired(105.0) == [('b', (0, BLOCK_SIZE), 100.0), ('a', (0, 0), 100.0)]
+    assert len(timer) == 1
+
+
+def test_timeout_adapts_to_round_trip_time():
+    new_peer = peer.Peer(4, '10.0.0.1')
+    assert new_peer.request_timeout() == peer.REQUEST_TIMEOUT
+    for _ in range(20):
+        new_peer._update_rtt(0.5)
+    assert new_peer.request_timeout() == peer.MIN_REQUEST_TIMEOUT
+    # 挂起的请求越多，排在后面的请求需要等待越久
+    new_peer.download_rate = BLOCK_SIZE
+    new_peer.outstanding_requests = {(0, i * BLOCK_SIZE): 0.0 for i in range(4)}
+    assert new_peer.request_timeout() == pytest.approx(0.5 + 4, abs=0.1)
+    for _ in range(20):
+        new_peer._update_rtt(100)
+    assert new_peer.request_timeout() == peer.MAX_REQUEST_TIMEOUT
+
+
+def test_answered_request_does_not_expire():
+    new_peer = peer.Peer(4, '10.0.0.1')
+    new_peer.outstanding_requests[(0, 0)] = 100.0
+    assert not new_peer.expire_request((0, 0), 99.0)
+    assert new_peer.expire_request((0, 0), 100.0)
+    assert new_peer.score == peer.MAX_SCORE / 2
+    assert not new_peer.expire_request((0, 0), 100.0)
+
+
+# 下载中的种子和一个已经解除阻塞、拥有全部片段的对等方
+@pytest.fixture
+def downloading(tmp_path, monkeypatch):
+    torrent_path, _ = make_torrent(str(tmp_path / 'source'), [('a.bin', 64 * 1024)])
+    monkeypatch.chdir(tmp_path)
+    manager = peers_manager.PeersManager(listen_port=0)
+    new_download = download.Download(torrent.Torrent().load_from_path(torrent_path), manager, disk_io.DiskIO())
+    assert new_download.checked.wait(10)
+
+    new_peer = peer.Peer(new_download.pieces_manager.number_of_pieces, '127.0.0.1',
+                         info_hash=new_download.torrent.info_hash)
+    new_peer.socket, remote = socket.socketpair()
+    new_peer.socket.setblocking(False)
+    new_peer.healthy = True
+    new_peer.has_handshaked = True
+    new_peer.state['peer_choking'] = False
+    new_peer.state['am_interested'] = True
+    new_peer.bit_field.set(True)
+    manager.peers.append(new_peer)
+    yield new_download, new_peer
+    new_peer.socket.close()
+    remote.close()
+    manager.listen_socket.close()
+    new_download.pieces_manager.disk_io.close()
+
+
+def test_expired_requests_are_freed_for_other_peers(downloading, monkeypatch):
+    new_download, new_peer = downloading
+    new_download.update()
+    requested = dict(new_peer.outstanding_requests)
+    assert requested
+    assert len(new_download.request_timer) == len(requested)
+
+    # 截止时间之前不会超时
+    new_download._expire_requests()
+    assert new_peer.outstanding_requests == requested
+
+    timer = new_download.request_timer
+    later = time.time() + peer.REQUEST_TIMEOUT + 1
+    monkeypatch.setattr(timer, 'pop_expired', lambda pop=timer.pop_expired: pop(later))
+    new_download._expire_requests()
+    assert not new_peer.outstanding_requests
+    assert new_peer.score < peer.MAX_SCORE
+    # 超时的块可以重新请求
+    pieces = new_download.pieces_manager.pieces
+    for piece_index, block_offset in requested:
+        assert pieces[piece_index].blocks[block_offset // BLOCK_SIZE].state == State.FREE
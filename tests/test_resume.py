@@ -0,0 +1,115 @@
+import os
+
+import pytest
+from pubsub import pub
+
+import torrent
+import resume
+import pieces_manager
+from block import BLOCK_SIZE
+from file_table import Priority
+from conftest import make_torrent
+
+PIECE_LENGTH = 32 * 1024
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # 种子中的文件生成在当前目录下，相当于已经下载过的数据
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def load_torrent(torrent_path, priorities=None):
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    return new_torrent, pieces_manager.PiecesManager(new_torrent, priorities=priorities)
+
+
+def send_piece(manager, index, data):
+    for offset in range(0, len(data), BLOCK_SIZE):
+        pub.sendMessage('PiecesManager.Piece', piece=(index, offset, data[offset:offset + BLOCK_SIZE]),
+                        info_hash=manager.torrent.info_hash, source='127.0.0.1:6881')
+
+
+def test_round_trip_with_ascii_bitfield_and_partial_piece(workdir):
+    torrent_path, contents = make_torrent(str(workdir), [('a.bin', 8 * PIECE_LENGTH)], PIECE_LENGTH)
+    new_torrent, manager = load_torrent(torrent_path)
+    # 片段1-7已下载，bitfield为b'\x7f'，能以utf-8解码
+    for index in range(1, 8):
+        manager.set_piece_completed(index)
+    # 片段0只收到第一个块，块数据同样能以utf-8解码
+    block = b'a' * BLOCK_SIZE
+    manager.pieces[0].set_block(0, block)
+    assert resume.ResumeData(new_torrent, manager).save()
+
+    new_torrent, manager = load_torrent(torrent_path)
+    assert resume.ResumeData(new_torrent, manager).load()
+    assert manager.bitfield.tobytes() == b'\x7f'
+    assert manager.complete_pieces == 7
+    assert isinstance(manager.pieces[0].blocks[0].data, bytes)
+    assert manager.pieces[0].blocks[0].data == block
+    assert manager.pieces[0].get_empty_block() == (0, BLOCK_SIZE, BLOCK_SIZE)
+
+
+def test_resume_data_is_rejected_when_out_of_date(workdir):
+    torrent_path, contents = make_torrent(str(workdir), [('a.bin', 3 * PIECE_LENGTH)], PIECE_LENGTH)
+    new_torrent, manager = load_torrent(torrent_path)
+    manager.set_piece_completed(0)
+    assert resume.ResumeData(new_torrent, manager).save()
+
+    # 文件被修改后需要重新校验
+    with open('data', 'ab') as f:
+        f.write(b'x')
+    new_torrent, manager = load_torrent(torrent_path)
+    assert not resume.ResumeData(new_torrent, manager).load()
+    assert manager.complete_pieces == 0
+
+
+def test_corrupted_resume_file_is_ignored(workdir):
+    torrent_path, contents = make_torrent(str(workdir), [('a.bin', PIECE_LENGTH)], PIECE_LENGTH)
+    new_torrent, manager = load_torrent(torrent_path)
+    data = resume.ResumeData(new_torrent, manager)
+    with open(data.path, 'wb') as f:
+        f.write(b'd9:info_hash')
+    assert not data.load()
+
+
+# 文件b.bin不下载时，与a.bin、c.bin共享的边界片段中属于b.bin的数据保存在部分文件中
+@pytest.fixture
+def skipped(workdir):
+    files = [('a.bin', 40000), ('b.bin', 40000), ('c.bin', 40000)]
+    torrent_path, contents = make_torrent(str(workdir), files, PIECE_LENGTH, name='part')
+    layout = b''.join(contents[path] for path, _ in files)
+    os.remove(os.path.join('part', 'b.bin'))
+    os.remove(os.path.join('part', 'c.bin'))
+
+    new_torrent, manager = load_torrent(torrent_path, {1: Priority.SKIP})
+    assert manager.file_table.part_files == {1}
+    # 片段1包含a.bin的结尾和b.bin的开头
+    send_piece(manager, 1, layout[PIECE_LENGTH:2 * PIECE_LENGTH])
+    manager.disk_io.close()
+    assert manager.bitfield[1]
+    assert not os.path.exists(os.path.join('part', 'b.bin'))
+    assert resume.ResumeData(new_torrent, manager).save()
+    return torrent_path, contents
+
+
+def test_part_files_and_priorities_are_restored(skipped):
+    torrent_path, contents = skipped
+    new_torrent, manager = load_torrent(torrent_path)
+    assert resume.ResumeData(new_torrent, manager).load(restore_priorities=True)
+    assert manager.file_table.priorities == [Priority.NORMAL, Priority.SKIP, Priority.NORMAL]
+    assert manager.file_table.part_files == {1}
+    assert manager.bitfield[1]
+    # 边界片段仍然可以从部分文件中读取并上传
+    assert manager.pieces[1].verify(manager.pieces[1].get_block(0, PIECE_LENGTH))
+
+
+def test_file_no_longer_skipped_is_moved_out_of_part_file(skipped):
+    torrent_path, contents = skipped
+    # 本次运行指定了文件优先级，不恢复保存的优先级
+    new_torrent, manager = load_torrent(torrent_path, {1: Priority.NORMAL})
+    assert resume.ResumeData(new_torrent, manager).load()
+    assert not manager.file_table.part_files
+    with open(os.path.join('part', 'b.bin'), 'rb') as f:
+        assert f.read() == contents['b.bin'][:2 * PIECE_LENGTH - 40000]
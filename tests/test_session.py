@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+import session
+from conftest import make_torrent
+
+
+# 不启用DHT、uTP和本地服务发现，也不启动事件循环的会话
+@pytest.fixture
+def new_session(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    current = session.Session(listen_port=0, enable_dht=False, enable_lsd=False, enable_utp=False)
+    yield current
+    current.close()
+    if current.peers_manager.listen_socket:
+        current.peers_manager.listen_socket.close()
+
+
+def scan(current):
+    current.last_watch_scan = 0.0
+    current._scan_watch_dir()
+
+
+def test_duplicate_torrent_returns_existing_download(new_session, tmp_path):
+    torrent_path, _ = make_torrent(str(tmp_path / 'source'), [('a.bin', 40000)])
+    first = new_session.add_torrent(torrent_path)
+    assert first is not None
+    assert first.checked.wait(10)
+    assert new_session.add_torrent(torrent_path) is first
+    assert len(new_session.downloads) == 1
+
+
+def test_partially_copied_torrent_is_retried(new_session, tmp_path):
+    torrent_path, _ = make_torrent(str(tmp_path / 'source'), [('a.bin', 40000)])
+    with open(torrent_path, 'rb') as f:
+        contents = f.read()
+    watch_dir = tmp_path / 'watch'
+    watch_dir.mkdir()
+    new_session.watch(str(watch_dir))
+
+    # 种子文件还在复制中，加载失败
+    copied = watch_dir / 'data.torrent'
+    copied.write_bytes(contents[:len(contents) // 2])
+    scan(new_session)
+    assert not new_session.downloads
+    # 文件没有变化时不再重试
+    scan(new_session)
+    assert list(new_session.failed_watch_files) == [str(copied)]
+
+    copied.write_bytes(contents)
+    scan(new_session)
+    assert len(new_session.downloads) == 1
+    assert str(copied) in new_session.watched_files
+    assert not new_session.failed_watch_files
+
+
+def test_other_files_in_watch_directory_are_ignored(new_session, tmp_path):
+    watch_dir = tmp_path / 'watch'
+    watch_dir.mkdir()
+    (watch_dir / 'notes.txt').write_bytes(b'not a torrent')
+    new_session.watch(str(watch_dir))
+    scan(new_session)
+    assert not new_session.downloads
+    assert not new_session.failed_watch_files
+    assert os.path.exists(str(watch_dir / 'notes.txt'))
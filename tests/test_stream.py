@@ -0,0 +1,101 @@
+import io
+import time
+import asyncio
+from threading import Thread
+
+import pytest
+from pubsub import pub
+
+import torrent
+import disk_io
+import download
+import peers_manager
+from block import BLOCK_SIZE
+from file_table import Priority
+from conftest import make_torrent
+
+PIECE_LENGTH = 32 * 1024
+# b.bin占据片段1-7
+FILES = [('a.bin', 40000), ('b.bin', 200000), ('c.bin', 10000)]
+
+
+# 还没有下载任何片段的种子，pieces为每个片段的数据
+@pytest.fixture
+def downloading(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path / 'source'), FILES, PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager = peers_manager.PeersManager(listen_port=0)
+    new_download = download.Download(torrent.Torrent().load_from_path(torrent_path), manager, disk_io.DiskIO(),
+                                     file_priorities={1: Priority.SKIP})
+    assert new_download.checked.wait(10)
+    data = b''.join(contents[path] for path, _ in FILES)
+    yield new_download, contents, [data[i:i + PIECE_LENGTH] for i in range(0, len(data), PIECE_LENGTH)]
+    manager.listen_socket.close()
+    new_download.pieces_manager.disk_io.close()
+
+
+def send_piece(new_download, index, data):
+    for offset in range(0, len(data), BLOCK_SIZE):
+        pub.sendMessage('PiecesManager.Piece', piece=(index, offset, data[offset:offset + BLOCK_SIZE]),
+                        info_hash=new_download.torrent.info_hash, source='127.0.0.1:6881')
+
+
+def test_pieces_ahead_of_read_position_come_first(downloading):
+    new_download, contents, pieces = downloading
+    picker = new_download.piece_picker
+    file_stream = new_download.open_stream(1, readahead=2 * PIECE_LENGTH)
+    # 不下载的文件被流式读取时改为下载
+    assert new_download.pieces_manager.file_table.priorities[1] == Priority.NORMAL
+    assert picker.pick_order()[:3] == [1, 2, 0]
+
+    file_stream.seek(100000)
+    assert picker.pick_order()[:3] == [4, 5, 0]
+    # 已下载的片段移出优先窗口
+    send_piece(new_download, 4, pieces[4])
+    new_download.pieces_manager.disk_io.close()
+    assert picker.pick_order()[:2] == [5, 0]
+
+    file_stream.close()
+    assert picker.pick_order()[:3] == [0, 1, 2]
+
+
+def test_read_returns_as_soon_as_the_piece_is_written(downloading):
+    new_download, contents, pieces = downloading
+    file_stream = new_download.open_stream('data/b.bin', timeout=10)
+    result = []
+    reader = Thread(target=lambda: result.append(file_stream.read(100000)))
+    reader.start()
+    time.sleep(0.1)
+    assert not result
+    # 读取位置所在的片段1写入后立即返回，最多读取到片段末尾
+    send_piece(new_download, 1, pieces[1])
+    reader.join(10)
+    assert result == [contents['b.bin'][:2 * PIECE_LENGTH - 40000]]
+    assert file_stream.tell() == 2 * PIECE_LENGTH - 40000
+
+    for index in range(2, 8):
+        send_piece(new_download, index, pieces[index])
+    with io.BufferedReader(file_stream) as buffered:
+        assert buffered.read() == contents['b.bin'][2 * PIECE_LENGTH - 40000:]
+
+
+def test_read_times_out_when_piece_is_missing(downloading):
+    new_download, contents, pieces = downloading
+    file_stream = new_download.open_stream(2, timeout=0.2)
+    with pytest.raises(TimeoutError):
+        file_stream.read(10)
+    file_stream.close()
+    with pytest.raises(ValueError):
+        file_stream.read(10)
+
+
+def test_async_stream(downloading):
+    new_download, contents, pieces = downloading
+    send_piece(new_download, 7, pieces[7])
+
+    async def read():
+        async with new_download.open_stream(2, asynchronous=True, timeout=10) as file_stream:
+            await file_stream.seek(-100, io.SEEK_END)
+            return await file_stream.read(), await file_stream.tell()
+
+    assert asyncio.run(read()) == (contents['c.bin'][-100:], 10000)
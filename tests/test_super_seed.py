@@ -0,0 +1,174 @@
+import time
+import socket
+
+import pytest
+
+import peer
+import choker
+import torrent
+import message
+import super_seed
+import peers_manager
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent, start_manager, stop_manager, WirePeer
+
+PIECE_LENGTH = 32 * 1024
+NUMBER_OF_PIECES = 4
+
+
+# 已拥有全部片段的片段管理器
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    torrent_path, _ = make_torrent(str(tmp_path), [('a.bin', NUMBER_OF_PIECES * PIECE_LENGTH)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path))
+    for index in range(manager.number_of_pieces):
+        manager.set_piece_completed(index)
+    yield manager
+    manager.disk_io.close()
+
+
+# 已握手的下载者，remotes记录对等方套接字的另一端
+@pytest.fixture
+def downloaders(storage):
+    peers = []
+    remotes = []
+
+    def add(count):
+        for _ in range(count):
+            new_peer = peer.Peer(NUMBER_OF_PIECES, '10.0.0.%d' % (len(peers) + 1),
+                                 info_hash=storage.torrent.info_hash)
+            new_peer.socket, remote = socket.socketpair()
+            new_peer.socket.setblocking(False)
+            remote.setblocking(False)
+            new_peer.healthy = True
+            new_peer.has_handshaked = True
+            peers.append(new_peer)
+            remotes.append(remote)
+        return peers
+
+    yield add
+    for new_peer, remote in zip(peers, remotes):
+        new_peer.socket.close()
+        remote.close()
+
+
+def test_active_only_with_all_pieces(storage):
+    seeder = super_seed.SuperSeeder(storage)
+    assert seeder.is_active()
+    storage.bitfield[1] = False
+    assert not seeder.is_active()
+
+
+def test_each_peer_is_offered_a_different_piece(storage, downloaders):
+    seeder = super_seed.SuperSeeder(storage)
+    peers = downloaders(NUMBER_OF_PIECES)
+    for new_peer in peers:
+        seeder.peer_handshaked(new_peer, peers)
+    offered = [new_peer.super_seed_pieces for new_peer in peers]
+    assert all(len(pieces) == 1 for pieces in offered)
+    assert sorted(pieces[0] for pieces in offered) == list(range(NUMBER_OF_PIECES))
+    assert seeder.can_upload(peers[0], offered[0][0])
+    assert not seeder.can_upload(peers[0], offered[1][0])
+
+
+def test_new_piece_is_offered_once_the_piece_spreads(storage, downloaders):
+    seeder = super_seed.SuperSeeder(storage)
+    first, second = downloaders(2)
+    peers = [first, second]
+    seeder.peer_handshaked(first, peers)
+    seeder.peer_handshaked(second, peers)
+    piece = first.super_seed_pieces[0]
+
+    # 第一个对等方下载完成后还不会得到新的片段
+    first.bit_field[piece] = True
+    seeder.peer_has(first, piece, peers)
+    assert first.super_seed_pieces == [piece]
+    # 第二个对等方从它那里得到该片段后，第一个对等方才会被告知新的片段
+    second.bit_field[piece] = True
+    seeder.peer_has(second, piece, peers)
+    assert len(first.super_seed_pieces) == 2
+    assert first.super_seed_pieces[1] not in (piece, second.super_seed_pieces[0])
+
+
+def test_lone_peer_is_not_stalled(storage, downloaders):
+    seeder = super_seed.SuperSeeder(storage)
+    peers = downloaders(1)
+    lone = peers[0]
+    seeder.peer_handshaked(lone, peers)
+    for _ in range(NUMBER_OF_PIECES):
+        piece = lone.super_seed_pieces[-1]
+        lone.bit_field[piece] = True
+        seeder.peer_has(lone, piece, peers)
+    assert sorted(lone.super_seed_pieces) == list(range(NUMBER_OF_PIECES))
+
+
+def test_piece_that_never_spreads_times_out(storage, downloaders):
+    seeder = super_seed.SuperSeeder(storage)
+    first, second = downloaders(2)
+    peers = [first, second]
+    seeder.peer_handshaked(first, peers)
+    seeder.peer_handshaked(second, peers)
+    first.bit_field[first.super_seed_pieces[0]] = True
+
+    seeder.update(first.info_hash, peers)
+    assert len(first.super_seed_pieces) == 1
+    first.super_seed_offered_at = time.time() - super_seed.SUPER_SEED_TIMEOUT - 1
+    second.super_seed_offered_at = time.time() - super_seed.SUPER_SEED_TIMEOUT - 1
+    seeder.update(first.info_hash, peers)
+    assert len(first.super_seed_pieces) == 2
+    # 还没有下载完告知的片段的对等方继续等待
+    assert len(second.super_seed_pieces) == 1
+
+
+def test_requests_for_pieces_not_offered_are_rejected(storage, downloaders):
+    manager = peers_manager.PeersManager(listen_port=0)
+    try:
+        manager.add_torrent(storage.torrent, storage)
+        manager.set_super_seeding(storage.torrent.info_hash, True)
+        new_peer = downloaders(1)[0]
+        new_peer.supports_fast = True
+        manager.peers.append(new_peer)
+        manager.peer_handshaked(new_peer)
+        offered = new_peer.super_seed_pieces[0]
+        other = (offered + 1) % NUMBER_OF_PIECES
+
+        manager.peer_requests_piece(message.Request(offered, 0, BLOCK_SIZE), new_peer)
+        manager.peer_requests_piece(message.Request(other, 0, BLOCK_SIZE), new_peer)
+        assert list(new_peer.upload_queue.requests) == [(offered, 0, BLOCK_SIZE)]
+    finally:
+        manager.listen_socket.close()
+
+
+# 在事件循环中超级做种的对等方管理器
+@pytest.fixture
+def running(storage, monkeypatch):
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    monkeypatch.setattr(choker.Choker, 'update', lambda self: None)
+    manager = peers_manager.PeersManager(listen_port=0)
+    manager.add_torrent(storage.torrent, storage)
+    manager.set_super_seeding(storage.torrent.info_hash, True)
+    yield storage.torrent.info_hash, start_manager(manager)
+    stop_manager(manager)
+
+
+def test_connecting_peer_sees_a_single_piece(running):
+    info_hash, port = running
+    wire = WirePeer(port, info_hash)
+    try:
+        assert wire.receive_until(lambda: wire.received(message.Have))
+        wire.receive_until(lambda: False, 0.5)
+        # 不发送位场和允许快速请求的片段，只告知一个片段
+        assert type(wire.messages[0]) is message.HaveNone
+        assert not wire.received(message.BitField) and not wire.received(message.HaveAll)
+        assert not wire.received(message.AllowedFast)
+        assert len(wire.received(message.Have)) == 1
+
+        # 下载者宣告拥有该片段，只有它一个下载者时直接告知新的片段
+        piece = wire.received(message.Have)[0].piece_index
+        wire.send(message.Have(piece).to_bytes())
+        assert wire.receive_until(lambda: len(wire.received(message.Have)) == 2)
+        assert wire.received(message.Have)[1].piece_index != piece
+    finally:
+        wire.close()
@@ -0,0 +1,117 @@
+import time
+import socket
+
+import pytest
+
+import peer
+import message
+import peers_manager
+from block import BLOCK_SIZE
+
+INFO_HASH = b'\x02' * 20
+
+
+# 不启动事件循环的对等方管理器，不连接候选对等方
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(peers_manager.PeersManager, '_connect_candidates', lambda self: None)
+    new_manager = peers_manager.PeersManager(listen_port=0, max_peers=3)
+    # 对等方套接字另一端，按对等方加入的顺序排列
+    new_manager.remotes = []
+    yield new_manager
+    new_manager.listen_socket.close()
+    for new_peer in new_manager.peers:
+        new_peer.socket.close()
+    for remote in new_manager.remotes:
+        remote.close()
+
+
+# 已握手且解除了阻塞的对等方，上个统计周期内下载了downloaded字节
+def add_peer(manager, number, downloaded=0):
+    new_peer = peer.Peer(4, '10.0.0.%d' % number, info_hash=INFO_HASH)
+    new_peer.socket, remote = socket.socketpair()
+    new_peer.socket.setblocking(False)
+    remote.settimeout(1)
+    manager.remotes.append(remote)
+    new_peer.healthy = True
+    new_peer.has_handshaked = True
+    new_peer.state['peer_choking'] = False
+    new_peer.rate_timestamp = time.time() - 1
+    new_peer.downloaded = downloaded
+    new_peer.last_call = time.time()
+    manager.peers.append(new_peer)
+    return new_peer
+
+
+def snub(new_peer):
+    new_peer.last_piece = time.time() - peer.SNUB_TIMEOUT - 1
+    new_peer.last_request = time.time()
+
+
+def test_snubbed_peer_gets_a_single_request():
+    new_peer = peer.Peer(4, '10.0.0.1')
+    new_peer.state['peer_choking'] = False
+    assert not new_peer.is_snubbed()
+    snub(new_peer)
+    assert new_peer.is_snubbed()
+    assert new_peer.can_request()
+    new_peer.outstanding_requests[(0, 0)] = time.time()
+    assert not new_peer.can_request()
+
+    # 收到数据块后恢复
+    new_peer.handle_piece(message.Piece(BLOCK_SIZE, 0, 0, bytes(BLOCK_SIZE)))
+    assert not new_peer.is_snubbed()
+    # 被阻塞时不算被冷落
+    snub(new_peer)
+    new_peer.state['peer_choking'] = True
+    assert not new_peer.is_snubbed()
+
+
+def test_snubbed_peer_is_turned_over_first(manager):
+    add_peer(manager, 1, downloaded=1000)
+    snubbed = add_peer(manager, 2, downloaded=50000)
+    add_peer(manager, 3, downloaded=20000)
+    snub(snubbed)
+    manager.add_candidates(INFO_HASH, [('10.0.0.9', 6881)])
+
+    now = time.time()
+    manager._turnover_slowest_peer(now)
+    assert snubbed not in manager.peers
+    assert manager.candidates_tried[(INFO_HASH, '10.0.0.2:6881')] == now
+
+
+def test_slowest_peer_is_turned_over(manager):
+    add_peer(manager, 1, downloaded=1000)
+    add_peer(manager, 2, downloaded=50000)
+    add_peer(manager, 3, downloaded=20000)
+    # 没有可以尝试的候选对等方时不淘汰
+    manager._turnover_slowest_peer(time.time())
+    assert len(manager.peers) == 3
+
+    manager.add_candidates(INFO_HASH, [('10.0.0.9', 6881)])
+    manager._turnover_slowest_peer(time.time())
+    assert [new_peer.ip for new_peer in manager.peers] == ['10.0.0.2', '10.0.0.3']
+
+
+def test_turnover_only_when_connections_are_full(manager):
+    add_peer(manager, 1)
+    add_peer(manager, 2)
+    manager.add_candidates(INFO_HASH, [('10.0.0.9', 6881)])
+    manager._turnover_slowest_peer(time.time())
+    assert len(manager.peers) == 2
+
+
+def test_keep_alive_and_idle_timeout(manager):
+    idle = add_peer(manager, 1)
+    quiet = add_peer(manager, 2)
+    active = add_peer(manager, 3)
+    idle.last_call = time.time() - peers_manager.KEEP_ALIVE_INTERVAL - 1
+    quiet.last_received = time.time() - peers_manager.PEER_TIMEOUT - 1
+    manager._maintain_peers()
+
+    assert manager.remotes[0].recv(4) == message.KeepAlive().to_bytes()
+    assert quiet not in manager.peers
+    assert active in manager.peers
+    manager.remotes[2].settimeout(0.1)
+    with pytest.raises(socket.timeout):
+        manager.remotes[2].recv(4)
@@ -0,0 +1,176 @@
+import os
+import socket
+import struct
+
+import pytest
+
+import peer
+import message
+import torrent
+import upload_queue
+import pieces_manager
+from block import BLOCK_SIZE
+from conftest import make_torrent
+
+HEADER = upload_queue.PIECE_HEADER_LENGTH
+PIECE_LENGTH = 64 * 1024
+
+
+def request(piece_index, block_offset, block_length=BLOCK_SIZE):
+    return message.Request(piece_index, block_offset, block_length)
+
+
+# 所有片段都已写入磁盘的片段管理器，以及每个片段的数据
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    torrent_path, contents = make_torrent(str(tmp_path), [('a.bin', 4 * PIECE_LENGTH - 1000)], PIECE_LENGTH)
+    monkeypatch.chdir(tmp_path)
+    manager = pieces_manager.PiecesManager(torrent.Torrent().load_from_path(torrent_path))
+    for index in range(manager.number_of_pieces):
+        manager.set_piece_completed(index)
+    data = contents['a.bin']
+    yield manager, [data[i:i + PIECE_LENGTH] for i in range(0, len(data), PIECE_LENGTH)]
+    manager.disk_io.close()
+
+
+# 用本地套接字对模拟的对等方，返回对等方和另一端的套接字
+@pytest.fixture
+def wire(storage):
+    local, remote = socket.socketpair()
+    local.setblocking(False)
+    new_peer = peer.Peer(storage[0].number_of_pieces, '127.0.0.1')
+    new_peer.socket = local
+    new_peer.healthy = True
+    remote.settimeout(5)
+    yield new_peer, remote
+    local.close()
+    remote.close()
+
+
+# 发送缓冲区中的数据全部发出后，读取另一端收到的消息
+def receive(new_peer, remote):
+    data = b''
+    while True:
+        new_peer.flush()
+        remote.settimeout(0.2)
+        try:
+            chunk = remote.recv(1024 * 1024)
+        except socket.timeout:
+            if not new_peer.write_buffer:
+                break
+            continue
+        data += chunk
+    messages = []
+    while data:
+        length, = struct.unpack('>I', data[:4])
+        messages.append(message.MessageDispatcher(data[:4 + length]).dispatch())
+        data = data[4 + length:]
+    return messages
+
+
+def test_piece_header_length():
+    assert len(upload_queue.piece_header(1, 0, BLOCK_SIZE)) == HEADER
+
+
+def test_queued_bytes_follow_add_cancel_pop_and_clear():
+    queue = upload_queue.UploadQueue()
+    for offset in range(0, 4 * BLOCK_SIZE, BLOCK_SIZE):
+        assert queue.add(request(0, offset))
+    assert queue.add(request(1, 0, 1000))
+    # 重复的请求不计入
+    assert not queue.add(request(1, 0, 1000))
+    assert queue.queued_bytes == 5 * HEADER + 4 * BLOCK_SIZE + 1000
+
+    assert queue.cancel(0, 3 * BLOCK_SIZE, BLOCK_SIZE) is not None
+    assert queue.cancel(0, 3 * BLOCK_SIZE, BLOCK_SIZE) is None
+    assert queue.queued_bytes == 4 * HEADER + 3 * BLOCK_SIZE + 1000
+
+    # 片段0的三个相邻请求合并为一次读取
+    assert len(queue.pop_run()) == 3
+    assert queue.queued_bytes == HEADER + 1000
+
+    queue.add(request(2, 0))
+    assert len(queue.clear(keep={2})) == 1
+    assert queue.queued_bytes == HEADER + BLOCK_SIZE
+    queue.clear()
+    assert queue.queued_bytes == 0
+
+
+def test_duplicate_requests_and_full_queue_are_refused():
+    queue = upload_queue.UploadQueue(max_requests=2)
+    assert queue.add(request(0, 0))
+    assert not queue.add(request(0, 0))
+    assert queue.add(request(0, BLOCK_SIZE))
+    assert not queue.add(request(1, 0))
+    assert len(queue) == 2
+
+
+def test_pop_run_coalesces_adjacent_requests_of_one_piece():
+    queue = upload_queue.UploadQueue()
+    blocks = upload_queue.MAX_COALESCE_SIZE // BLOCK_SIZE
+    for offset in range(0, (blocks + 2) * BLOCK_SIZE, BLOCK_SIZE):
+        queue.add(request(0, offset))
+    queue.add(request(1, 0))
+    queue.add(request(1, 2 * BLOCK_SIZE))
+
+    # 合并读取的总长度有上限
+    assert [r.block_offset for r in queue.pop_run()] == [i * BLOCK_SIZE for i in range(blocks)]
+    assert [r.block_offset for r in queue.pop_run()] == [blocks * BLOCK_SIZE, (blocks + 1) * BLOCK_SIZE]
+    # 其他片段和不相邻的请求不合并
+    assert [r.block_offset for r in queue.pop_run()] == [0]
+    assert [r.block_offset for r in queue.pop_run()] == [2 * BLOCK_SIZE]
+    assert not queue
+
+
+def test_uploader_sends_requested_blocks_in_order(storage, wire):
+    manager, pieces = storage
+    new_peer, remote = wire
+    requests = [request(1, BLOCK_SIZE), request(1, 2 * BLOCK_SIZE), request(0, 0),
+                request(3, 3 * BLOCK_SIZE, len(pieces[3]) - 3 * BLOCK_SIZE)]
+    for r in requests:
+        assert new_peer.upload_queue.add(r)
+    uploader = upload_queue.Uploader()
+    uploader.serve(new_peer, manager)
+    uploader.close()
+
+    messages = receive(new_peer, remote)
+    assert [(m.piece_index, m.block_offset) for m in messages] == [(r.piece_index, r.block_offset) for r in requests]
+    for r, m in zip(requests, messages):
+        assert m.block == pieces[r.piece_index][r.block_offset:r.block_offset + r.block_length]
+    length = sum(r.block_length for r in requests)
+    assert new_peer.uploaded == length
+    assert uploader.sendfile_bytes + uploader.read_bytes == length
+    if hasattr(os, 'sendfile'):
+        assert uploader.sendfile_bytes > 0
+    assert new_peer.upload_queue.queued_bytes == 0
+
+
+def test_cancelled_request_is_not_sent(storage, wire):
+    manager, pieces = storage
+    new_peer, remote = wire
+    new_peer.supports_fast = True
+    for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+        new_peer.upload_queue.add(request(2, offset))
+    new_peer.handle_cancel(message.Cancel(2, BLOCK_SIZE, BLOCK_SIZE))
+    uploader = upload_queue.Uploader()
+    uploader.serve(new_peer, manager)
+    uploader.close()
+
+    messages = receive(new_peer, remote)
+    # 支持快速扩展的对等方取消成功时收到拒绝
+    assert isinstance(messages[0], message.RejectRequest)
+    assert (messages[0].piece_index, messages[0].block_offset) == (2, BLOCK_SIZE)
+    assert [m.block_offset for m in messages[1:]] == [0, 2 * BLOCK_SIZE, 3 * BLOCK_SIZE]
+
+
+def test_unreadable_blocks_are_rejected(storage, wire):
+    manager, pieces = storage
+    new_peer, remote = wire
+    new_peer.supports_fast = True
+    os.remove('data')
+    new_peer.upload_queue.add(request(0, 0))
+    upload_queue.Uploader().serve(new_peer, manager)
+
+    messages = receive(new_peer, remote)
+    assert len(messages) == 1 and isinstance(messages[0], message.RejectRequest)
+    assert new_peer.uploaded == 0
@@ -0,0 +1,128 @@
+import os
+from threading import Thread
+
+import pytest
+
+import utp
+from conftest import pump
+
+
+# 代替对等方管理器，记录接受的连接
+class Acceptor(object):
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.streams = []
+
+    def accept_stream(self, sock, ip, port, is_utp=False):
+        if not self.accept:
+            return False
+        sock.setblocking(False)
+        self.streams.append(sock)
+        return True
+
+
+# 每发送drop_every个数据包丢弃一个，模拟有丢包的链路
+def inject_loss(manager, drop_every):
+    send = manager.send
+    count = [0]
+
+    def lossy_send(data, address):
+        count[0] += 1
+        if count[0] % drop_every:
+            send(data, address)
+
+    manager.send = lossy_send
+
+
+# 在连接线程中发起连接，同时驱动两个端点，返回对等方使用的套接字
+def connect(client, server, timeout=utp.CONNECT_TIMEOUT):
+    result = {}
+    connector = Thread(target=lambda: result.update(sock=client.connect('127.0.0.1', server.socket.getsockname()[1],
+                                                                        timeout)), daemon=True)
+    connector.start()
+    pump([client, server], lambda: not connector.is_alive(), timeout + 5)
+    return result.get('sock')
+
+
+# 双方同时发送数据，直到都收到对方的全部数据
+def exchange(managers, sender, receiver, data, reply):
+    sender.setblocking(False)
+    state = {'sent': 0, 'replied': 0, 'received': b'', 'answer': b''}
+
+    def done():
+        try:
+            state['sent'] += sender.send(data[state['sent']:state['sent'] + 65536])
+        except BlockingIOError:
+            pass
+        try:
+            state['replied'] += receiver.send(reply[state['replied']:state['replied'] + 65536])
+        except BlockingIOError:
+            pass
+        try:
+            state['received'] += receiver.recv(65536)
+        except BlockingIOError:
+            pass
+        try:
+            state['answer'] += sender.recv(65536)
+        except BlockingIOError:
+            pass
+        return len(state['received']) == len(data) and len(state['answer']) == len(reply)
+
+    assert pump(managers, done, 60)
+    return state['received'], state['answer']
+
+
+def close(managers):
+    for manager in managers:
+        for connection in list(manager.connections.values()):
+            connection.close()
+            connection.remote_end.close()
+        manager.socket.close()
+
+
+@pytest.mark.parametrize('drop_every', [0, 20, 10])
+def test_transfer_over_lossy_link(drop_every):
+    acceptor = Acceptor()
+    server = utp.UTP(acceptor, 0)
+    client = utp.UTP(acceptor, 0)
+    managers = [client, server]
+    try:
+        if drop_every:
+            inject_loss(client, drop_every)
+            inject_loss(server, drop_every)
+        sock = connect(client, server)
+        assert sock is not None
+        assert len(acceptor.streams) == 1
+
+        data = os.urandom(512 * 1024)
+        reply = os.urandom(64 * 1024)
+        received, answer = exchange(managers, sock, acceptor.streams[0], data, reply)
+        # 数据按顺序完整送达，没有重复
+        assert received == data
+        assert answer == reply
+    finally:
+        close(managers)
+
+
+def test_refused_connection_is_reset():
+    server = utp.UTP(Acceptor(accept=False), 0)
+    client = utp.UTP(Acceptor(), 0)
+    managers = [client, server]
+    try:
+        assert connect(client, server) is None
+        assert not server.connections
+        assert pump(managers, lambda: not client.connections)
+    finally:
+        close(managers)
+
+
+def test_connect_times_out_without_answer():
+    client = utp.UTP(Acceptor(), 0)
+    silent = utp.UTP(Acceptor(), 0)
+    try:
+        # 连接请求全部丢失
+        inject_loss(client, 1)
+        assert connect(client, silent, timeout=0.5) is None
+        assert pump([client], lambda: not client.connections)
+    finally:
+        close([client, silent])
@@ -0,0 +1,146 @@
+import os
+import re
+import time
+import functools
+import http.server
+from threading import Thread
+
+import pytest
+
+import torrent
+import web_seed
+import pieces_manager
+from file_table import Priority
+from conftest import make_torrent
+
+PIECE_LENGTH = 32 * 1024
+# 文件大小不是片段长度的整数倍，文件之间需要填充
+FILES = [('a.bin', 40000), ('sub/b.bin', 70000), ('sub/c.bin', 5000)]
+
+
+# 支持范围请求的静态文件服务器，记录每个请求的路径
+class RangeHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    supports_ranges = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requested.append(self.path)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        match = re.match(r'bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if match and self.supports_ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class NoRangeHandler(RangeHandler):
+    supports_ranges = False
+
+
+def serve(directory, handler=RangeHandler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    server.requested = []
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# 只从网络种子下载，直到需要的片段全部写入磁盘，skip为不下载的文件在种子中的相对路径
+def download(torrent_path, skip=(), timeout=30):
+    new_torrent = torrent.Torrent().load_from_path(torrent_path)
+    # 文件编号包括填充文件
+    priorities = {index: Priority.SKIP for index, file in enumerate(new_torrent.file_names)
+                  if os.path.relpath(file['path'], 'data').replace(os.sep, '/') in skip}
+    manager = pieces_manager.PiecesManager(new_torrent, priorities=priorities)
+    seed = web_seed.WebSeed(new_torrent.url_list[0], new_torrent, manager)
+    wanted = [index for index in range(manager.number_of_pieces) if manager.is_wanted(index)]
+    deadline = time.time() + timeout
+    while not all(manager.bitfield[index] for index in wanted) and time.time() < deadline:
+        seed.update(range(manager.number_of_pieces))
+        time.sleep(0.01)
+    manager.disk_io.close()
+    return manager, seed
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+    www = tmp_path / 'www'
+    www.mkdir()
+    downloads = tmp_path / 'downloads'
+    downloads.mkdir()
+    # 下载的文件保存在当前目录下
+    monkeypatch.chdir(downloads)
+    return www, downloads
+
+
+@pytest.mark.parametrize('meta_version, pad', [(1, False), (1, True), (2, True)])
+def test_multi_file_download(site, meta_version, pad):
+    www, downloads = site
+    server = serve(str(www))
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        torrent_path, contents = make_torrent(str(www), FILES, PIECE_LENGTH, meta_version, pad, [url])
+        manager, seed = download(torrent_path)
+
+        assert manager.bitfield.all(True)
+        assert seed.downloaded > 0
+        for path, data in contents.items():
+            with open(os.path.join(str(downloads), 'data', *path.split('/')), 'rb') as f:
+                assert f.read() == data
+        # 填充文件的数据直接补0，既不会被请求，也不会在磁盘上创建
+        assert not any('.pad' in path for path in server.requested)
+        assert not os.path.exists(os.path.join(str(downloads), 'data', '.pad'))
+        # 每个请求都是一个文件中的字节范围
+        assert all(path.startswith('/data/') for path in server.requested)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_skipped_file_is_not_requested(site):
+    www, downloads = site
+    server = serve(str(www))
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        torrent_path, contents = make_torrent(str(www), FILES, PIECE_LENGTH, 2, url_list=[url])
+        manager, seed = download(torrent_path, skip=['sub/b.bin'])
+
+        with open(os.path.join(str(downloads), 'data', 'a.bin'), 'rb') as f:
+            assert f.read() == contents['a.bin']
+        assert '/data/sub/b.bin' not in server.requested
+        assert not os.path.exists(os.path.join(str(downloads), 'data', 'sub', 'b.bin'))
+        assert '/data/sub/c.bin' in server.requested
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_without_range_support(site):
+    www, downloads = site
+    server = serve(str(www), NoRangeHandler)
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        torrent_path, contents = make_torrent(str(www), FILES, PIECE_LENGTH, 1, True, [url])
+        manager, seed = download(torrent_path)
+
+        assert manager.bitfield.all(True)
+        for path, data in contents.items():
+            with open(os.path.join(str(downloads), 'data', *path.split('/')), 'rb') as f:
+                assert f.read() == data
+    finally:
+        server.shutdown()
+        server.server_close()
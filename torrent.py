@@ -4,9 +4,9 @@ __author__ = 'alexisgallepe'
 
 import hashlib
 import time
-from bcoding import bencode, bdecode
 import logging
 import os
+from torrent_decoder import TorrentDecoder
 
 
 class Torrent(object):
@@ -17,64 +17,92 @@ class Torrent(object):
         self.total_length: int = 0
         # 每个片段的长度
         self.piece_length: int = 0
-        # 片段的哈希值
-        self.pieces: int = 0
-        # 种子的哈希值
+        # 片段的哈希值，为种子文件原始数据的memoryview
+        self.pieces: memoryview = memoryview(b'')
+        # 种子的哈希值，v2种子为SHA-256哈希值截断后的20字节，用于握手和tracker
         self.info_hash: str = ''
+        # v2种子完整的SHA-256哈希值
+        self.info_hash_v2: bytes = b''
+        # 种子的版本，1为v1种子，2为v2种子或同时兼容v1和v2的混合种子（BEP 52）
+        self.meta_version: int = 1
+        # 是否为混合种子
+        self.is_hybrid: bool = False
+        # v2种子每个文件的片段层哈希值，以文件的根哈希值为关键字
+        self.piece_layers = {}
         # 用于存储本客户端生成的peer id
         self.peer_id: str = ''
         # trackers地址列表
         self.announce_list = ''
+        # 网络种子（BEP 19）的地址列表，可以通过HTTP下载种子中的文件
+        self.url_list = []
         # 种子中所有文件的文件路径
         self.file_names = []
         # 片段数量
         self.number_of_pieces: int = 0
 
     def load_from_path(self, path):
-        # 读取文件并编码为字典
+        # 读取文件并解码为字典
         with open(path, 'rb') as file:
-            contents = bdecode(file)
+            decoder = TorrentDecoder(file.read())
+        contents = decoder.decode()
 
         self.torrent_file = contents
         # 提取信息
         self.piece_length = self.torrent_file['info']['piece length']
-        self.pieces = self.torrent_file['info']['pieces']
-        # 将info信息重新编码为bencode格式
-        raw_info_hash = bencode(self.torrent_file['info'])
+        self.meta_version = self.torrent_file['info'].get('meta version', 1)
+        # v2种子没有v1的片段哈希值
+        self.pieces = self.torrent_file['info'].get('pieces', memoryview(b''))
+        self.is_hybrid = self.meta_version == 2 and len(self.pieces) > 0
+        # 直接取出info信息在种子文件中的原始字节，无需重新编码为bencode格式
+        raw_info_hash = decoder.raw_info()
         # 使用sha1计算raw_info_hash的哈希值，并保存为字节字符串，用作种子文件的唯一标识
-        self.info_hash = hashlib.sha1(raw_info_hash).digest()
+        # 混合种子仍然使用v1的哈希值，以便与只支持v1的对等方通信；v2种子使用截断的SHA-256哈希值
+        if self.meta_version == 2:
+            self.info_hash_v2 = hashlib.sha256(raw_info_hash).digest()
+            self.piece_layers = {bytes(root): bytes(layer)
+                                 for root, layer in self.torrent_file.get('piece layers', {}).items()}
+        if self.meta_version == 2 and not self.is_hybrid:
+            self.info_hash = self.info_hash_v2[:20]
+        else:
+            self.info_hash = hashlib.sha1(raw_info_hash).digest()
         # 为本客户端基于当前时间生成peer id
         self.peer_id = self.generate_peer_id()
         # 从种子文件信息中获取trackers地址列表
         self.announce_list = self.get_trakers()
+        # 获取网络种子的地址列表
+        self.url_list = self.get_url_list()
         # 初始化文件系统，创建文件目录，并存储文件路径
         self.init_files()
-        # 计算片段数量
-        self.number_of_pieces = math.ceil(self.total_length / self.piece_length)
+        # 计算片段数量，v2种子的文件按片段对齐，需要计入文件之间的填充
+        layout_length = sum(file["length"] for file in self.file_names)
+        self.number_of_pieces = math.ceil(layout_length / self.piece_length)
         logging.debug(self.announce_list)
-        logging.debug(self.file_names)
+        logging.debug("%d file(s)" % len(self.file_names))
         # 检查种子中的文件大小和文件数量，如果为0则触发异常
         assert(self.total_length > 0)
         assert(len(self.file_names) > 0)
 
         return self
 
+    # 记录种子中所有文件的路径和大小，目录和文件在第一次写入时才创建，见file_table.FileTable.open_for_writing
     def init_files(self):
         # 获取种子中根目录的路径
         root = self.torrent_file['info']['name']
+        # v2种子和混合种子使用file tree中的文件信息
+        if self.meta_version == 2:
+            self._init_file_tree(root)
+            return
         # 如果有files字段，则表明种子中包含多个文件
         if 'files' in self.torrent_file['info']:
-            if not os.path.exists(root):
-                # 创建根目录，并定义其权限为没有特殊权限设定（0），所有者读写执行（4+2+1），用户和访客读写（4+2）
-                os.mkdir(root, 0o0766 )
             # 遍历根目录下的所有文件路径
             for file in self.torrent_file['info']['files']:
                 # 将文件路径的各个部分同根目录拼接起来
                 # file["path"]的结构形如["music", "song.mp3"]
                 path_file = os.path.join(root, *file["path"])
-                # 检查该文件的父路径是否存在，若不存在则创建该父路径
-                if not os.path.exists(os.path.dirname(path_file)):
-                    os.makedirs(os.path.dirname(path_file))
+                # 填充文件（BEP 47）只用于对齐片段边界，与v2种子的填充一样不在磁盘上创建，也不计入种子大小
+                if 'p' in file.get('attr', ''):
+                    self.file_names.append({"path": path_file, "length": file["length"], "pad": True})
+                    continue
                 # 存储文件路径，并附上文件大小
                 self.file_names.append({"path": path_file , "length": file["length"]})
                 # 更新种子的总大小
@@ -84,6 +112,41 @@ class Torrent(object):
             self.file_names.append({"path": root , "length": self.torrent_file['info']['length']})
             self.total_length = self.torrent_file['info']['length']
 
+    # 解析v2种子的file tree，每个文件都从新的片段开始，文件之间用填充补齐到片段边界
+    # 填充只用于计算偏移量，不会在磁盘上创建，与混合种子中v1的填充文件布局相同
+    def _init_file_tree(self, root):
+        files = []
+        self._walk_file_tree(self.torrent_file['info']['file tree'], [], files)
+        # 只有一个文件且位于顶层时，文件路径就是该文件名
+        single_file = len(files) == 1 and len(files[0][0]) == 1
+
+        for i, (path, attributes) in enumerate(files):
+            length = attributes['length']
+            path_file = path[0] if single_file else os.path.join(root, *path)
+            pieces_root = bytes(attributes['pieces root']) if length > 0 else None
+            self.file_names.append({"path": path_file, "length": length, "pieces_root": pieces_root})
+            self.total_length += length
+            # 除最后一个文件外，文件末尾填充到片段边界
+            padding = -length % self.piece_length
+            if padding and i < len(files) - 1:
+                self.file_names.append({"path": os.path.join(root, '.pad', str(padding)), "length": padding,
+                                        "pad": True})
+
+    # 按照关键字顺序遍历file tree，空关键字对应的值为文件信息
+    def _walk_file_tree(self, tree, path, files):
+        for name in sorted(tree):
+            if name == '':
+                files.append((path, tree[name]))
+            else:
+                self._walk_file_tree(tree[name], path + [name], files)
+
+    # 获取网络种子的地址，url-list可以是单个地址或地址列表，只支持HTTP和HTTPS
+    def get_url_list(self):
+        url_list = self.torrent_file.get('url-list', [])
+        if not isinstance(url_list, list):
+            url_list = [url_list]
+        return [url for url in url_list if isinstance(url, str) and url.startswith(('http://', 'https://'))]
+
     def get_trakers(self):
         if 'announce-list' in self.torrent_file:
             return self.torrent_file['announce-list']
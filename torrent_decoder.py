@@ -0,0 +1,118 @@
+__author__ = 'alexisgallepe'
+
+# 以memoryview形式返回的字段，这些字段是二进制数据且可能很大，不需要尝试解码为字符串，也不需要复制
+BINARY_KEYS = {'pieces', 'pieces root'}
+# 关键字和值全部为二进制数据的字典，例如v2种子的piece layers，其关键字为文件的根哈希值，值为片段层的哈希值
+# 关键字保持为字节串，即使恰好能以utf-8解码
+BINARY_DICTS = {'piece layers'}
+
+
+# 用于抛出bencode格式错误的异常
+class DecodeError(Exception):
+    pass
+
+
+# 解码种子文件的bencode数据，与bcoding.bdecode的结果相同：字典的关键字和能以utf-8解码的字节串会被解码为字符串
+# 区别在于会记录info字典在原始数据中的字节范围，可以直接计算种子哈希值，而无需重新编码，也能正确处理非规范的编码
+# 此外pieces等二进制字段会直接返回原始数据的memoryview，不会复制
+class TorrentDecoder(object):
+    def __init__(self, data, binary_keys=BINARY_KEYS):
+        # 以memoryview形式返回的字段，解码其他bencode数据时可以指定
+        self.binary_keys = binary_keys
+        # 原始数据
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        # 顶层info字典在原始数据中的开始和结束下标
+        self.info_start = -1
+        self.info_end = -1
+
+    # 解码全部数据
+    def decode(self):
+        try:
+            value, index = self._decode(0, 0)
+        except (IndexError, ValueError) as e:
+            raise DecodeError("Invalid bencoded data : %s" % e.__str__())
+
+        if index != len(self.data):
+            raise DecodeError("Trailing data after index %d" % index)
+
+        return value
+
+    # 获取info字典的原始字节，用于计算种子哈希值
+    def raw_info(self):
+        if self.info_start < 0:
+            raise DecodeError("No info dictionary")
+
+        return self.view[self.info_start:self.info_end]
+
+    # 从下标index开始解码一个值，返回解码结果和下一个值的下标
+    # depth为嵌套的深度，顶层字典为0
+    def _decode(self, index, depth, key=None):
+        data = self.data
+        c = data[index]
+        # 字节串，格式为<长度>:<内容>
+        if 0x30 <= c <= 0x39:
+            colon = data.index(b':', index)
+            start = colon + 1
+            end = start + int(data[index:colon])
+            if end > len(data):
+                raise DecodeError("String out of range")
+
+            if key in self.binary_keys:
+                return self.view[start:end], end
+
+            raw = data[start:end]
+            try:
+                return raw.decode(), end
+            except UnicodeDecodeError:
+                return raw, end
+        # 整数，格式为i<数字>e
+        if c == 0x69:
+            end = data.index(b'e', index)
+            return int(data[index + 1:end]), end + 1
+        # 列表，格式为l<值>...e
+        if c == 0x6c:
+            items = []
+            index += 1
+            while data[index] != 0x65:
+                # 列表中的字节串（例如文件路径）直接在此解析以减少函数调用
+                if 0x30 <= data[index] <= 0x39:
+                    colon = data.index(b':', index)
+                    index = colon + 1 + int(data[index:colon])
+                    item = data[colon + 1:index]
+                    try:
+                        item = item.decode()
+                    except UnicodeDecodeError:
+                        pass
+                else:
+                    item, index = self._decode(index, depth + 1)
+                items.append(item)
+            return items, index + 1
+        # 字典，格式为d<关键字><值>...e
+        if c == 0x64:
+            result = {}
+            index += 1
+            while data[index] != 0x65:
+                # 关键字一定是字节串，直接在此解析以减少函数调用
+                colon = data.index(b':', index)
+                value_start = colon + 1 + int(data[index:colon])
+                dict_key = data[colon + 1:value_start]
+                if key not in BINARY_DICTS:
+                    try:
+                        dict_key = dict_key.decode()
+                    except UnicodeDecodeError:
+                        pass
+                index = value_start
+                # 二进制字典中的值直接返回memoryview
+                if key in BINARY_DICTS and 0x30 <= data[index] <= 0x39:
+                    colon = data.index(b':', index)
+                    index = colon + 1 + int(data[index:colon])
+                    result[dict_key] = self.view[colon + 1:index]
+                    continue
+                result[dict_key], index = self._decode(index, depth + 1, dict_key)
+                # 记录顶层info字典的字节范围
+                if depth == 0 and dict_key == 'info':
+                    self.info_start, self.info_end = value_start, index
+            return result, index + 1
+
+        raise DecodeError("Unknown type %r at index %d" % (chr(c), index))
@@ -2,7 +2,7 @@ import ipaddress
 import struct
 import peer
 from message import UdpTrackerConnection, UdpTrackerAnnounce, UdpTrackerAnnounceOutput
-from peers_manager import PeersManager
+from peers_manager import PeersManager, LISTEN_PORT, MAX_PEERS_CONNECTED
 
 __author__ = 'alexisgallepe'
 
@@ -14,8 +14,6 @@ from urllib.parse import urlparse
 
 # 尝试连接对等方的最大数量
 MAX_PEERS_TRY_CONNECT = 30
-# 最终成功连接的对等方的最大数量
-MAX_PEERS_CONNECTED = 8
 
 
 class SockAddr:
@@ -30,8 +28,10 @@ class SockAddr:
 
 
 class Tracker(object):
-    def __init__(self, torrent):
+    def __init__(self, torrent, listen_port=LISTEN_PORT):
         self.torrent = torrent
+        # 本客户端监听的端口号
+        self.listen_port = listen_port
         self.threads_list = []
         self.connected_peers = {}
         self.dict_sock_addr = {}
@@ -76,7 +76,7 @@ class Tracker(object):
             if len(self.connected_peers) >= MAX_PEERS_CONNECTED:
                 break
             # 创建对等方实例
-            new_peer = peer.Peer(int(self.torrent.number_of_pieces), sock_addr.ip, sock_addr.port)
+            new_peer = peer.Peer(int(self.torrent.number_of_pieces), sock_addr.ip, sock_addr.port, self.torrent.info_hash)
             # 尝试与对等方进行连接，如果连接失败就跳过
             # BUG: 此处应该在连接成功后立即握手，否则会被对等方重置连接，导致握手失败
             # 删除main.start中的self.peers_manager.add_peers(peers_dict.values())
@@ -98,7 +98,7 @@ class Tracker(object):
             'peer_id': torrent.peer_id, # 本客户端的peer id
             'uploaded': 0, # 已上传的字节数，初始为0
             'downloaded': 0, # 已下载的字节数，初始为0
-            'port': 6881, # 本客户端监听的端口号，用于与对等方通信
+            'port': self.listen_port, # 本客户端监听的端口号，用于与对等方通信
             'left': torrent.total_length, # 还需要下载的字节数，初始为种子总大小
             'event': 'started' # 表明初始状态，刚刚交互，要开始下载。常见的值有started、stopped和completed
         }
@@ -184,9 +184,8 @@ class Tracker(object):
         # 用响应填充实例
         tracker_connection_output.from_bytes(response)
         # 创建实例，准备发送请求，参数包含种子哈希值，从响应处获得的连接ID，以及本客户端的peer id
-        # 监听的端口号被写在UdpTrackerAnnounce.to_bytes的port里，为8000
         tracker_announce_input = UdpTrackerAnnounce(torrent.info_hash, tracker_connection_output.conn_id,
-                                                    torrent.peer_id)
+                                                    torrent.peer_id, self.listen_port)
         # 发送请求，等待响应
         response = self.send_message((ip, port), sock, tracker_announce_input)
 
@@ -0,0 +1,186 @@
+__author__ = 'alexisgallepe'
+
+import os
+import logging
+from collections import OrderedDict
+from struct import pack
+import message
+
+# 每个对等方最多排队的请求数量，超过时拒绝新的请求
+MAX_QUEUED_REQUESTS = 500
+# 对等方请求的块长度上限，超过时拒绝
+MAX_BLOCK_LENGTH = 128 * 1024
+# 一次合并读取的连续请求的最大总长度
+MAX_COALESCE_SIZE = 256 * 1024
+# 发送缓冲区中的数据少于该值时才继续处理请求，避免一次把整个请求队列读入内存
+UPLOAD_BUFFER_SIZE = 256 * 1024
+# 为sendfile保持打开的文件数量
+MAX_OPEN_FILES = 32
+
+
+# PIECE消息头部的长度：长度前缀、消息编号、片段号和块偏移量
+PIECE_HEADER_LENGTH = 13
+
+
+# PIECE消息的头部，之后紧接着块数据
+def piece_header(piece_index, block_offset, block_length):
+    return pack(">IBII", 9 + block_length, message.Piece.message_id, piece_index, block_offset)
+
+
+# 对等方的请求队列，按照收到的顺序排列，以(片段号, 块偏移量, 块长度)为关键字，取消时可以直接删除
+class UploadQueue(object):
+    def __init__(self, max_requests=MAX_QUEUED_REQUESTS):
+        self.requests = OrderedDict()
+        self.max_requests = max_requests
+        # 队列中的请求全部发送时需要的字节数，包括每条PIECE消息的头部，计入发送队列的内存占用
+        self.queued_bytes = 0
+
+    # 加入请求，队列已满或重复的请求返回False
+    def add(self, request):
+        key = (request.piece_index, request.block_offset, request.block_length)
+        if key in self.requests or len(self.requests) >= self.max_requests:
+            return False
+        self.requests[key] = request
+        self.queued_bytes += PIECE_HEADER_LENGTH + request.block_length
+        return True
+
+    # 取消还没有处理的请求，返回被取消的请求，不在队列中时返回None
+    def cancel(self, piece_index, block_offset, block_length):
+        request = self.requests.pop((piece_index, block_offset, block_length), None)
+        if request is not None:
+            self.queued_bytes -= PIECE_HEADER_LENGTH + block_length
+        return request
+
+    # 取出队首的请求，以及紧随其后的同一片段中相邻的请求，合并为一次读取
+    def pop_run(self):
+        _, first = self.requests.popitem(last=False)
+        run = [first]
+        end = first.block_offset + first.block_length
+        size = first.block_length
+        while self.requests:
+            key = next(iter(self.requests))
+            piece_index, block_offset, block_length = key
+            if piece_index != first.piece_index or block_offset != end or size + block_length > MAX_COALESCE_SIZE:
+                break
+            run.append(self.requests.pop(key))
+            end += block_length
+            size += block_length
+        self.queued_bytes -= len(run) * PIECE_HEADER_LENGTH + size
+        return run
+
+    # 清空队列，keep中的片段的请求保留，返回被移除的请求
+    def clear(self, keep=()):
+        removed = [request for key, request in self.requests.items() if key[0] not in keep]
+        for request in removed:
+            del self.requests[(request.piece_index, request.block_offset, request.block_length)]
+            self.queued_bytes -= PIECE_HEADER_LENGTH + request.block_length
+        return removed
+
+    def __len__(self):
+        return len(self.requests)
+
+
+# 上传管道，由对等方管理器在事件循环中调用，处理各个对等方排队的请求
+# 相邻的请求合并为一次读取，已缓存或被重复请求的片段从读取缓存中获取；
+# 其他已写入磁盘且位于单个文件中的数据通过os.sendfile直接从文件发送，不经过Python复制
+class Uploader(object):
+    def __init__(self):
+        # 打开的文件描述符，以路径为关键字，按最近使用的顺序排列
+        self.files = OrderedDict()
+        # 通过sendfile和读取发送的字节数
+        self.sendfile_bytes = 0
+        self.read_bytes = 0
+
+    # 处理对等方排队的请求，直到队列为空或发送缓冲区中积压了足够的数据
+    def serve(self, peer, pieces_manager):
+        while peer.upload_queue and peer.healthy and len(peer.write_buffer) < UPLOAD_BUFFER_SIZE:
+            run = peer.upload_queue.pop_run()
+            if self._send_file(peer, pieces_manager, run) or self._send_read(peer, pieces_manager, run):
+                # 统计上传量，用于计算上传速率
+                peer.uploaded += sum(request.block_length for request in run)
+                continue
+            # 读取失败，支持快速扩展的对等方需要明确拒绝
+            if peer.supports_fast:
+                for request in run:
+                    peer.reject(request)
+
+    # 通过sendfile发送，只用于已写入磁盘、且整段数据位于同一个文件中的请求，不通过读取缓存提供的片段
+    def _send_file(self, peer, pieces_manager, run):
+        if not hasattr(os, 'sendfile'):
+            return False
+        piece_index = run[0].piece_index
+        if not pieces_manager.bitfield[piece_index]:
+            return False
+        table = pieces_manager.file_table
+        offset = piece_index * table.piece_length + run[0].block_offset
+        length = sum(request.block_length for request in run)
+        segments = list(table.segments(offset, length))
+        if len(segments) != 1 or table.pads[segments[0][0]]:
+            return False
+        if pieces_manager.is_upload_cached(piece_index, length):
+            return False
+
+        file_index, file_offset, _, _ = segments[0]
+        path_file, file_offset = table.locate(file_index, file_offset)
+        fd = self._open(path_file)
+        if fd is None:
+            return False
+        for i, request in enumerate(run):
+            header = piece_header(request.piece_index, request.block_offset, request.block_length)
+            position = file_offset + request.block_offset - run[0].block_offset
+            if peer.send_file(header, fd, position, request.block_length):
+                self.sendfile_bytes += request.block_length
+                continue
+            # 发送缓冲区中还有数据时不能直接发送，剩下的请求一次从文件读入发送缓冲区
+            rest = run[i:]
+            rest_length = sum(request.block_length for request in rest)
+            try:
+                data = os.pread(fd, rest_length, position)
+            except OSError:
+                return False
+            return self._send_data(peer, rest, data)
+        return True
+
+    # 读取整段数据后发送，片段还没有写入磁盘时从内存中读取，启用读取缓存时从缓存中读取
+    def _send_read(self, peer, pieces_manager, run):
+        first = run[0]
+        length = sum(request.block_length for request in run)
+        return self._send_data(peer, run, pieces_manager.get_block(first.piece_index, first.block_offset, length))
+
+    # 将整段数据拼接为多条PIECE消息后一次发送
+    def _send_data(self, peer, run, data):
+        length = sum(request.block_length for request in run)
+        if not data or len(data) != length:
+            return False
+
+        buf = bytearray()
+        view = memoryview(data)
+        position = 0
+        for request in run:
+            buf += piece_header(request.piece_index, request.block_offset, request.block_length)
+            buf += view[position:position + request.block_length]
+            position += request.block_length
+        peer.send_to_peer(buf)
+        self.read_bytes += length
+        return True
+
+    # 获取文件的只读描述符，超过上限时关闭最久没有使用的文件
+    def _open(self, path_file):
+        fd = self.files.pop(path_file, None)
+        if fd is None:
+            try:
+                fd = os.open(path_file, os.O_RDONLY)
+            except OSError as e:
+                logging.debug("Can't open %s for upload : %s" % (path_file, e.__str__()))
+                return None
+        self.files[path_file] = fd
+        while len(self.files) > MAX_OPEN_FILES:
+            _, old_fd = self.files.popitem(last=False)
+            os.close(old_fd)
+        return fd
+
+    # 关闭所有打开的文件
+    def close(self):
+        for fd in self.files.values():
+            os.close(fd)
+        self.files.clear()
@@ -0,0 +1,571 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import socket
+import struct
+import logging
+from collections import OrderedDict
+from threading import Event
+
+# uTP数据包的类型（BEP 29）
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+# 协议版本
+UTP_VERSION = 1
+# 选择性确认扩展的编号
+EXTENSION_SACK = 1
+# 数据包头部格式和长度
+HEADER_FORMAT = ">BBHIIIHH"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# 每个数据包携带的最大数据量，保证加上UDP和IP头部后不超过常见的MTU
+MSS = 1200
+# LEDBAT的目标排队延迟（秒），延迟低于目标时增大拥塞窗口，高于目标时减小
+TARGET_DELAY = 0.1
+# LEDBAT的增益，每个往返时间拥塞窗口最多增加的数据包数量
+GAIN = 1.0
+# 拥塞窗口的上下限（字节）
+MIN_WINDOW = MSS
+MAX_WINDOW = 1024 * 1024
+# 初始拥塞窗口（字节）
+INITIAL_WINDOW = 4 * MSS
+# 本客户端的接收窗口（字节），已收到但对等方还没有读取的数据不能超过该值
+RECEIVE_WINDOW = 1024 * 1024
+# 基础延迟的历史记录，每分钟记录一个最小值，取最近若干分钟的最小值作为基础延迟
+BASE_DELAY_HISTORY = 10
+# 重传超时的初始值和上限（秒），重传超时至少比往返时间多MIN_TIMEOUT，避免排队延迟稳定时误判超时
+INITIAL_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.5
+MAX_TIMEOUT = 30
+# 连续超时该次数后断开连接
+MAX_TIMEOUTS = 6
+# 建立连接时等待回应的时间（秒）
+CONNECT_TIMEOUT = 3
+# 收到该数量的重复确认，或在某个包之后已有该数量的包被选择性确认时，立即重传该包
+DUPLICATE_ACKS = 3
+# 选择性确认位图的最大长度（字节）
+MAX_SACK_BYTES = 32
+# 连续发送的数据包最多可以积累的发送额度（字节），超过时只能按速率平滑发送
+MAX_BURST = 4 * MSS
+# 计算发送速率时使用的最小往返时间（秒），避免本地连接的速率过高
+MIN_PACING_RTT = 0.001
+# 每次可读时最多处理的数据包数量，避免阻塞对等方的事件循环
+MAX_PACKETS_PER_READ = 256
+# 有待发送的数据或待确认的数据包时，事件循环等待的最长时间（秒）
+ACTIVE_TIMEOUT = 0.005
+# 空闲时事件循环等待的最长时间（秒）
+IDLE_TIMEOUT = 1
+
+SEQ_MASK = 0xFFFF
+TIMESTAMP_MASK = 0xFFFFFFFF
+
+
+# 判断序号a是否在序号b之前，序号为16位并会回绕
+def seq_before(a, b):
+    return a != b and ((b - a) & SEQ_MASK) < 0x8000
+
+
+# 判断回绕的32位时间差a是否小于b
+def timestamp_less(a, b):
+    return ((a - b) & TIMESTAMP_MASK) > 0x7FFFFFFF
+
+
+# 当前时间的微秒数，只用于计算单向延迟
+def timestamp_us(now=None):
+    return int((now if now is not None else time.time()) * 1000000) & TIMESTAMP_MASK
+
+
+# 解析数据包，返回(类型, 连接ID, 时间戳, 时间差, 窗口大小, 序号, 确认号, 选择性确认位图, 数据)，格式错误时返回None
+def parse_packet(data):
+    if len(data) < HEADER_SIZE:
+        return None
+    type_version, extension, connection_id, timestamp, timestamp_diff, window, seq_nr, ack_nr = \
+        struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    packet_type, version = type_version >> 4, type_version & 0x0F
+    if version != UTP_VERSION or packet_type > ST_SYN:
+        return None
+
+    sack = None
+    offset = HEADER_SIZE
+    while extension:
+        if offset + 2 > len(data):
+            return None
+        next_extension, length = data[offset], data[offset + 1]
+        if extension == EXTENSION_SACK:
+            sack = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+        extension = next_extension
+    if offset > len(data):
+        return None
+    return packet_type, connection_id, timestamp, timestamp_diff, window, seq_nr, ack_nr, sack, data[offset:]
+
+
+# 等待确认的数据包
+class OutgoingPacket(object):
+    def __init__(self, packet_type, seq_nr, payload):
+        self.type = packet_type
+        self.seq_nr = seq_nr
+        self.payload = payload
+        # 上次发送的时间
+        self.sent_at = 0.0
+        # 发送的次数，重传过的数据包不用于计算往返时间
+        self.transmissions = 0
+        # 是否已因选择性确认或重复确认而快速重传过
+        self.fast_resent = False
+
+
+# 一个uTP连接，通过套接字对与对等方连接在事件循环中的读写方式保持一致
+# 对等方读写remote_end，本连接从local读取待发送的数据、向local写入收到的数据
+class Connection(object):
+    def __init__(self, manager, address, recv_id, send_id, seq_nr, ack_nr, connected):
+        self.manager = manager
+        self.address = address
+        # 对方发来的数据包使用recv_id，本客户端发出的数据包使用send_id
+        self.recv_id = recv_id
+        self.send_id = send_id
+        # 下一个要发送的数据包序号
+        self.seq_nr = seq_nr
+        # 已按顺序收到的最后一个数据包序号
+        self.ack_nr = ack_nr
+        self.connected = Event()
+        if connected:
+            self.connected.set()
+        self.local, self.remote_end = socket.socketpair()
+        self.local.setblocking(False)
+        # 等待确认的数据包，按序号排列
+        self.outgoing = OrderedDict()
+        # 已发送但还没有确认的字节数
+        self.in_flight = 0
+        # 拥塞窗口和对方的接收窗口（字节）
+        self.cwnd = INITIAL_WINDOW
+        self.peer_window = RECEIVE_WINDOW
+        # 平滑往返时间、偏差和重传超时（秒）
+        self.rtt = None
+        self.rtt_var = 0.0
+        self.timeout = INITIAL_TIMEOUT
+        # 连续超时的次数
+        self.timeouts = 0
+        # 对方上一个数据包的单向延迟（微秒），在下一个发出的数据包中告知对方
+        self.reply_micro = 0
+        # 基础延迟的历史记录，每项为[分钟, 该分钟内的最小延迟]
+        self.delay_history = []
+        # 当前的排队延迟（秒）
+        self.queuing_delay = 0.0
+        # 乱序到达的数据包，以序号为关键字，值为(类型, 数据)
+        self.out_of_order = {}
+        # 已按顺序收到、等待写入local的数据
+        self.to_local = bytearray()
+        # 上一次收到的确认号和重复的次数
+        self.last_ack = None
+        self.duplicate_acks = 0
+        # 最近一次因丢包减小拥塞窗口时的序号，同一个窗口内的丢包只减小一次
+        self.loss_seq_nr = None
+        # 按速率平滑发送的额度（字节）
+        self.pacing_credit = MAX_BURST
+        self.last_pacing = time.time()
+        self.last_received = time.time()
+        # 是否需要向对方发送确认
+        self.need_ack = False
+        # 是否已发送或收到连接结束的数据包
+        self.fin_sent = False
+        self.fin_received = False
+        self.is_closed = False
+
+    # 发送数据包，数据包头部包含最新的确认号、接收窗口和延迟信息
+    def _send_packet(self, packet_type, seq_nr, payload=b'', now=None):
+        now = now if now is not None else time.time()
+        window = max(RECEIVE_WINDOW - len(self.to_local) - sum(len(data) for _, data in self.out_of_order.values()), 0)
+        sack = self._make_sack()
+        header = struct.pack(HEADER_FORMAT, packet_type << 4 | UTP_VERSION, EXTENSION_SACK if sack else 0,
+                             self.recv_id if packet_type == ST_SYN else self.send_id, timestamp_us(now),
+                             self.reply_micro, window, seq_nr, self.ack_nr)
+        if sack:
+            header += bytes([0, len(sack)]) + sack
+        self.manager.send(header + payload, self.address)
+        if packet_type != ST_STATE:
+            self.need_ack = False
+
+    # 为乱序到达的数据包生成选择性确认位图，第i位表示序号ack_nr + 2 + i的数据包已收到
+    def _make_sack(self):
+        if not self.out_of_order:
+            return None
+        offsets = [(seq_nr - self.ack_nr - 2) & SEQ_MASK for seq_nr in self.out_of_order]
+        offsets = [offset for offset in offsets if offset < MAX_SACK_BYTES * 8]
+        if not offsets:
+            return None
+        sack = bytearray((max(offsets) // 32 + 1) * 4)
+        for offset in offsets:
+            sack[offset // 8] |= 1 << (offset % 8)
+        return bytes(sack)
+
+    # 发送需要确认的数据包，并记录在等待确认的列表中
+    def _send_reliable(self, packet_type, payload, now):
+        packet = OutgoingPacket(packet_type, self.seq_nr, payload)
+        self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+        self.outgoing[packet.seq_nr] = packet
+        self.in_flight += len(payload)
+        self._transmit(packet, now)
+
+    def _transmit(self, packet, now):
+        packet.sent_at = now
+        packet.transmissions += 1
+        self._send_packet(packet.type, packet.seq_nr, packet.payload, now)
+
+    # 发起连接
+    def send_syn(self):
+        self._send_reliable(ST_SYN, b'', time.time())
+
+    # 发送确认，只在没有其他数据包可以携带确认时单独发送
+    def send_ack(self):
+        if self.need_ack and not self.is_closed:
+            self._send_packet(ST_STATE, self.seq_nr)
+            self.need_ack = False
+
+    # 断开连接，通知对方并关闭本端的套接字，对等方读到连接关闭后由对等方管理器关闭另一端
+    def close(self, reset=False):
+        if self.is_closed:
+            return
+        if reset:
+            self._send_packet(ST_RESET, self.seq_nr)
+        self.is_closed = True
+        self.connected.set()
+        try:
+            self.local.close()
+        except OSError:
+            pass
+
+    # 更新单向延迟的基础值，排队延迟为当前延迟与基础延迟之差
+    def _update_delay(self, timestamp_diff, now):
+        minute = int(now // 60)
+        if not self.delay_history or self.delay_history[-1][0] != minute:
+            self.delay_history.append([minute, timestamp_diff])
+            del self.delay_history[:-BASE_DELAY_HISTORY]
+        elif timestamp_less(timestamp_diff, self.delay_history[-1][1]):
+            self.delay_history[-1][1] = timestamp_diff
+
+        base_delay = self.delay_history[0][1]
+        for _, delay in self.delay_history[1:]:
+            if timestamp_less(delay, base_delay):
+                base_delay = delay
+        self.queuing_delay = ((timestamp_diff - base_delay) & TIMESTAMP_MASK) / 1000000
+
+    # 按照TCP的方式更新往返时间和重传超时
+    def _update_rtt(self, sample):
+        if self.rtt is None:
+            self.rtt, self.rtt_var = sample, sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.timeout = min(self.rtt + max(4 * self.rtt_var, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    # 丢包时拥塞窗口减半，同一个窗口内的多次丢包只减半一次
+    def _on_loss(self, seq_nr):
+        if self.loss_seq_nr is not None and seq_before(seq_nr, self.loss_seq_nr):
+            return
+        self.loss_seq_nr = self.seq_nr
+        self.cwnd = max(self.cwnd // 2, MIN_WINDOW)
+
+    # 确认一个数据包
+    def _ack_packet(self, seq_nr, now):
+        packet = self.outgoing.pop(seq_nr)
+        self.in_flight -= len(packet.payload)
+        if packet.transmissions == 1:
+            self._update_rtt(now - packet.sent_at)
+        return len(packet.payload)
+
+    # 处理对方的确认号和选择性确认，按照LEDBAT调整拥塞窗口
+    def _handle_ack(self, ack_nr, sack, now):
+        acked_bytes = 0
+        acked_any = False
+        for seq_nr in list(self.outgoing):
+            if seq_before(ack_nr, seq_nr):
+                break
+            acked_bytes += self._ack_packet(seq_nr, now)
+            acked_any = True
+
+        if sack:
+            sacked = [(ack_nr + 2 + i) & SEQ_MASK for i in range(len(sack) * 8) if sack[i // 8] >> (i % 8) & 1]
+            for seq_nr in sacked:
+                if seq_nr in self.outgoing:
+                    acked_bytes += self._ack_packet(seq_nr, now)
+                    acked_any = True
+            # 之后已有足够多的数据包到达，说明该数据包已经丢失
+            for packet in list(self.outgoing.values()):
+                if packet.fast_resent or sum(1 for seq_nr in sacked if seq_before(packet.seq_nr, seq_nr)) \
+                        < DUPLICATE_ACKS:
+                    continue
+                packet.fast_resent = True
+                self._on_loss(packet.seq_nr)
+                self._transmit(packet, now)
+
+        # 重复确认，第一个未确认的数据包可能已经丢失
+        if ack_nr == self.last_ack and not acked_any and self.outgoing:
+            self.duplicate_acks += 1
+            packet = next(iter(self.outgoing.values()))
+            if self.duplicate_acks >= DUPLICATE_ACKS and not packet.fast_resent:
+                packet.fast_resent = True
+                self._on_loss(packet.seq_nr)
+                self._transmit(packet, now)
+        else:
+            self.duplicate_acks = 0
+        self.last_ack = ack_nr
+
+        if acked_any:
+            self.timeouts = 0
+        if acked_bytes:
+            # LEDBAT：排队延迟低于目标时增大窗口，高于目标时按超出的比例减小窗口
+            off_target = (TARGET_DELAY - self.queuing_delay) / TARGET_DELAY
+            self.cwnd += GAIN * off_target * acked_bytes * MSS / self.cwnd
+            self.cwnd = int(min(max(self.cwnd, MIN_WINDOW), MAX_WINDOW))
+
+    # 处理对方发来的数据包
+    def handle_packet(self, packet_type, timestamp, timestamp_diff, window, seq_nr, ack_nr, sack, payload):
+        now = time.time()
+        self.last_received = now
+        self.reply_micro = (timestamp_us(now) - timestamp) & TIMESTAMP_MASK
+        self.peer_window = window
+        if timestamp_diff:
+            self._update_delay(timestamp_diff, now)
+
+        if packet_type == ST_RESET:
+            self.close()
+            return
+
+        if not self.connected.is_set():
+            if packet_type != ST_STATE:
+                return
+            # 对方回应连接请求，对方的第一个数据包序号即为该确认中的序号
+            self.ack_nr = (seq_nr - 1) & SEQ_MASK
+            self.connected.set()
+
+        self._handle_ack(ack_nr, sack, now)
+
+        if packet_type in (ST_DATA, ST_FIN):
+            self.need_ack = True
+            offset = (seq_nr - self.ack_nr - 1) & SEQ_MASK
+            if offset == 0:
+                self._deliver(packet_type, payload)
+                # 之后的乱序数据包可能已经连续
+                while (self.ack_nr + 1) & SEQ_MASK in self.out_of_order:
+                    self._deliver(*self.out_of_order.pop((self.ack_nr + 1) & SEQ_MASK))
+            elif offset < 0x8000 and seq_nr not in self.out_of_order:
+                self.out_of_order[seq_nr] = (packet_type, payload)
+
+        self._write_local()
+
+    # 按顺序交付数据
+    def _deliver(self, packet_type, payload):
+        self.ack_nr = (self.ack_nr + 1) & SEQ_MASK
+        if packet_type == ST_FIN:
+            self.fin_received = True
+        else:
+            self.to_local += payload
+
+    # 将收到的数据写入套接字对，对等方从另一端读取
+    def _write_local(self):
+        try:
+            while self.to_local:
+                sent = self.local.send(self.to_local)
+                del self.to_local[:sent]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close(reset=True)
+            return
+        # 对方已经结束连接，数据全部交付后关闭
+        if self.fin_received and not self.to_local:
+            self.send_ack()
+            self.close()
+
+    # 超时重传第一个未确认的数据包，拥塞窗口降为最小值
+    def _check_timeout(self, now):
+        if not self.outgoing:
+            return
+        packet = next(iter(self.outgoing.values()))
+        if now - packet.sent_at < self.timeout:
+            return
+        self.timeouts += 1
+        if self.timeouts > MAX_TIMEOUTS:
+            logging.debug("uTP connection to %s timed out" % self.address[0])
+            self.close(reset=True)
+            return
+        self.timeout = min(self.timeout * 2, MAX_TIMEOUT)
+        self.cwnd = MIN_WINDOW
+        self.loss_seq_nr = self.seq_nr
+        self._transmit(packet, now)
+
+    # 拥塞窗口和对方接收窗口是否允许再发送一个数据包
+    def _window_open(self):
+        return self.in_flight + MSS <= min(self.cwnd, self.peer_window) or not self.in_flight
+
+    # 是否可以发送对等方写入的数据，不能发送时事件循环不必监听套接字对，避免反复被唤醒
+    def can_send(self):
+        return self.connected.is_set() and not self.is_closed and not self.fin_sent and self.pacing_credit > 0 \
+            and self._window_open()
+
+    # 在拥塞窗口和对方接收窗口允许的范围内，按速率平滑地发送对等方写入的数据
+    def _send_data(self, now):
+        if not self.connected.is_set() or self.fin_sent:
+            return
+        rtt = max(self.rtt if self.rtt is not None else self.timeout, MIN_PACING_RTT)
+        self.pacing_credit = min(self.pacing_credit + (now - self.last_pacing) * self.cwnd / rtt, MAX_BURST)
+        self.last_pacing = now
+
+        while self.pacing_credit > 0 and self._window_open():
+            try:
+                data = self.local.recv(MSS)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            # 对等方关闭了连接
+            if not data:
+                self.fin_sent = True
+                self._send_reliable(ST_FIN, b'', now)
+                return
+            self.pacing_credit -= len(data)
+            self._send_reliable(ST_DATA, data, now)
+
+    # 由管理器在每次事件循环中调用
+    def update(self, now):
+        if self.is_closed:
+            return
+        self._check_timeout(now)
+        if self.is_closed:
+            return
+        self._write_local()
+        if self.is_closed:
+            return
+        self._send_data(now)
+        self.send_ack()
+        # 已发送连接结束的数据包并全部确认
+        if self.fin_sent and not self.outgoing:
+            self.close()
+
+    # 是否有需要尽快处理的数据：待确认的数据包、待发送的确认、待交付的数据，或因速率限制暂缓发送的数据
+    def is_active(self):
+        return bool(self.outgoing or self.need_ack or self.to_local) or self.pacing_credit <= 0
+
+
+# uTP传输（BEP 29），在UDP上提供类似TCP的可靠连接，使用LEDBAT拥塞控制
+# 网络中的排队延迟超过目标时主动降低速率，大量的后台传输不会占满路由器的缓冲区，影响同一链路上其他服务的延迟
+# 与对等方管理器共享事件循环，每个连接对对等方表现为一个普通的流套接字
+class UTP(object):
+    def __init__(self, peers_manager, port, sock=None):
+        self.peers_manager = peers_manager
+        # 与DHT共享同一个UDP套接字时，由DHT把不是KRPC的数据包交给handle_packet
+        self.shared_socket = sock is not None
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(('', port))
+            sock.setblocking(False)
+        self.socket = sock
+        # 所有连接，以(IP地址, 端口号, 接收连接ID)为关键字
+        self.connections = {}
+
+    # 需要事件循环监听的套接字：UDP套接字和每个连接的套接字对
+    def sockets(self):
+        sockets = [] if self.shared_socket else [self.socket]
+        sockets.extend(connection.local for connection in list(self.connections.values()) if connection.can_send())
+        return sockets
+
+    # 事件循环等待的最长时间，有数据在传输时需要及时重传和按速率发送
+    def timeout(self):
+        for connection in list(self.connections.values()):
+            if connection.is_active():
+                return ACTIVE_TIMEOUT
+        return IDLE_TIMEOUT
+
+    # 套接字可读时由对等方管理器调用
+    def handle_readable(self, sock):
+        if sock is not self.socket:
+            # 对等方写入了数据，在下一次update中发送
+            return
+        for _ in range(MAX_PACKETS_PER_READ):
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.debug("uTP recv failed : %s" % e.__str__())
+                break
+            self.handle_packet(data, address)
+        self.send_acks()
+
+    def send(self, data, address):
+        try:
+            self.socket.sendto(data, address)
+        except OSError as e:
+            logging.debug("uTP send to %s failed : %s" % (address[0], e.__str__()))
+
+    # 处理收到的数据包
+    def handle_packet(self, data, address):
+        packet = parse_packet(data)
+        if not packet:
+            return
+        packet_type, connection_id, timestamp, timestamp_diff, window, seq_nr, ack_nr, sack, payload = packet
+        ip, port = address
+
+        if packet_type == ST_SYN:
+            self._accept(address, connection_id, seq_nr)
+            return
+        connection = self.connections.get((ip, port, connection_id))
+        if connection:
+            connection.handle_packet(packet_type, timestamp, timestamp_diff, window, seq_nr, ack_nr, sack, payload)
+
+    # 接受对方发起的连接，交给对等方管理器
+    def _accept(self, address, connection_id, seq_nr):
+        key = (address[0], address[1], (connection_id + 1) & SEQ_MASK)
+        connection = self.connections.get(key)
+        # 重复的连接请求，对方没有收到回应
+        if connection:
+            connection.need_ack = True
+            return
+        connection = Connection(self, address, key[2], connection_id, struct.unpack(">H", os.urandom(2))[0],
+                                seq_nr, True)
+        connection.need_ack = True
+        if not self.peers_manager.accept_stream(connection.remote_end, address[0], address[1], True):
+            connection.close(reset=True)
+            return
+        self.connections[key] = connection
+
+    # 发起连接，在连接线程中调用并等待对方回应，成功时返回对等方使用的套接字，失败时返回None
+    def connect(self, ip, port, timeout=CONNECT_TIMEOUT):
+        recv_id = struct.unpack(">H", os.urandom(2))[0]
+        key = (ip, port, recv_id)
+        if key in self.connections:
+            return None
+        connection = Connection(self, (ip, port), recv_id, (recv_id + 1) & SEQ_MASK, 1, 0, False)
+        self.connections[key] = connection
+        connection.send_syn()
+        if connection.connected.wait(timeout) and not connection.is_closed:
+            return connection.remote_end
+        connection.close()
+        connection.remote_end.close()
+        return None
+
+    # 立即发送收到数据后需要的确认，多个数据包合并为一个确认
+    def send_acks(self):
+        for connection in list(self.connections.values()):
+            connection.send_ack()
+
+    # 由对等方管理器在每次事件循环中调用
+    def update(self):
+        now = time.time()
+        for key, connection in list(self.connections.items()):
+            # 发起连接的线程等待超时后会关闭连接
+            connection.update(now)
+            if connection.is_closed:
+                del self.connections[key]
+
+    # 所有连接的统计信息
+    def stats(self):
+        connections = list(self.connections.values())
+        return {
+            'connections': len(connections),
+            'queuing_delay': max([connection.queuing_delay for connection in connections] or [0.0])
+        }
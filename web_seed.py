@@ -0,0 +1,201 @@
+__author__ = 'alexisgallepe'
+
+import os
+import time
+import queue
+import logging
+from threading import Thread
+from urllib.parse import quote
+import requests
+from requests.adapters import HTTPAdapter
+from pubsub import pub
+from block import BLOCK_SIZE
+
+# 每个网络种子同时进行的范围请求数量，也是连接池中保持的连接数量
+WEB_SEED_CONNECTIONS = 4
+# 每个范围请求最多包含的连续片段的总大小，至少包含一个片段
+MAX_SPAN_SIZE = 4 * 1024 * 1024
+# 请求的超时时间（秒）
+WEB_SEED_TIMEOUT = 30
+# 请求失败后等待该时间（秒）再重试
+RETRY_INTERVAL = 60
+# 连续失败该次数后不再使用该网络种子
+MAX_FAILURES = 5
+# 读取响应的分块大小
+READ_CHUNK_SIZE = 256 * 1024
+
+
+# 请求失败的异常
+class WebSeedError(Exception):
+    pass
+
+
+# 网络种子（BEP 19），通过HTTP范围请求下载缺少的片段
+# 选取连续的、还没有开始下载的片段，按文件段表映射为各个文件中的字节范围，由多个线程通过连接池并行下载
+# 下载到的数据在事件循环中按块交给片段管理器，与对等方发来的块使用同一条校验路径
+class WebSeed(object):
+    def __init__(self, url, torrent, pieces_manager, connections=WEB_SEED_CONNECTIONS):
+        self.url = url
+        self.torrent = torrent
+        self.pieces_manager = pieces_manager
+        self.file_table = pieces_manager.file_table
+        self.connections = connections
+        # 保持连接的HTTP会话，连接池的大小与并行请求的数量相同
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 等待下载的片段范围和下载结果，由下载线程处理
+        self.spans = queue.Queue()
+        self.results = queue.Queue()
+        # 正在下载的片段范围数量
+        self.in_flight = 0
+        # 连续失败的次数和上次失败的时间
+        self.failures = 0
+        self.last_failure = 0.0
+        # 校验失败次数过多而被停用
+        self.is_banned = False
+        # 从该网络种子下载的字节数
+        self.downloaded = 0
+
+        for _ in range(connections):
+            Thread(target=self._worker, daemon=True).start()
+
+        # events
+        # 订阅事件，网络种子发送坏数据时停用
+        pub.subscribe(self.ban, 'PeersManager.BanPeer')
+
+    # 停用发送坏数据的网络种子
+    def ban(self, source=None):
+        if source == self.url and not self.is_banned:
+            logging.warning("Banned web seed : %s" % self.url)
+            self.is_banned = True
+
+    # 是否可以发起新的请求
+    def is_available(self):
+        if self.is_banned or self.failures >= MAX_FAILURES:
+            return False
+        return not self.failures or time.time() - self.last_failure >= RETRY_INTERVAL
+
+    # 由下载循环调用：交付下载完成的数据，并在有空闲连接时请求新的片段范围
+    def update(self, pick_order):
+        self._handle_results()
+        if self.in_flight >= self.connections or not self.is_available():
+            return
+        # 内存预算用完时不再开始新的片段
+        if self.pieces_manager.memory_budget.is_exhausted():
+            return
+
+        for span in self._pick_spans(pick_order):
+            self.in_flight += 1
+            self.spans.put(span)
+            if self.in_flight >= self.connections:
+                break
+
+    # 按照片段选择器的顺序，从还没有开始下载的片段开始，向后合并连续的未开始下载的片段
+    # 遇到不需要下载的片段时停止合并，不下载的文件中的片段不会被下载
+    def _pick_spans(self, pick_order):
+        pieces = self.pieces_manager.pieces
+        for index in pick_order:
+            if pieces[index].is_full or pieces[index].is_started() or not self.pieces_manager.is_wanted(index):
+                continue
+            end = index
+            size = 0
+            while end < len(pieces) and not pieces[end].is_full and not pieces[end].is_started() \
+                    and self.pieces_manager.is_wanted(end) \
+                    and (size == 0 or size + pieces[end].piece_size <= MAX_SPAN_SIZE):
+                # 占用片段中的所有块，对等方不会再请求它们
+                while pieces[end].get_empty_block():
+                    pass
+                size += pieces[end].piece_size
+                end += 1
+            yield index, end
+
+    # 交付下载完成的片段范围，失败时释放其中的块，由对等方或之后的请求重新下载
+    def _handle_results(self):
+        while True:
+            try:
+                first, end, data = self.results.get_nowait()
+            except queue.Empty:
+                return
+            self.in_flight -= 1
+            pieces = self.pieces_manager.pieces
+
+            if data is None:
+                for index in range(first, end):
+                    for block_index in range(pieces[index].number_of_blocks):
+                        pieces[index].free_block(block_index * BLOCK_SIZE)
+                continue
+
+            self.downloaded += len(data)
+            position = 0
+            for index in range(first, end):
+                for offset in range(0, pieces[index].piece_size, BLOCK_SIZE):
+                    block = data[position + offset:position + min(offset + BLOCK_SIZE, pieces[index].piece_size)]
+                    pub.sendMessage('PiecesManager.Piece', piece=(index, offset, block),
+                                    info_hash=self.torrent.info_hash, source=self.url)
+                position += pieces[index].piece_size
+
+    # 下载线程，依次下载队列中的片段范围
+    def _worker(self):
+        while True:
+            first, end = self.spans.get()
+            try:
+                data = self._download_span(first, end)
+                self.failures = 0
+            except Exception as e:
+                logging.warning("Web seed %s failed : %s" % (self.url, e.__str__()))
+                self.failures += 1
+                self.last_failure = time.time()
+                data = None
+            self.results.put((first, end, data))
+
+    # 下载一段连续的片段，每个文件段发起一个范围请求，填充部分直接补0
+    # v2种子中文件的最后一个片段不包含之后的填充，片段之间可能有空隙，下载整段数据后只保留各个片段自己的数据
+    def _download_span(self, first, end):
+        pieces = self.pieces_manager.pieces
+        piece_length = self.torrent.piece_length
+        offset = first * piece_length
+        length = (end - 1 - first) * piece_length + pieces[end - 1].piece_size
+        data = bytearray()
+        for file_index, file_offset, segment_length, _ in self.file_table.segments(offset, length):
+            if self.file_table.pads[file_index]:
+                data += bytes(segment_length)
+            else:
+                data += self._get_range(self.file_url(file_index), file_offset, segment_length)
+        if len(data) != length:
+            raise WebSeedError("Expected %d bytes, got %d" % (length, len(data)))
+        return b''.join(data[(index - first) * piece_length:(index - first) * piece_length + pieces[index].piece_size]
+                        for index in range(first, end))
+
+    # 请求文件中的一段字节范围
+    def _get_range(self, url, offset, length):
+        headers = {'Range': 'bytes=%d-%d' % (offset, offset + length - 1)}
+        with self.session.get(url, headers=headers, stream=True, timeout=WEB_SEED_TIMEOUT) as response:
+            # 不支持范围请求的服务器返回整个文件，只能跳过前面的数据
+            if response.status_code == 200:
+                skip = offset
+            elif response.status_code == 206:
+                skip = 0
+            else:
+                raise WebSeedError("HTTP %d for %s" % (response.status_code, url))
+
+            data = bytearray()
+            for chunk in response.iter_content(READ_CHUNK_SIZE):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                data += chunk
+                if len(data) >= length:
+                    break
+        return data[:length]
+
+    # 文件的下载地址：多文件种子为<地址>/<种子名称>/<路径>，单文件种子的地址以/结尾时为<地址>/<文件名>，否则就是文件本身
+    def file_url(self, file_index):
+        parts = self.file_table.paths[file_index].split(os.sep)
+        single_file = sum(1 for pad in self.file_table.pads if not pad) == 1
+        if single_file and not self.url.endswith('/'):
+            return self.url
+        base = self.url if self.url.endswith('/') else self.url + '/'
+        return base + '/'.join(quote(part) for part in parts)